@@ -1,7 +1,86 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
-import io
+import hashlib
+
+from billing import export, ingest, normalize, schema
+
+SELECT_PAGE_ROWS = 200 # 選択用の一覧に一度に表示する行数
+
+
+@st.cache_resource
+def get_export_cache():
+    """セッションをまたいで共有する出力ファイルのキャッシュ。"""
+    return export.ExportCache(max_entries=8)
+
+
+def keys_to_mask(keys, size):
+    """請求キー (行番号) の集合から、長さ size のブールマスクを作る。"""
+    mask = np.zeros(size, dtype=bool)
+    mask[np.fromiter(keys, dtype=np.intp, count=len(keys))] = True
+    return mask
+
+
+def select_invoices(df, data_id):
+    """バクラク請求書ごとに「入金済み」「出力から除外」を選択する。(入金済みのマスク, 除外のマスク) を返す。
+
+    各行には行番号を請求キーとして割り当て、選択状態はキーの集合としてセッションに保持する
+    (同じ書類番号・送付先名・金額の行が複数あってもキーで区別できる)。
+    一覧は検索条件に合う行を SELECT_PAGE_ROWS 行ずつ表示し、ブラウザには表示中の行だけを送る。
+    data_id (ファイル内容のハッシュ値) が変わると選択状態をリセットする。
+    """
+    state = st.session_state
+    if state.get('bakuraku_data_id') != data_id:
+        state['bakuraku_data_id'] = data_id
+        state['bakuraku_paid_keys'] = set()
+        state['bakuraku_excluded_keys'] = set()
+    paid_keys = state['bakuraku_paid_keys']
+    excluded_keys = state['bakuraku_excluded_keys']
+
+    query = st.text_input("書類番号・送付先名で検索", key="bakuraku_search").strip()
+    matched = np.arange(len(df))
+    if query:
+        hit = (df['書類番号'].astype(str).str.contains(query, regex=False)
+               | df['送付先名'].astype(str).str.contains(query, regex=False))
+        matched = matched[hit.to_numpy()]
+
+    pages = max(1, -(-len(matched) // SELECT_PAGE_ROWS))
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"ページ (全{pages:,}ページ / {len(matched):,}件)", min_value=1, max_value=pages, value=1, step=1, key="bakuraku_select_page")
+    keys = matched[(page - 1) * SELECT_PAGE_ROWS:page * SELECT_PAGE_ROWS]
+
+    view = df.iloc[keys][['書類番号', '送付先名', '金額', '日付']]
+    view.insert(0, '請求キー', keys)
+    view.insert(1, '入金済み', [int(key) in paid_keys for key in keys])
+    view.insert(2, '除外', [int(key) in excluded_keys for key in keys])
+    edited = st.data_editor(
+        view,
+        column_config={
+            '入金済み': st.column_config.CheckboxColumn('入金済み', help="入金が完了している請求を選択してください。"),
+            '除外': st.column_config.CheckboxColumn('出力から除外', help="Excel/CSVファイルに出力したくない請求書を選択してください。"),
+            '金額': st.column_config.NumberColumn('金額', format='localized'),
+        },
+        disabled=['請求キー', '書類番号', '送付先名', '金額', '日付'],
+        hide_index=True,
+        # 検索条件・ページごとに別の表として扱う (選択状態はキーの集合に反映済み)
+        key=f"bakuraku_select_{data_id}_{query}_{page}"
+    )
+
+    # 表示中の行の選択状態をキーの集合に反映する
+    for key, paid, excluded in zip(keys.tolist(), edited['入金済み'], edited['除外']):
+        if paid:
+            paid_keys.add(key)
+        else:
+            paid_keys.discard(key)
+        if excluded:
+            excluded_keys.add(key)
+        else:
+            excluded_keys.discard(key)
+    st.caption(f"入金済み: {len(paid_keys):,}件 / 出力から除外: {len(excluded_keys):,}件 (全{len(df):,}件)")
+    return keys_to_mask(paid_keys, len(df)), keys_to_mask(excluded_keys, len(df))
+
 
 # --- Streamlit UI ---
 st.title("請求書管理アプリ")
@@ -13,14 +92,12 @@ uploaded_np_file = st.file_uploader("NP掛け払いCSVファイルをアップ
 
 np_df_processed = pd.DataFrame()
 if uploaded_np_file is not None:
-    try:
-        np_df_raw = pd.read_csv(uploaded_np_file, encoding='shift_jis') # 仮定: Shift-JIS
-    except UnicodeDecodeError:
-        try:
-            np_df_raw = pd.read_csv(uploaded_np_file, encoding='utf-8')
-        except Exception as e:
-            st.error(f"NP掛け払いCSVの読み込み中にエラーが発生しました: {e}。エンコーディングを確認してください。")
-            np_df_raw = pd.DataFrame()
+    # 文字コードは先頭部分から判定し、1回のデコード・パースで読み込む
+    np_df_raw, read_messages = ingest.read_csv_file(uploaded_np_file.name, uploaded_np_file.getvalue())
+    for level, message in read_messages:
+        getattr(st, level)(message)
+    if np_df_raw is None:
+        np_df_raw = pd.DataFrame()
             
     if not np_df_raw.empty:
         st.subheader("NP掛け払いCSV内容（先頭5行）")
@@ -34,12 +111,11 @@ if uploaded_np_file is not None:
                 np_df_raw = pd.DataFrame() # 必要なカラムがなければ処理を中断
             else:
                 np_df_processed = np_df_raw.copy()
-                np_df_processed['入金有無'] = np_df_processed['入金ステータス'].apply(lambda x: 'あり' if x == '入金完了' else 'なし')
-                np_df_processed['未入金金額合計(税込)'] = np_df_processed.apply(
-                    lambda row: row['請求金額'] if row['入金有無'] == 'なし' else 0, axis=1
-                )
+                np_paid = (np_df_processed['入金ステータス'] == '入金完了').to_numpy()
+                np_df_processed['入金有無'] = normalize.payment_flag(np_paid)
+                np_df_processed['未入金金額合計(税込)'] = normalize.unpaid_amount(np_df_processed['請求金額'], np_paid)
                 np_df_processed['ご請求金額合計(税込)'] = np_df_processed['請求金額']
-                np_df_processed['ご利用年月'] = pd.to_datetime(np_df_processed['請求日付']).dt.strftime('%Y年%m月') # 例
+                np_df_processed['ご利用年月'] = pd.to_datetime(np_df_processed['請求日付']).dt.to_period('M') # 例 (表示・出力時に 'YYYY年MM月' にする)
                 np_df_processed['ご請求方法'] = 'NP掛け払い' # 固定値
                 
                 # 最終フォーマットに合わせるためのカラム選択とリネーム
@@ -68,14 +144,11 @@ uploaded_bakuraku_file = st.file_uploader("バクラク請求書CSVファイル
 bakuraku_df_processed = pd.DataFrame()
 
 if uploaded_bakuraku_file is not None:
-    try:
-        bakuraku_df_raw = pd.read_csv(uploaded_bakuraku_file, encoding='utf-8-sig') # 仮定: UTF-8-sig
-    except UnicodeDecodeError:
-        try:
-            bakuraku_df_raw = pd.read_csv(uploaded_bakuraku_file, encoding='utf-8')
-        except Exception as e:
-            st.error(f"バクラク請求書CSVの読み込み中にエラーが発生しました: {e}。エンコーディングを確認してください。")
-            bakuraku_df_raw = pd.DataFrame()
+    bakuraku_df_raw, read_messages = ingest.read_csv_file(uploaded_bakuraku_file.name, uploaded_bakuraku_file.getvalue())
+    for level, message in read_messages:
+        getattr(st, level)(message)
+    if bakuraku_df_raw is None:
+        bakuraku_df_raw = pd.DataFrame()
 
     if not bakuraku_df_raw.empty:
         st.subheader("バクラク請求書CSV内容（先頭5行）")
@@ -87,44 +160,30 @@ if uploaded_bakuraku_file is not None:
             bakuraku_df_raw = pd.DataFrame()
         else:
             bakuraku_temp_df = bakuraku_df_raw.copy()
-            bakuraku_temp_df['入金状況'] = '未入金（ユーザー未選択）' # 初期値
-
-            bakuraku_temp_df['請求識別子'] = bakuraku_temp_df['書類番号'].astype(str) + " - " + \
-                                          bakuraku_temp_df['送付先名'].astype(str) + " - " + \
-                                          bakuraku_temp_df['金額'].astype(str)
-
-            # Step 2a: 入金済み請求の選択
-            st.subheader("2a. 入金済みと認識するバクラク請求書を選択してください")
-            selected_paid_invoices_ids = st.multiselect(
-                "入金済みの請求を選択",
-                options=bakuraku_temp_df['請求識別子'].tolist(),
-                help="入金が完了している請求を選択してください。",
-                key="bakuraku_paid_select"
+
+            # Step 2a: 入金済みの請求と、出力から除外する請求の選択
+            st.subheader("2a. 入金済みと認識する請求書・出力から除外する請求書を選択してください")
+            data_id = hashlib.sha256(uploaded_bakuraku_file.getvalue()).hexdigest()
+            bakuraku_paid, bakuraku_excluded = select_invoices(bakuraku_temp_df, data_id)
+            bakuraku_temp_df['入金状況'] = pd.Categorical.from_codes(
+                bakuraku_paid.astype('int8'),
+                categories=['未入金（ユーザー未選択）', '入金済み（ユーザー選択）']
             )
-            bakuraku_temp_df.loc[bakuraku_temp_df['請求識別子'].isin(selected_paid_invoices_ids), '入金状況'] = '入金済み（ユーザー選択）'
             
             st.subheader("現在のバクラク請求書入金状況")
             st.dataframe(bakuraku_temp_df[['書類番号', '送付先名', '金額', '入金状況']].head())
 
-            # Step 2b: 出力から除外する請求書を選択
-            st.subheader("2b. 出力から除外するバクラク請求書を選択してください")
-            excluded_from_output_ids = st.multiselect(
-                "出力から除外する請求書を選択",
-                options=bakuraku_temp_df['請求識別子'].tolist(),
-                help="Excel/CSVファイルに出力したくない請求書を選択してください。",
-                key="bakuraku_exclude_select"
-            )
-            bakuraku_temp_df = bakuraku_temp_df[~bakuraku_temp_df['請求識別子'].isin(excluded_from_output_ids)].copy()
+            bakuraku_kept = ~bakuraku_excluded
+            bakuraku_temp_df = bakuraku_temp_df[bakuraku_kept].copy()
+            bakuraku_paid = bakuraku_paid[bakuraku_kept]
 
             if not bakuraku_temp_df.empty:
                 # バクラクデータ整形
                 bakuraku_df_processed = bakuraku_temp_df.copy()
-                bakuraku_df_processed['入金有無'] = bakuraku_df_processed['入金状況'].apply(lambda x: 'あり' if x.startswith('入金済み') else 'なし')
-                bakuraku_df_processed['未入金金額合計(税込)'] = bakuraku_df_processed.apply(
-                    lambda row: row['金額'] if row['入金有無'] == 'なし' else 0, axis=1
-                )
+                bakuraku_df_processed['入金有無'] = normalize.payment_flag(bakuraku_paid)
+                bakuraku_df_processed['未入金金額合計(税込)'] = normalize.unpaid_amount(bakuraku_df_processed['金額'], bakuraku_paid)
                 bakuraku_df_processed['ご請求金額合計(税込)'] = bakuraku_df_processed['金額']
-                bakuraku_df_processed['ご利用年月'] = pd.to_datetime(bakuraku_df_processed['日付']).dt.strftime('%Y年%m月') # 日付からご利用年月
+                bakuraku_df_processed['ご利用年月'] = pd.to_datetime(bakuraku_df_processed['日付']).dt.to_period('M') # 日付からご利用年月
                 bakuraku_df_processed['ご請求方法'] = '直接請求' # 仮定：バクラクは直接請求
 
                 # 最終フォーマットに合わせるためのカラム選択とリネーム
@@ -161,7 +220,7 @@ elif not bakuraku_df_processed.empty:
 if not final_output_df.empty:
     total_row = pd.DataFrame([
         {
-            'ご利用年月': '',
+            'ご利用年月': None,
             'ご請求方法': '合計', # 合計行のご請求方法は「合計」とする
             'ご請求金額合計(税込)': final_output_df['ご請求金額合計(税込)'].sum(),
             '未入金金額合計(税込)': final_output_df['未入金金額合計(税込)'].sum(),
@@ -170,11 +229,11 @@ if not final_output_df.empty:
             'お支払期日': '',
             '入金有無': ''
         }
-    ])
+    ]).astype({'ご利用年月': final_output_df['ご利用年月'].dtype})
     final_output_df = pd.concat([final_output_df, total_row], ignore_index=True)
     
     st.subheader("最終出力データ (合計行含む)")
-    st.dataframe(final_output_df)
+    st.dataframe(schema.with_month_labels(final_output_df))
 
 # 出力オプション
 if not final_output_df.empty:
@@ -183,14 +242,18 @@ if not final_output_df.empty:
     timestamp_str = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_filename_base = f"ご請求およびご入金状況一覧_{timestamp_str}"
 
+    # 出力ファイルはダウンロードボタンが押されたときに作成し、同じデータなら作成済みのものを使う
     if output_format == "Excel (.xlsx)":
-        excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            final_output_df.to_excel(writer, sheet_name="ご入金状況一覧", index=False)
-        
+        def build_excel(path):
+            # 書き込み専用モードで行を順に書き出す (金額は値のまま、桁区切りの表示形式を設定)
+            export.write_workbook(
+                [("ご入金状況一覧", final_output_df)], path,
+                number_formats={'ご請求金額合計(税込)': export.AMOUNT_FORMAT, '未入金金額合計(税込)': export.AMOUNT_FORMAT}
+            )
+
         st.download_button(
             label="Excelでダウンロード",
-            data=excel_buffer.getvalue(),
+            data=get_export_cache().deferred(('xlsx',), final_output_df, build_excel),
             file_name=f"{output_filename_base}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             key="download_excel"
@@ -201,27 +264,32 @@ if not final_output_df.empty:
             ("UTF-8 (BOMなし)", "Windows (CP932)"), # 選択肢名を維持
             key="csv_encoding_select"
         )
-        
-        csv_buffer = io.BytesIO() # BytesIOはCSVをバイト列として保持するために必要
-
-        if csv_encoding_choice == "UTF-8 (BOMなし)":
-            # to_csvでUTF-8文字列を生成し、それをutf-8でエンコードしてBytesIOに書き込む
-            csv_str = final_output_df.to_csv(index=False, encoding='utf-8')
-            csv_buffer.write(csv_str.encode('utf-8'))
-            mime_type = "text/csv"
-        else: # Windows (CP932)
-            # to_csvでcp932文字列を生成し、それをcp932でエンコードしてBytesIOに書き込む
-            csv_str = final_output_df.to_csv(index=False, encoding='cp932')
-            csv_buffer.write(csv_str.encode('cp932', errors='replace')) # errors='replace'で変換できない文字を置換
-            mime_type = "text/csv"
+        csv_encoding = {"UTF-8 (BOMなし)": 'utf-8', "Windows (CP932)": 'cp932'}[csv_encoding_choice]
 
-        st.download_button(
-            label="CSVでダウンロード",
-            data=csv_buffer.getvalue(),
-            file_name=f"{output_filename_base}.csv",
-            mime=mime_type,
-            key="download_csv"
-        )
+        # 選んだ文字コードで表せない文字がある行を先に知らせる (出力時は '?' に置き換えるか、出力しない)
+        csv_errors = 'replace'
+        unencodable = export.find_unencodable(final_output_df, csv_encoding)
+        if not unencodable.empty:
+            st.warning(f"{csv_encoding_choice} で表せない文字が {len(unencodable):,} 箇所あります。出力時は '?' に置き換えられます。")
+            st.dataframe(unencodable.head(100), hide_index=True)
+            if st.checkbox("表せない文字がある場合はCSVを出力しない", key="csv_strict"):
+                csv_errors = 'strict'
+
+        def build_csv(path):
+            # 選んだ文字コードでファイルに直接書き込む (文字列全体を作ってからエンコードし直さない)
+            with open(path, 'wb') as f:
+                export.write_csv(schema.with_month_labels(final_output_df), f, csv_encoding, csv_errors)
+
+        if csv_errors == 'strict':
+            st.error("表せない文字を修正するか、UTF-8 を選択してください。")
+        else:
+            st.download_button(
+                label="CSVでダウンロード",
+                data=get_export_cache().deferred(('csv', csv_encoding), final_output_df, build_csv),
+                file_name=f"{output_filename_base}.csv",
+                mime=export.CSV_MIME,
+                key="download_csv"
+            )
 else:
     st.info("出力対象のデータがありません。")
 
@@ -1,8 +1,12 @@
 import streamlit as st
 import pandas as pd
-import io
+import numpy as np
 import datetime
-import unicodedata # 文字列の正規化に使用
+import hashlib
+import os
+import uuid
+
+from billing import export, ingest, jobs, normalize, pipeline, profiling, reconcile, schema, selection, sheets, statement, store
 
 # Streamlitページの基本設定
 st.set_page_config(
@@ -11,8 +15,288 @@ st.set_page_config(
     initial_sidebar_state="expanded" # サイドバーをデフォルトで開く
 )
 
+
+@st.cache_resource
+def get_job_executor():
+    """セッションをまたいで共有するジョブの実行器 (同時に実行する数は環境変数 BILLING_JOB_WORKERS で変更できる)。"""
+    return jobs.JobExecutor()
+
+
+SOURCE_LABELS = {ingest.NP: "NP掛け払いCSV", ingest.BAKURAKU: "バクラク請求書CSV", ingest.BANK: "入金明細CSV"}
+
+
+def load_uploaded_files(source, file_keys, chunksize, files):
+    """アップロードされたCSV群を共有の実行器で読み込んで整形する。読み込み中・失敗・キャンセルの場合は None を返す。
+
+    ファイルごとの読み込み (パースと列名の正規化) をそれぞれ1つのジョブにして並列に実行し、
+    すべて終わったら結合と整形を1つのジョブで行う。ジョブのキーはデータソースと各ファイルの (ファイル名, 内容のSHA-256) のみで、
+    同じファイルの読み込みは別のセッションからのものも含めて1回だけ行い、完了後もしばらく結果を共有する。
+    分割読み込み (chunksize) の場合は、メモリを抑えるため1つのジョブで1ファイルずつ読み込む。
+    """
+    label = SOURCE_LABELS[source]
+    if source == ingest.NP and chunksize:
+        return run_job(
+            ('load', source, file_keys, chunksize), f"{label}の読み込み",
+            ingest.load_np_chunked, files, chunksize, stages=1
+        )
+    reads = {}
+    for (name, digest), (_, data) in zip(file_keys, files):
+        key = ('read', source, name, digest)
+        if key not in reads:
+            reads[key] = run_job(key, f"{name} の読み込み", ingest.read_file, name, data, stages=1)
+    if any(result is None for result in reads.values()):
+        return None
+    results = [reads[('read', source, name, digest)] for name, digest in file_keys]
+    return run_job(
+        ('load', source, file_keys), f"{label}の整形",
+        ingest.process_files, source, results, stages=3 if source == ingest.BAKURAKU else 2
+    )
+
+
+def run_job(key, label, fn, *args, stages=None, **kwargs):
+    """fn を共有の実行器でジョブとして実行し、完了していれば結果を返す。
+
+    完了していなければ進捗とキャンセルボタンをこの位置に表示して None を返す (スクリプトは止めないので、
+    後に続く読み込みも同時に投入される。完了するとページ全体が再実行される)。
+    失敗した場合、このセッションでキャンセルした場合もメッセージを表示して None を返す。
+    失敗・キャンセルしたジョブは「再実行」が押されるまで投入し直さない (失敗したジョブは実行器に残り、他のセッションにも同じエラーを表示する)。
+    """
+    cancelled_keys = st.session_state.setdefault('cancelled_jobs', set())
+    if key in cancelled_keys:
+        st.warning(f"{label}をキャンセルしました。")
+        if st.button("再実行", key=f"retry_{key}"):
+            cancelled_keys.discard(key)
+            st.rerun()
+        return None
+
+    job = job_executor.submit(key, fn, *args, label=label, stages=stages, profile=True, waiter=session_id, **kwargs)
+    if not job.done():
+        show_job_progress(job)
+        return None
+    if job.state == jobs.DONE:
+        # ワーカーで記録した処理段階は、このセッションで初めて結果を受け取ったときに追加する
+        recorded = st.session_state.setdefault('recorded_jobs', set())
+        if job.id not in recorded:
+            recorded.add(job.id)
+            profiler.extend(job.records)
+        return job.result()
+    if job.state == jobs.FAILED:
+        st.error(f"{label}中にエラーが発生しました: {job.error}")
+        if st.button("再実行", key=f"retry_{key}"):
+            # 他のセッションがすでに実行し直している場合は、そのジョブを使う
+            job_executor.discard(key, job)
+            st.rerun()
+        return None
+    # このセッション以外の理由でキャンセルされた (次の再実行で投入し直す)
+    st.rerun()
+
+
+@st.fragment(run_every=1.0)
+def show_job_progress(job):
+    """実行中のジョブの進捗を1秒ごとに更新して表示する。完了したらページ全体を再実行する。
+
+    キャンセルボタンは、このセッションがジョブを待つのをやめるだけ (他のセッションも待っている場合は実行を続ける)。
+    更新のたびにこのセッションがまだ待っていることを知らせる (タブが閉じられると知らせが止まり、しばらくすると待つのをやめたものとして扱われる)。
+    """
+    if job.done():
+        st.rerun(scope="app")
+    job.touch(session_id)
+    fraction, stage_name = job.progress()
+    text = f"{job.label}: {stage_name} ({job.elapsed:,.0f}秒)"
+    if fraction is None:
+        st.write(text)
+    else:
+        st.progress(fraction, text=text)
+    if st.button("キャンセル", key=f"cancel_{job.id}"):
+        job.detach(session_id)
+        st.session_state.setdefault('cancelled_jobs', set()).add(job.key)
+        st.rerun(scope="app")
+
+
+@st.fragment(run_every=2.0)
+def show_running_jobs():
+    """共有の実行器で実行中・待機中のジョブ (他のセッションのものを含む) の一覧。"""
+    running = [job for job in job_executor.jobs() if not job.done()]
+    if not running:
+        return
+    st.subheader("実行中の処理")
+    for job in running:
+        _, stage_name = job.progress()
+        st.caption(f"{job.label}: {stage_name} ({job.elapsed:,.0f}秒)")
+
+
+def background_export(kind, df, **kwargs):
+    """出力ファイルを共有の実行器で作って path に書き出す関数を返す (ダウンロードボタンが押されたときに別スレッドから呼ばれる)。
+
+    ワーカーはファイルに直接書き出すので、出力の内容をプロセス間で受け渡さない。
+    """
+    executor = job_executor
+    def write(path):
+        _, records = executor.run(export.build, kind, df, path, label=f"出力: {kind}", stages=1, profile=True, **kwargs)
+        profiler.extend(records)
+    return write
+
+
+def load_uploaded(source, uploaded_files, persist=True):
+    """アップロードされたCSV群を読み込む。読み込み中・失敗・キャンセルの場合は None を返す。
+
+    ローカル保存が有効な場合は、まだ取り込んでいないファイルだけを読み込んで保存先に追加する。
+    すべて取り込み済みの場合はその旨を表示して None を返す。persist=False の場合 (入金明細) は保存先を使わない。
+    """
+    files = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+    files = [(name, data, hashlib.sha256(data).hexdigest()) for name, data in files]
+    if not persist:
+        file_keys = tuple((name, digest) for name, _, digest in files)
+        return load_uploaded_files(source, file_keys, None, [(name, data) for name, data, _ in files])
+    if invoice_store is not None:
+        files = invoice_store.new_files(source, files)
+        if not files:
+            st.info(f"アップロードされた{SOURCE_LABELS[source]}ファイルはすべて取り込み済みです。")
+            return None
+    file_keys = tuple((name, digest) for name, _, digest in files)
+    result = load_uploaded_files(source, file_keys, np_chunksize, [(name, data) for name, data, _ in files])
+    if invoice_store is not None and result is not None and result.df is not None:
+        # 読み込みに失敗したファイルは記録しない (次回も新しいファイルとして読み込み直す)
+        invoice_store.append(source, result.df, [file_keys[i] for i in result.loaded_files])
+    return result
+
+
+@st.cache_resource
+def open_store(path):
+    """ローカル保存先 (SQLite ファイル) を開く。同じパスならセッションをまたいで共有する。"""
+    return store.InvoiceStore(path)
+
+
+@st.cache_data(max_entries=4, show_spinner="保存済みのデータを読み込んでいます...")
+def load_stored(source, path, revision, _store, _profiler):
+    """保存済みのデータを読み込む。
+
+    キャッシュキーは保存先のパスと更新番号のみで、データが追加されるまでは同じ結果を返す。
+    バクラク請求書は (明細の DataFrame, 未入金選択用のインデックス) を返す。
+    """
+    with _profiler.stage(f"{source}: 保存済みデータ読み込み") as stage:
+        if source == ingest.NP:
+            df = _store.load_np()
+            stage.rows_out = len(df)
+            return df
+        df = _store.load_bakuraku()
+        stage.rows_out = len(df)
+    return df, selection.build_index(df)
+
+
+@st.cache_resource
+def get_export_cache():
+    """セッションをまたいで共有する出力ファイルのキャッシュ。"""
+    return export.ExportCache(max_entries=8)
+
+
+def show_messages(messages):
+    for level, message in messages:
+        # 列名などのデバッグ情報はサイドバーで有効にしたときだけ表示する
+        if message.startswith("デバッグ:") and not show_debug:
+            continue
+        getattr(st, level)(message)
+
+
+# 一覧表示の書式 (表示する列だけに適用する)。日付・金額は値のまま渡し、ブラウザ側で書式を付ける
+DISPLAY_COLUMN_CONFIG = {
+    'ご請求金額合計 (税込)': st.column_config.NumberColumn('ご請求金額合計 (税込)', format='localized'),
+    '未入金金額合計 (税込)': st.column_config.NumberColumn('未入金金額合計 (税込)', format='localized'),
+    '金額': st.column_config.NumberColumn('金額', format='localized'),
+    '請求書発行日': st.column_config.DateColumn('請求書発行日', format='YYYY/MM/DD'),
+    'お支払期日': st.column_config.DateColumn('お支払期日', format='YYYY/MM/DD'),
+    '日付': st.column_config.DateColumn('日付', format='YYYY/MM/DD'),
+    '支払期日': st.column_config.DateColumn('支払期日', format='YYYY/MM/DD'),
+    '入金日': st.column_config.DateColumn('入金日', format='YYYY/MM/DD'),
+    '入金金額': st.column_config.NumberColumn('入金金額', format='localized'),
+}
+PAGE_SIZES = (100, 500, 1000, 5000)
+
+
+def show_table(df, key):
+    """DataFrame を1ページ (サイドバーで選んだ行数) ずつ表示する。
+
+    ブラウザに送るのは表示中のページの行だけ。ご利用年月の表示用文字列もそのページの分だけ作る。
+    表示した行数を返す。
+    """
+    pages = max(1, -(-len(df) // page_size))
+    page = 1
+    if pages > 1:
+        page = st.number_input(
+            f"ページ (全{pages:,}ページ / {len(df):,}行)",
+            min_value=1, max_value=pages, value=1, step=1, key=f"{key}_page"
+        )
+    start = (page - 1) * page_size
+    view = df.iloc[start:start + page_size]
+    if 'ご利用年月' in view.columns and isinstance(view['ご利用年月'].dtype, pd.PeriodDtype):
+        view = schema.with_month_labels(view)
+    st.dataframe(
+        view,
+        column_config={col: config for col, config in DISPLAY_COLUMN_CONFIG.items() if col in view.columns}
+    )
+    return len(view)
+
+
+def google_credentials():
+    """Googleのサービスアカウントの情報 (st.secrets の gcp_service_account)。
+
+    ない場合は環境変数 GOOGLE_APPLICATION_CREDENTIALS のファイルのパス (それもなければ None)。
+    """
+    try:
+        if 'gcp_service_account' in st.secrets:
+            return dict(st.secrets['gcp_service_account'])
+    except FileNotFoundError: # secrets.toml がない
+        pass
+    return os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+
+
 st.title("請求・入金状況確認アプリ")
 
+np_chunked = st.sidebar.checkbox(
+    "NP掛け払いCSVを分割して読み込む (メモリ節約)",
+    value=False,
+    help=f"NP掛け払いCSVを{ingest.NP_CHUNK_ROWS:,}行ずつ、必要な列だけ読み込んで整形します。大きなファイルでメモリが不足する場合に使います。"
+)
+np_chunksize = ingest.NP_CHUNK_ROWS if np_chunked else None
+
+use_store = st.sidebar.checkbox(
+    "取り込んだデータをローカルに保存する",
+    value=bool(os.environ.get('BILLING_STORE_PATH')),
+    help="取り込んだCSVの内容を保存し、次回以降は新しいファイルだけを読み込みます。バクラク請求書の未入金の選択も保存されます。"
+)
+store_path = st.sidebar.text_input(
+    "保存先ファイル",
+    value=os.environ.get('BILLING_STORE_PATH', 'billing_store.sqlite3'),
+    disabled=not use_store
+)
+invoice_store = open_store(store_path) if use_store and store_path else None
+
+show_debug = st.sidebar.checkbox("デバッグ情報を表示する", value=False, help="列名の一覧やメモリ使用量などのデバッグ用メッセージを表示します。")
+page_size = st.sidebar.selectbox(
+    "一覧の1ページの行数",
+    PAGE_SIZES,
+    index=0,
+    help="処理結果や統合結果の一覧は、この行数ずつページに分けて表示します。Excel出力にはすべての行が含まれます。"
+)
+show_profile = st.sidebar.checkbox("処理時間を表示する", value=False, help="読み込み・整形・統合・表示・出力の各段階の所要時間、行数、メモリ使用量を表示します。")
+
+# 処理段階ごとの記録はセッションごとに保持する (ダウンロード時の出力ファイル作成も記録される)
+if 'profiler' not in st.session_state:
+    st.session_state['profiler'] = profiling.Profiler()
+profiler = st.session_state['profiler']
+if os.environ.get('BILLING_PROFILE_LOG'):
+    # 記録を1行1件のJSONとしてファイルに追記する
+    profiling.configure_json_log(os.environ['BILLING_PROFILE_LOG'])
+
+# CSVの読み込みと出力ファイルの作成は、セッションをまたいで共有するプロセスプールで実行する
+# (同時に実行する数は環境変数 BILLING_JOB_WORKERS で変更できる)
+job_executor = get_job_executor()
+# 共有のジョブを待っているセッションの区別に使う
+session_id = st.session_state.setdefault('session_id', uuid.uuid4().hex)
+with st.sidebar:
+    show_running_jobs()
+
+
 # --- NP掛け払いCSVのアップロード ---
 st.header("1. NP掛け払いCSVのアップロード")
 # 複数ファイルのアップロードを許可
@@ -26,94 +310,28 @@ uploaded_files_np = st.file_uploader(
 df_np_processed = None # 初期化
 
 if uploaded_files_np: # ファイルがアップロードされた場合のみ処理
-    all_df_np_raw = []
-    for uploaded_file in uploaded_files_np:
-        try:
-            # エンコーディングの自動判別を試みる (utf-8, shift_jis)
-            df_temp = pd.read_csv(uploaded_file, encoding='utf-8')
-            all_df_np_raw.append(df_temp)
-        except UnicodeDecodeError:
-            try:
-                df_temp = pd.read_csv(uploaded_file, encoding='shift_jis')
-                all_df_np_raw.append(df_temp)
-            except Exception as e:
-                st.error(f"ファイル '{uploaded_file.name}' の読み込み中にエラーが発生しました: {e}。エンコーディングを確認してください。")
-                continue # 次のファイルへスキップ
-        except Exception as e:
-            st.error(f"ファイル '{uploaded_file.name}' の読み込み中にエラーが発生しました: {e}")
-            continue # 次のファイルへスキップ
-    
-    if all_df_np_raw:
-        # 全てのNP掛け払いCSVを結合
-        df_np_raw_combined = pd.concat(all_df_np_raw, ignore_index=True)
+    # 読み込み・整形結果はファイル内容が変わらない限り共有の実行器から返される (読み込み中は None)
+    np_result = load_uploaded(ingest.NP, uploaded_files_np)
+    if np_result is not None and np_result.preview is not None:
+        show_messages(np_result.read_messages)
         st.subheader("NP掛け払いデータプレビュー (結合後)")
-        st.dataframe(df_np_raw_combined.head())
+        st.dataframe(np_result.preview)
 
-        # NP掛け払いデータの処理
-        df_np = df_np_raw_combined.copy() # 処理用コピー
-        
-        # --- 列名の正規化 ---
-        # 列名の前後の空白を除去し、英数字を半角に、カタカナを全角に変換
-        new_columns = []
-        for col in df_np.columns:
-            normalized_col = col.strip() # 前後の空白を除去
-            normalized_col = unicodedata.normalize('NFKC', normalized_col) # 全角と半角の統一（英数字は半角、カタカナは全角になりやすい）
-            new_columns.append(normalized_col)
-        df_np.columns = new_columns
-        st.info(f"デバッグ: NPデータフレーム列名正規化後の列: {df_np.columns.tolist()}") # デバッグ表示
-
-        # '企業名' 列の存在チェックと代替
-        if '企業名' not in df_np.columns:
-            st.warning("NP掛け払いCSVに '企業名' 列が見つかりませんでした。空文字列として処理を続行します。")
-            df_np['企業名'] = '' # 存在しない場合は空の列を追加
-
-        # '請求番号' 列の存在チェックと代替
-        # 正規化後も '請求番号' がなければ、強制的に追加
-        if '請求番号' not in df_np.columns:
-            st.warning("NP掛け払いCSVに '請求番号' 列が見つかりませんでした。空文字列として列を追加します。")
-            df_np['請求番号'] = '' # 存在しない場合は空の列を追加
-            st.info(f"デバッグ: '請求番号' 列追加後のNPデータフレームの列: {df_np.columns.tolist()}") # デバッグ表示
-        else:
-            st.info(f"デバッグ: NPデータフレームに'請求番号'列は元から存在していました。現在の列: {df_np.columns.tolist()}") # デバッグ表示
+        show_messages(np_result.messages)
+        df_np_processed = np_result.df
+    elif np_result is not None:
+        show_messages(np_result.read_messages)
+        st.info("NP掛け払いCSVファイルがアップロードされていません。")
 
+if invoice_store is not None:
+    # 今回取り込んだ分を含む、保存済みのすべてのデータを使う
+    df_np_processed = load_stored(ingest.NP, store_path, invoice_store.revision(), invoice_store, profiler)
+    if df_np_processed.empty:
+        df_np_processed = None
 
-        # 必須列の存在チェック (上で追加した'企業名', '請求番号'はここでチェックしない)
-        required_np_columns_for_processing = ['請求書発行日', '支払期限日', '請求金額', '入金ステータス'] 
-        missing_np_cols = [col for col in required_np_columns_for_processing if col not in df_np.columns]
-        
-        if missing_np_cols:
-            st.error(f"NP掛け払いCSVに以下の必須列が見つかりません: {', '.join(missing_np_cols)}")
-            df_np = None # 処理を中断
-        else:
-            df_np['請求書発行日'] = pd.to_datetime(df_np['請求書発行日'], errors='coerce')
-            df_np['支払期限日'] = pd.to_datetime(df_np['支払期限日'], errors='coerce') 
-
-            if df_np['請求書発行日'].isnull().any() or df_np['支払期限日'].isnull().any():
-                st.warning("NP掛け払いCSVの日付列に無効な値がありました。該当行はNaNとして処理されます。")
-
-            df_np['入金有無'] = df_np['入金ステータス'].apply(lambda x: 'あり' if x == '入金済み' else 'なし')
-            df_np['ご請求方法'] = 'NP掛け払い'
-            df_np['請求金額'] = pd.to_numeric(df_np['請求金額'], errors='coerce').fillna(0)
-            df_np['未入金金額合計 (税込)'] = df_np.apply(lambda row: row['請求金額'] if row['入金有無'] == 'なし' else 0, axis=1)
-            
-            cols_for_np_processed = ['請求書発行日', '支払期限日', '請求番号', '企業名', 'ご請求方法', '請求金額', '未入金金額合計 (税込)', '入金有無']
-            
-            st.info(f"デバッグ: df_np_processed作成直前のdf_npの列: {df_np.columns.tolist()}") # デバッグ表示
-            if all(col in df_np.columns for col in cols_for_np_processed):
-                df_np_processed = df_np[cols_for_np_processed].copy()
-                df_np_processed = df_np_processed.rename(columns={
-                    '請求金額': 'ご請求金額合計 (税込)', 
-                    '支払期限日': 'お支払期日',
-                    '請求番号': '請求書番号' # ★この行を追加★
-                })
-                
-                st.subheader("NP掛け払い処理結果")
-                st.dataframe(df_np_processed)
-            else:
-                st.error("NP掛け払い処理済みデータフレームの作成に必要な列が不足しています。予期せぬエラーが発生しました。不足している列は上記デバッグ情報をご確認ください。")
-                df_np_processed = None 
-    else:
-        st.info("NP掛け払いCSVファイルがアップロードされていません。")
+if df_np_processed is not None:
+    st.subheader("NP掛け払い処理結果")
+    show_table(df_np_processed, "np_processed")
 
 
 # --- バクラク請求書CSVのアップロード ---
@@ -126,213 +344,118 @@ uploaded_files_bakuraku = st.file_uploader(
     key="bakuraku_uploader"
 )
 
+df_bakuraku = None
+bakuraku_index = None
 df_bakuraku_processed = None # 初期化
 
 if uploaded_files_bakuraku: # ファイルがアップロードされた場合のみ処理
-    all_df_bakuraku_raw = []
-    for uploaded_file in uploaded_files_bakuraku:
-        try:
-            df_temp = pd.read_csv(uploaded_file, encoding='utf-8')
-            all_df_bakuraku_raw.append(df_temp)
-        except UnicodeDecodeError:
-            try:
-                df_temp = pd.read_csv(uploaded_file, encoding='shift_jis')
-                all_df_bakuraku_raw.append(df_temp)
-            except Exception as e:
-                st.error(f"ファイル '{uploaded_file.name}' の読み込み中にエラーが発生しました: {e}。エンコーディングを確認してください。")
-                continue 
-        except Exception as e:
-            st.error(f"ファイル '{uploaded_file.name}' の読み込み中にエラーが発生しました: {e}")
-            continue 
-
-    if all_df_bakuraku_raw:
-        # 全てのバクラク請求書CSVを結合
-        df_bakuraku_raw_combined = pd.concat(all_df_bakuraku_raw, ignore_index=True)
+    bakuraku_result = load_uploaded(ingest.BAKURAKU, uploaded_files_bakuraku)
+    if bakuraku_result is not None and bakuraku_result.preview is not None:
+        show_messages(bakuraku_result.read_messages)
         st.subheader("バクラク請求書データプレビュー (結合後)")
-        st.dataframe(df_bakuraku_raw_combined.head())
-
-        # バクラク請求書データの処理
-        df_bakuraku = df_bakuraku_raw_combined.copy() # 処理用コピー
-
-        # --- 列名の正規化 ---
-        new_columns_bakuraku = []
-        for col in df_bakuraku.columns:
-            normalized_col = col.strip()
-            normalized_col = unicodedata.normalize('NFKC', normalized_col)
-            new_columns_bakuraku.append(normalized_col)
-        df_bakuraku.columns = new_columns_bakuraku
-        st.info(f"デバッグ: バクラクデータフレーム列名正規化後の列: {df_bakuraku.columns.tolist()}") # デバッグ表示
-
-
-        # 必須列の存在チェック
-        required_bakuraku_columns = ['日付', '支払期日', '書類種別', '書類番号', '送付先名', '金額'] # '書類種別'も確認
-        missing_bakuraku_cols = [col for col in required_bakuraku_columns if col not in df_bakuraku.columns]
-        if missing_bakuraku_cols:
-            st.error(f"バクラク請求書CSVに以下の必須列が見つかりません: {', '.join(missing_bakuraku_cols)}")
-            df_bakuraku = None 
-        else:
-            df_bakuraku['日付'] = pd.to_datetime(df_bakuraku['日付'], errors='coerce')
-            df_bakuraku['支払期日'] = pd.to_datetime(df_bakuraku['支払期日'], errors='coerce')
-
-            if df_bakuraku['日付'].isnull().any() or df_bakuraku['支払期日'].isnull().any():
-                st.warning("バクラク請求書CSVの日付列に無効な値がありました。該当行はNaNとして処理されます。")
-
-            # 'ご請求方法'を'書類種別'から取得するように修正
-            df_bakuraku['ご請求方法'] = df_bakuraku['書類種別'].fillna('不明') # '書類種別'が存在しない場合やNaNの場合の対応
-            
-            df_bakuraku['金額'] = pd.to_numeric(df_bakuraku['金額'], errors='coerce').fillna(0)
-            df_bakuraku['ご請求金額合計 (税込)'] = df_bakuraku['金額']
-
-            st.subheader("バクラク請求書 未入金状況選択")
-            st.write("未入金の請求書にチェックを入れてください。")
-            
-            selected_unpaid_bakuraku = {}
-            if df_bakuraku is not None and not df_bakuraku.empty: 
-                with st.expander("バクラク請求書一覧を開く"):
-                    # 'original_index' を一時的に追加して、後で元の行にマッピングできるようにする
-                    df_bakuraku_temp = df_bakuraku.reset_index().rename(columns={'index': 'original_index'})
-                    df_bakuraku_display = df_bakuraku_temp[['original_index', '書類番号', '日付', '金額']].drop_duplicates(subset=['書類番号', '日付', '金額']).set_index('original_index')
-
-                    for original_idx, row in df_bakuraku_display.iterrows():
-                        date_str = row['日付'].strftime('%Y-%m-%d') if pd.notna(row['日付']) else '日付不明'
-                        amount_display = f"{row['金額']:,}円" if pd.notna(row['金額']) else '金額不明'
-                        
-                        # チェックボックスの初期状態は、この表示行に対応する元のレコードの選択状態を反映
-                        # ここでは、特定のoriginal_idxのselected_unpaid_bakurakuの状態を利用
-                        # ただし、同じ「書類番号,日付,金額」を持つ複数のoriginal_idxがある場合、最初のoriginal_idxの状態を代表として使用
-                        is_checked = selected_unpaid_bakuraku.get(original_idx, False)
-
-                        unique_key = f"bakuraku_unpaid_{row['書類番号']}_{date_str}_{row['金額']}_{original_idx}" # original_idxを含めてキーをユニークに
-                        
-                        if st.checkbox(f"書類番号: {row['書類番号']}, 日付: {date_str}, 金額: {amount_display}", key=unique_key, value=is_checked):
-                            # この表示行に対応する全ての元のデータフレームのレコードの入金状態を更新
-                            # 条件に一致する全てのインデックスを取得
-                            matching_indices = df_bakuraku[(df_bakuraku['書類番号'] == row['書類番号']) & 
-                                                           (df_bakuraku['日付'] == row['日付']) & 
-                                                           (df_bakuraku['金額'] == row['金額'])].index
-                            for idx in matching_indices:
-                                selected_unpaid_bakuraku[idx] = True
-                        else:
-                            matching_indices = df_bakuraku[(df_bakuraku['書類番号'] == row['書類番号']) & 
-                                                           (df_bakuraku['日付'] == row['日付']) & 
-                                                           (df_bakuraku['金額'] == row['金額'])].index
-                            for idx in matching_indices:
-                                selected_unpaid_bakuraku[idx] = False
-
-            if df_bakuraku is not None:
-                df_bakuraku['入金有無'] = df_bakuraku.index.map(lambda idx: 'なし' if selected_unpaid_bakuraku.get(idx, False) else 'あり')
-                df_bakuraku['未入金金額合計 (税込)'] = df_bakuraku.apply(lambda row: row['金額'] if row['入金有無'] == 'なし' else 0, axis=1)
-                
-                # 最終的な処理済みデータフレームを作成する際に、同じ請求書をグループ化
-                # 'ご請求方法' もグループ化キーに含める
-                df_bakuraku_processed = df_bakuraku.groupby(['書類番号', '日付', '支払期日', '送付先名', 'ご請求方法']).agg(
-                    金額合計=('ご請求金額合計 (税込)', 'sum'),
-                    未入金合計=('未入金金額合計 (税込)', 'sum'),
-                    入金有無=('入金有無', lambda x: 'なし' if 'なし' in x.values else 'あり') # 一つでも「なし」があれば「なし」
-                ).reset_index()
-                
-                df_bakuraku_processed = df_bakuraku_processed.rename(columns={
-                    '日付': '請求書発行日', 
-                    '支払期日': 'お支払期日', 
-                    '書類番号': '請求書番号', 
-                    '送付先名': '企業名',
-                    '金額合計': 'ご請求金額合計 (税込)', 
-                    '未入金合計': '未入金金額合計 (税込)'
-                })
-            
-            st.subheader("バクラク請求書処理結果")
-            if df_bakuraku_processed is not None:
-                st.dataframe(df_bakuraku_processed)
-            else:
-                st.write("バクラク請求書データが処理されていません。")
-    else:
+        st.dataframe(bakuraku_result.preview)
+
+        show_messages(bakuraku_result.messages)
+        df_bakuraku = bakuraku_result.df
+        bakuraku_index = bakuraku_result.selection_index
+    elif bakuraku_result is not None:
+        show_messages(bakuraku_result.read_messages)
         st.info("バクラク請求書CSVファイルがアップロードされていません。")
 
+if invoice_store is not None:
+    df_bakuraku, bakuraku_index = load_stored(ingest.BAKURAKU, store_path, invoice_store.revision(), invoice_store, profiler)
+    if df_bakuraku.empty:
+        df_bakuraku = None
 
-# --- 統合結果の表示とExcel出力 ---
-if df_np_processed is not None and df_bakuraku_processed is not None: 
-    st.header("3. 統合された請求および入金状況")
-    
-    df_np_processed['ご利用年月'] = df_np_processed['請求書発行日'].apply(lambda x: x.strftime('%Y年%m月') if pd.notna(x) else '')
-    df_bakuraku_processed['ご利用年月'] = df_bakuraku_processed['請求書発行日'].apply(lambda x: x.strftime('%Y年%m月') if pd.notna(x) else '')
+if df_bakuraku is not None:
+    st.subheader("バクラク請求書 未入金状況選択")
+    st.write("未入金の請求書にチェックを入れてください。")
 
-    common_cols = ['ご利用年月', 'ご請求方法', 'ご請求金額合計 (税込)', '未入金金額合計 (税込)', '請求書番号', '請求書発行日', 'お支払期日', '入金有無', '企業名']
-    
-    # 結合する前に、各DFが共通の列を持っているか最終確認
-    missing_cols_np = [col for col in common_cols if col not in df_np_processed.columns]
-    missing_cols_bakuraku = [col for col in common_cols if col not in df_bakuraku_processed.columns]
-
-    if missing_cols_np:
-        st.error(f"NP掛け払い処理結果データに結合に必要な列が不足しています: {', '.join(missing_cols_np)}")
-        combined_df_with_total = None
-    elif missing_cols_bakuraku:
-        st.error(f"バクラク請求書処理結果データに結合に必要な列が不足しています: {', '.join(missing_cols_bakuraku)}")
-        combined_df_with_total = None
+    # (書類番号, 日付, 金額) ごとに1行の一覧を1つの編集可能な表として表示する
+    # ローカル保存が有効な場合は前回までの選択を初期値にする
+    if invoice_store is not None:
+        saved_unpaid_groups = invoice_store.unpaid_groups(bakuraku_index)
     else:
-        combined_df = pd.concat([
-            df_np_processed[common_cols],
-            df_bakuraku_processed[common_cols]
-        ])
-        
-        combined_df['請求書発行日'] = pd.to_datetime(combined_df['請求書発行日'], errors='coerce')
-        combined_df['お支払期日'] = pd.to_datetime(combined_df['お支払期日'], errors='coerce')
+        saved_unpaid_groups = np.zeros(len(bakuraku_index.table), dtype=bool)
+    initial_unpaid_groups = saved_unpaid_groups
+
+    # 銀行の入金明細をアップロードした場合は、照合結果 (自動で消し込めなかった請求書を未入金) を初期値にする
+    uploaded_files_bank = st.file_uploader(
+        "銀行の入金明細CSVファイルをアップロードすると、入金と照合して未入金のチェックを自動で入れます (任意)。",
+        type="csv",
+        accept_multiple_files=True,
+        key="bank_uploader"
+    )
+    if uploaded_files_bank:
+        bank_result = load_uploaded(ingest.BANK, uploaded_files_bank, persist=False)
+        if bank_result is not None:
+            show_messages(bank_result.read_messages + bank_result.messages)
+        if bank_result is not None and bank_result.df is not None:
+            with profiler.stage(f"{ingest.BANK}: 照合", rows_in=len(bank_result.df)) as stage:
+                reconcile_result = reconcile.reconcile(df_bakuraku, bank_result.df)
+                initial_unpaid_groups = selection.groups_from_rows(bakuraku_index, reconcile.unpaid_rows(reconcile_result))
+                stage.rows_out = len(reconcile_result.invoices)
+            show_messages(reconcile_result.messages)
+            if not reconcile_result.review.empty:
+                with st.expander(f"要確認の入金 (請求書 {reconcile_result.review['書類番号'].nunique():,} 件)"):
+                    st.write("同じ金額の請求書・入金が期間内に複数ある、または振込依頼人名と送付先名が一致しないため、自動で消し込めなかった組み合わせです。入金済みの請求書はチェックを外してください。")
+                    show_table(reconcile_result.review, "bank_review")
+            if not reconcile_result.unmatched_deposits.empty:
+                with st.expander(f"どの請求書とも対応しない入金 ({len(reconcile_result.unmatched_deposits):,} 件)"):
+                    show_table(reconcile_result.unmatched_deposits, "bank_unmatched")
+
+    unpaid_groups = initial_unpaid_groups
+    if not df_bakuraku.empty:
+        with st.expander("バクラク請求書一覧を開く"):
+            edited_selection = st.data_editor(
+                bakuraku_index.table.assign(未入金=initial_unpaid_groups)[['未入金', '書類番号', '日付', '金額']],
+                column_config={
+                    '未入金': st.column_config.CheckboxColumn('未入金', default=False),
+                    '日付': st.column_config.DateColumn('日付', format='YYYY-MM-DD'),
+                    '金額': st.column_config.NumberColumn('金額', format='localized'),
+                },
+                disabled=['書類番号', '日付', '金額'],
+                hide_index=True,
+                key="bakuraku_unpaid_editor"
+            )
+            unpaid_groups = edited_selection['未入金'].to_numpy(dtype=bool)
+    if invoice_store is not None and not np.array_equal(unpaid_groups, saved_unpaid_groups):
+        invoice_store.save_unpaid(bakuraku_index, unpaid_groups)
+
+    with profiler.stage(f"{ingest.BAKURAKU}: 未入金の反映", rows_in=len(df_bakuraku)) as stage:
+        df_bakuraku_processed = normalize.apply_bakuraku_payment(
+            df_bakuraku, selection.rows_mask(bakuraku_index, unpaid_groups)
+        )
+        stage.rows_out = None if df_bakuraku_processed is None else len(df_bakuraku_processed)
 
-        combined_df = combined_df.sort_values(by=['ご利用年月', '請求書発行日'], na_position='last').reset_index(drop=True)
+    st.subheader("バクラク請求書処理結果")
+    if df_bakuraku_processed is not None:
+        show_table(df_bakuraku_processed, "bakuraku_processed")
+    else:
+        st.write("バクラク請求書データが処理されていません。")
 
-        total_請求金額 = combined_df['ご請求金額合計 (税込)'].sum()
-        total_未入金金額 = combined_df['未入金金額合計 (税込)'].sum()
-        
-        total_row = pd.DataFrame([{
-            'ご利用年月': '',
-            'ご請求方法': '合計',
-            'ご請求金額合計 (税込)': total_請求金額,
-            '未入金金額合計 (税込)': total_未入金金額,
-            '請求書番号': '',
-            '請求書発行日': pd.NaT, 
-            'お支払期日': pd.NaT, 
-            '入金有無': '',
-            '企業名': '' 
-        }])
-        
-        for col in ['ご請求金額合計 (税込)', '未入金金額合計 (税込)']:
-            if col in combined_df.columns and combined_df[col].dtype != total_row[col].dtype:
-                total_row[col] = total_row[col].astype(combined_df[col].dtype)
-        
-        combined_df_with_total = pd.concat([combined_df, total_row], ignore_index=True)
 
+# --- 統合結果の表示とExcel出力 ---
+if df_np_processed is not None and df_bakuraku_processed is not None: 
+    st.header("3. 統合された請求および入金状況")
+    
+    with profiler.stage("統合", rows_in=len(df_np_processed) + len(df_bakuraku_processed)) as stage:
+        combined_df, combine_messages = pipeline.combine(df_np_processed, df_bakuraku_processed)
+        combined_df_with_total = pipeline.add_total_row(combined_df) if combined_df is not None else None
+        stage.rows_out = None if combined_df_with_total is None else len(combined_df_with_total)
+    show_messages(combine_messages)
 
     if combined_df_with_total is not None:
-        company_name = "取引先" 
-
-        all_unique_companies = []
-
-        if df_np_processed is not None and not df_np_processed.empty and '企業名' in df_np_processed.columns:
-            all_unique_companies.extend(df_np_processed['企業名'].dropna().unique().tolist())
-            
-        if df_bakuraku_processed is not None and not df_bakuraku_processed.empty and '企業名' in df_bakuraku_processed.columns:
-            all_unique_companies.extend(df_bakuraku_processed['企業名'].dropna().unique().tolist())
-        
-        unique_companies_set = sorted(list(set(all_unique_companies)))
-
-        if len(unique_companies_set) == 1:
-            company_name = unique_companies_set[0]
-        elif len(unique_companies_set) > 1:
-            company_name = ", ".join(unique_companies_set[:2]) + " 他"
-        
-        if not company_name or company_name.strip() == "": 
-            company_name = "取引先"
-
+        total_未入金金額 = combined_df['未入金金額合計 (税込)'].sum()
+        company_name = pipeline.company_label(df_np_processed, df_bakuraku_processed)
 
         st.markdown(f"### {company_name}さま")
         st.markdown("### ご請求およびご入金状況一覧")
         st.markdown(f"**作成日: {datetime.date.today().strftime('%Y/%m/%d')}**")
 
-        st.dataframe(combined_df_with_total.style.format({
-            'ご請求金額合計 (税込)': '{:,.0f}',
-            '未入金金額合計 (税込)': '{:,.0f}',
-            '請求書発行日': lambda x: x.strftime('%Y/%m/%d') if pd.notna(x) else '',
-            'お支払期日': lambda x: x.strftime('%Y/%m/%d') if pd.notna(x) else ''
-        }))
+        # 合計行は最後のページに表示される。金額・日付の書式は column_config で付ける (Styler は使わない)
+        with profiler.stage("表示", rows_in=len(combined_df_with_total)) as stage:
+            stage.rows_out = show_table(combined_df_with_total, "combined")
 
         st.markdown(f"**※{datetime.date.today().strftime('%Y年%m月')}時点での未入金合計金額: {total_未入金金額:,}円**")
 
@@ -340,28 +463,130 @@ if df_np_processed is not None and df_bakuraku_processed is not None:
         # --- Excel出力ボタン ---
         current_date_str = datetime.date.today().strftime('%Y%m%d_%H%M%S')
 
-        excel_buffer = io.BytesIO()
-        
-        output_df = combined_df_with_total.copy() 
-        output_df['請求書発行日'] = output_df['請求書発行日'].dt.strftime('%Y/%m/%d').fillna('')
-        output_df['お支払期日'] = output_df['お支払期日'].dt.strftime('%Y/%m/%d').fillna('')
-        
-        output_df.to_excel(excel_buffer, index=False, sheet_name='請求入金状況', engine='openpyxl')
-        excel_buffer.seek(0) 
-
-        st.download_button(
-            label="Excelファイルとしてダウンロード",
-            data=excel_buffer,
-            file_name=f"請求入金状況_{current_date_str}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        output_mode = st.radio(
+            "出力単位を選択してください:",
+            ("すべての企業を1シートにまとめる", "企業ごとにシートを分ける", "企業ごとのExcelファイルをZIPにまとめる", "企業ごとのPDFをZIPにまとめる", "CSVファイル"),
+            horizontal=True,
+            key="output_mode"
         )
+
+        # 出力ファイルはダウンロードボタンが押されたときに、共有の実行器で作成する (再実行のたびには作らない)
+        if output_mode == "すべての企業を1シートにまとめる":
+            st.download_button(
+                label="Excelファイルとしてダウンロード",
+                data=get_export_cache().deferred(
+                    ('sheet',), combined_df_with_total,
+                    background_export('sheet', combined_df_with_total)
+                ),
+                file_name=f"請求入金状況_{current_date_str}.xlsx",
+                mime=export.EXCEL_MIME
+            )
+        elif output_mode == "企業ごとにシートを分ける":
+            st.download_button(
+                label="Excelファイルとしてダウンロード",
+                data=get_export_cache().deferred(
+                    ('sheets',), combined_df,
+                    background_export('sheets', combined_df)
+                ),
+                file_name=f"請求入金状況_{current_date_str}.xlsx",
+                mime=export.EXCEL_MIME
+            )
+        elif output_mode == "企業ごとのExcelファイルをZIPにまとめる":
+            st.download_button(
+                label="ZIPファイルとしてダウンロード",
+                data=get_export_cache().deferred(
+                    ('zip', current_date_str), combined_df,
+                    background_export('zip', combined_df, suffix=current_date_str)
+                ),
+                file_name=f"請求入金状況_{current_date_str}.zip",
+                mime=export.ZIP_MIME
+            )
+        elif output_mode == "企業ごとのPDFをZIPにまとめる":
+            if statement.available():
+                st.download_button(
+                    label="ZIPファイルとしてダウンロード",
+                    data=get_export_cache().deferred(
+                        ('pdf', current_date_str), combined_df,
+                        background_export('pdf', combined_df, suffix=current_date_str)
+                    ),
+                    file_name=f"請求入金状況_PDF_{current_date_str}.zip",
+                    mime=export.ZIP_MIME
+                )
+            else:
+                st.error("PDFの作成には WeasyPrint (と cairo / pango) が必要です。")
+        else:
+            csv_encoding_choice = st.radio("CSVの文字コード:", ("UTF-8", "Shift-JIS (CP932)"), horizontal=True, key="csv_encoding")
+            csv_encoding = {"UTF-8": 'utf-8', "Shift-JIS (CP932)": 'cp932'}[csv_encoding_choice]
+
+            # 選んだ文字コードで表せない文字がある行を先に知らせる (出力時は '?' に置き換えるか、出力しない)
+            csv_errors = 'replace'
+            unencodable = export.find_unencodable(combined_df_with_total, csv_encoding)
+            if not unencodable.empty:
+                st.warning(f"{csv_encoding_choice} で表せない文字が {len(unencodable):,} 箇所あります。出力時は '?' に置き換えられます。")
+                st.dataframe(unencodable.head(100), hide_index=True)
+                if st.checkbox("表せない文字がある場合はCSVを出力しない", key="csv_strict"):
+                    csv_errors = 'strict'
+
+            if csv_errors == 'strict':
+                st.error("表せない文字を修正するか、UTF-8 を選択してください。")
+            else:
+                st.download_button(
+                    label="CSVファイルとしてダウンロード",
+                    data=get_export_cache().deferred(
+                        ('csv', csv_encoding), combined_df_with_total,
+                        background_export('csv', combined_df_with_total, encoding=csv_encoding)
+                    ),
+                    file_name=f"請求入金状況_{current_date_str}.csv",
+                    mime=export.CSV_MIME
+                )
         
-        st.info("Excelファイルとしてダウンロード可能です。")
+        st.info("Excel・PDF・CSVファイルとしてダウンロード可能です。")
+
+        # --- Googleスプレッドシートへの反映 (前回から変わった行だけを書き込む) ---
+        with st.expander("Googleスプレッドシートに反映"):
+            sheet_url = st.text_input("スプレッドシートのURLまたはキー", value=os.environ.get('BILLING_SHEET_URL', ''), key="sheet_url")
+            sheet_title = st.text_input("ワークシート名", value=export.SHEET_NAME, key="sheet_title")
+            if st.button("変更を反映する", disabled=not sheet_url or not sheet_title, key="sheet_publish"):
+                try:
+                    with st.spinner("スプレッドシートに反映しています..."):
+                        with profiler.stage("出力: スプレッドシート", rows_in=len(combined_df_with_total)) as stage:
+                            client = sheets.GspreadClient.open(sheet_url, sheet_title, google_credentials())
+                            publish_result = sheets.publish(combined_df_with_total, client)
+                            stage.rows_out = publish_result.changed_rows
+                    st.success(f"{publish_result.changed_rows:,}行を更新しました (API呼び出し {publish_result.api_calls}回)。")
+                except Exception as e:
+                    st.error(f"スプレッドシートに反映できませんでした: {e}")
     else:
         st.error("データの結合または処理に問題が発生したため、統合された結果は表示できません。上記のエラーメッセージを確認してください。")
 
 else: 
-    if uploaded_files_np is None or not uploaded_files_np: 
+    if df_np_processed is None and not uploaded_files_np: 
         st.info("NP掛け払いCSVファイルをアップロードしてください。")
-    if uploaded_files_bakuraku is None or not uploaded_files_bakuraku: 
+    if df_bakuraku is None and not uploaded_files_bakuraku: 
         st.info("バクラク請求書CSVファイルをアップロードしてください。")
+
+
+# --- 処理時間の表示 (サイドバー) ---
+if show_profile:
+    with st.sidebar:
+        st.subheader("処理時間")
+        records = [stage.as_dict() for stage in reversed(profiler.records)] # 新しい順
+        if records:
+            st.dataframe(
+                pd.DataFrame(records),
+                column_config={
+                    'stage': st.column_config.TextColumn('段階'),
+                    'seconds': st.column_config.NumberColumn('秒', format='%.3f'),
+                    'rows_in': st.column_config.NumberColumn('入力行数', format='localized'),
+                    'rows_out': st.column_config.NumberColumn('出力行数', format='localized'),
+                    'peak_rss_mb': st.column_config.NumberColumn('最大RSS (MB)', format='%.1f'),
+                    'rss_growth_mb': st.column_config.NumberColumn('RSS増加 (MB)', format='%.1f'),
+                    'error': st.column_config.TextColumn('エラー'),
+                },
+                hide_index=True
+            )
+        else:
+            st.write("まだ記録がありません。")
+        if st.button("記録をクリア", key="clear_profile"):
+            profiler.clear()
+            st.rerun()
@@ -0,0 +1 @@
+"""合成データによる処理時間のベンチマーク (python -m bench)。"""
@@ -0,0 +1,125 @@
+"""合成データでApp.pyと同じ処理段階を実行し、段階ごとの所要時間を表示する。
+
+例:
+    python -m bench --sizes 1000 10000 100000 --encodings utf-8 sjis --json bench.json
+    python -m bench --sizes 1000000 --export-max-rows 0 --baseline bench.json
+
+計測する段階は、CSV読み込み (文字コード判定・パース・列名正規化)、整形、バクラク請求書の選択用インデックス、
+入金明細との照合、未入金の反映 (書類ごとの集計)、統合 (結合・並べ替え・合計行)、企業ごとの分割、Excel出力 (1シート)。
+Excel出力は openpyxl の書き込み速度に律速されるため、--export-max-rows を超える件数では省略する。
+最大RSSはプロセス全体の値なので、件数の小さい順に実行したときの増加分を見る。
+--json で結果を保存し、--baseline で保存済みの結果と比較 (所要時間の比) できる。
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+
+import numpy as np
+import pandas as pd
+
+from bench import generate
+from billing import export, ingest, normalize, pipeline, profiling, reconcile, selection
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+UNPAID_RATIO = 0.3 # 未入金として選択するバクラク請求書の割合
+
+
+def run_case(rows, encoding, files=1, workers=1, export_max_rows=100_000, seed=0, chunksize=None):
+    """1つの件数・文字コードについて全段階を実行し、Stage のリストを返す。"""
+    np_files = generate.np_files(rows, encoding, files, seed)
+    bakuraku_files = generate.bakuraku_files(rows, encoding, files, seed)
+    profiler = profiling.Profiler(max_records=100)
+
+    np_result = ingest.load_source(ingest.NP, np_files, workers, profiler, chunksize)
+    bakuraku_result = ingest.load_source(ingest.BAKURAKU, bakuraku_files, workers, profiler)
+    if np_result.df is None or bakuraku_result.df is None:
+        raise RuntimeError(f"読み込みに失敗しました: {np_result.read_messages + np_result.messages + bakuraku_result.messages}")
+
+    df_bakuraku = bakuraku_result.df
+    index = bakuraku_result.selection_index
+    bank_result = ingest.load_source(ingest.BANK, generate.bank_files(rows, encoding, files, seed), workers, profiler)
+    with profiler.stage(f"{ingest.BANK}: 照合", rows_in=len(bank_result.df)) as stage:
+        stage.rows_out = len(reconcile.reconcile(df_bakuraku, bank_result.df).invoices)
+    unpaid_groups = np.random.default_rng(seed).random(len(index.table)) < UNPAID_RATIO
+    with profiler.stage(f"{ingest.BAKURAKU}: 未入金の反映", rows_in=len(df_bakuraku)) as stage:
+        df_bakuraku_processed = normalize.apply_bakuraku_payment(df_bakuraku, selection.rows_mask(index, unpaid_groups))
+        stage.rows_out = len(df_bakuraku_processed)
+
+    with profiler.stage("統合", rows_in=len(np_result.df) + len(df_bakuraku_processed)) as stage:
+        combined_df, _ = pipeline.combine(np_result.df, df_bakuraku_processed)
+        combined_df_with_total = pipeline.add_total_row(combined_df)
+        stage.rows_out = len(combined_df_with_total)
+
+    with profiler.stage("企業ごとに分割", rows_in=len(combined_df)) as stage:
+        stage.rows_out = len(pipeline.split_by_customer(combined_df))
+
+    if len(combined_df_with_total) <= export_max_rows:
+        with profiler.stage("出力: 1シート", rows_in=len(combined_df_with_total)):
+            export.workbook_file([(export.SHEET_NAME, combined_df_with_total)]).close()
+    return profiler.records
+
+
+def load_baseline(path):
+    """--json で保存した結果を {(件数, 文字コード, 段階): 秒} にする。"""
+    with open(path, encoding='utf-8') as f:
+        results = json.load(f)['results']
+    return {(r['rows'], r['encoding'], r['stage']): r['seconds'] for r in results}
+
+
+def format_report(results, baseline=None):
+    lines = []
+    for (rows, encoding), group in itertools.groupby(results, key=lambda r: (r['rows'], r['encoding'])):
+        group = list(group)
+        ratios = None
+        if baseline is not None:
+            ratios = []
+            for r in group:
+                base = baseline.get((rows, encoding, r['stage']))
+                ratios.append(f"{r['seconds'] / base:.2f}x" if base else '-')
+        lines.append(f"\n== {rows:,}行 / {encoding} ==")
+        lines.append(profiling.format_records(group, ratios))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description="合成データで各処理段階の所要時間を計測します。")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="件数 (NP掛け払い・バクラク請求書それぞれの行数)")
+    parser.add_argument('--encodings', nargs='+', choices=list(generate.ENCODINGS), default=list(generate.ENCODINGS), help="CSVの文字コード")
+    parser.add_argument('--files', type=int, default=1, help="それぞれのデータを分割するCSVファイル数")
+    parser.add_argument('--workers', type=int, default=1, help="CSV読み込みの並列数")
+    parser.add_argument('--chunksize', type=int, help="NP掛け払いCSVを分割して読み込む行数 (省略時は一括読み込み)")
+    parser.add_argument('--export-max-rows', type=int, default=100_000, help="Excel出力を計測する最大行数 (0で計測しない)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="結果を保存するJSONファイル")
+    parser.add_argument('--baseline', help="比較対象の結果 (--json で保存したもの)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for rows in sorted(args.sizes):
+        for encoding in args.encodings:
+            print(f"{rows:,}行 / {encoding} を計測しています...", file=sys.stderr)
+            for stage in run_case(rows, encoding, args.files, args.workers, args.export_max_rows, args.seed, args.chunksize):
+                results.append({'rows': rows, 'encoding': encoding, **stage.as_dict()})
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    print(format_report(results, baseline))
+
+    if args.json:
+        meta = {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'files': args.files,
+            'workers': args.workers,
+            'chunksize': args.chunksize,
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""ベンチマーク用のNP掛け払い・バクラク請求書CSVの生成。
+
+列構成は実際のエクスポートに合わせ、値は乱数 (シード固定) で作る。
+バクラク請求書は1つの書類番号が1〜5行の明細になる。
+銀行の入金明細は、バクラク請求書の一部 (PAID_RATIO) に対する入金と、どの請求書とも関係のない入金からなる。
+"""
+import numpy as np
+import pandas as pd
+
+ENCODINGS = {'utf-8': 'utf-8', 'sjis': 'cp932'} # 名前 -> Pythonのエンコーディング名
+NP_STATUSES = np.array(['入金済み', '未入金', '一部入金'], dtype=object)
+NP_STATUS_WEIGHTS = [0.7, 0.25, 0.05]
+DOCUMENT_TYPES = np.array(['請求書', '納品書兼請求書'], dtype=object)
+ITEMS = np.array(['システム利用料', '初期設定費用', 'オプション料金', '保守サポート', '追加ライセンス'], dtype=object)
+START_DATE = np.datetime64('2022-01-01')
+DAYS = 3 * 365
+PAID_RATIO = 0.7 # 入金明細に入金があるバクラク請求書の割合
+OTHER_DEPOSIT_RATIO = 0.05 # 請求書と関係のない入金の割合 (請求書の件数に対する)
+
+
+def company_names(count):
+    """'株式会社サンプル0001' のような企業名 (一部は全角英数字・㈱表記を含む)。"""
+    names = np.array([f"株式会社サンプル{i:04d}" for i in range(count)], dtype=object)
+    names[1::7] = [f"㈱ＴＥＳＴ{i:04d}" for i in range(1, count, 7)]
+    return names
+
+
+def _dates(rng, rows):
+    return START_DATE + rng.integers(0, DAYS, rows).astype('timedelta64[D]')
+
+
+def _company_count(rows):
+    return max(10, rows // 200)
+
+
+def np_frame(rows, seed=0):
+    """NP掛け払いの請求データ (1行 = 1請求書)。"""
+    rng = np.random.default_rng(seed)
+    issued = _dates(rng, rows)
+    companies = company_names(_company_count(rows))
+    return pd.DataFrame({
+        '請求書発行日': pd.to_datetime(issued).strftime('%Y/%m/%d'),
+        '支払期限日': pd.to_datetime(issued + rng.integers(20, 60, rows).astype('timedelta64[D]')).strftime('%Y/%m/%d'),
+        '請求番号': [f"NP{i:08d}" for i in range(rows)],
+        '顧客ID': rng.integers(100000, 999999, rows),
+        '企業名': companies[rng.integers(0, len(companies), rows)],
+        '請求金額': rng.integers(1, 500, rows) * 1000 + rng.integers(0, 1000, rows),
+        '入金ステータス': NP_STATUSES[rng.choice(len(NP_STATUSES), rows, p=NP_STATUS_WEIGHTS)],
+        '備考': np.where(rng.random(rows) < 0.1, '分割請求', ''),
+    })
+
+
+def bakuraku_frame(rows, seed=0):
+    """バクラク請求書の明細データ (1行 = 1明細、書類番号ごとに1〜5行)。"""
+    rng = np.random.default_rng(seed + 1)
+    lines_per_document = rng.integers(1, 6, rows) # 多めに作って rows 行で切る
+    document = np.repeat(np.arange(rows), lines_per_document)[:rows]
+    documents = document[-1] + 1
+
+    issued = _dates(rng, documents)
+    due = issued + rng.integers(20, 60, documents).astype('timedelta64[D]')
+    companies = company_names(_company_count(rows))
+    document_company = companies[rng.integers(0, len(companies), documents)]
+    return pd.DataFrame({
+        '日付': pd.to_datetime(issued[document]).strftime('%Y-%m-%d'),
+        '支払期日': pd.to_datetime(due[document]).strftime('%Y-%m-%d'),
+        '書類種別': DOCUMENT_TYPES[rng.integers(0, len(DOCUMENT_TYPES), documents)][document],
+        '書類番号': [f"BK{i:08d}" for i in document],
+        '送付先名': document_company[document],
+        '品目': ITEMS[rng.integers(0, len(ITEMS), rows)],
+        '金額': rng.integers(1, 200, rows) * 500,
+    })
+
+
+def payer_names(names):
+    """送付先名を銀行の振込依頼人名の形 ('株式会社サンプル0001' -> 'カ)サンプル0001'、'㈱ＴＥＳＴ0001' -> 'ＴＥＳＴ0001(カ') にする。"""
+    names = pd.Series(names, dtype=object)
+    return names.str.replace(r'^株式会社', 'カ)', regex=True).str.replace(r'^㈱(.*)$', r'\1(カ', regex=True).to_numpy()
+
+
+def bank_frame(rows, seed=0):
+    """bakuraku_frame(rows, seed) の請求書に対する銀行の入金明細 (1行 = 1入金)。"""
+    rng = np.random.default_rng(seed + 2)
+    lines = bakuraku_frame(rows, seed)
+    invoices = lines.groupby(['書類番号', '支払期日', '送付先名'], sort=False)['金額'].sum().reset_index()
+    invoices = invoices[rng.random(len(invoices)) < PAID_RATIO]
+    due = pd.to_datetime(invoices['支払期日']).to_numpy().astype('datetime64[D]')
+    others = int(len(invoices) * OTHER_DEPOSIT_RATIO)
+    deposits = pd.DataFrame({
+        '取引日': np.concatenate([due - rng.integers(0, 20, len(invoices)).astype('timedelta64[D]'), _dates(rng, others)]),
+        '入金金額': np.concatenate([invoices['金額'].to_numpy(), rng.integers(1, 1000, others) * 500]),
+        '振込依頼人名': np.concatenate([payer_names(invoices['送付先名']), np.full(others, 'カ)ソノタ')]),
+    }).sort_values('取引日', kind='stable', ignore_index=True)
+    deposits['取引日'] = deposits['取引日'].dt.strftime('%Y/%m/%d')
+    return deposits
+
+
+def to_csv_files(df, name, encoding='utf-8', files=1):
+    """DataFrame を files 個のCSVファイル [(ファイル名, バイト列), ...] に分割する。"""
+    codec = ENCODINGS[encoding]
+    bounds = np.linspace(0, len(df), files + 1).astype(int)
+    return [
+        (f"{name}_{i + 1:02d}.csv", df.iloc[start:end].to_csv(index=False).encode(codec))
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+    ]
+
+
+def np_files(rows, encoding='utf-8', files=1, seed=0):
+    return to_csv_files(np_frame(rows, seed), 'np', encoding, files)
+
+
+def bakuraku_files(rows, encoding='utf-8', files=1, seed=0):
+    return to_csv_files(bakuraku_frame(rows, seed), 'bakuraku', encoding, files)
+
+
+def bank_files(rows, encoding='utf-8', files=1, seed=0):
+    return to_csv_files(bank_frame(rows, seed), 'bank', encoding, files)
@@ -0,0 +1 @@
+"""請求・入金状況確認アプリの処理部分 (Streamlitに依存しない)。"""
@@ -0,0 +1,187 @@
+"""コマンドラインからの一括処理 (Streamlitは使わない)。
+
+例:
+    python -m billing --np-dir np/ --bakuraku-dir bakuraku/ --unpaid unpaid.txt --out-dir out/
+
+--unpaid には未入金のバクラク請求書の書類番号を1行に1つ書いたファイルを指定する
+(先頭行が '書類番号' の場合は見出しとして読み飛ばす)。
+--bank に銀行の入金明細CSVのディレクトリを指定すると、入金と照合して自動で消し込めなかった請求書を未入金とする
+(--unpaid の書類番号も未入金になる)。出力先には企業名ごとに1つのExcelファイルを作成する。
+--split sheets で企業ごとのシートを持つ1つのExcelファイル、--split zip で企業ごとのExcelファイルをまとめたZIP、
+--split pdf で企業ごとのPDFをまとめたZIPを作成する (PDFの作成は --workers のプロセス数で並列に行う)。
+--chunksize でNP掛け払いCSVを分割して読み込む (大きなファイルでメモリを節約する)。
+--sheet にスプレッドシートのURLまたはキーを指定すると、統合結果を前回から変わった行だけ反映する
+(認証は --credentials のサービスアカウントのJSONファイル。省略時は gspread の既定の場所)。
+--profile で各段階の所要時間・行数・最大RSSを標準エラー出力に表示し、--profile-log には同じ内容を1行1件のJSONで追記する。
+"""
+import argparse
+import datetime
+import sys
+from pathlib import Path
+
+from billing import export, ingest, normalize, pipeline, profiling, reconcile, sheets, statement
+
+
+def read_csv_dir(directory, as_paths=False):
+    """ディレクトリ直下のCSVファイルを名前順に (ファイル名, バイト列) のリストで返す。
+
+    as_paths=True の場合はバイト列の代わりにパスを返す (分割読み込みでファイル全体を読み込まないため)。
+    """
+    paths = sorted(Path(directory).glob('*.csv'))
+    return [(path.name, path if as_paths else path.read_bytes()) for path in paths]
+
+
+def read_unpaid_numbers(path):
+    """未入金の書類番号の集合を読み込む。"""
+    numbers = set()
+    for i, line in enumerate(Path(path).read_text(encoding='utf-8-sig').splitlines()):
+        number = line.strip()
+        if not number or (i == 0 and number == '書類番号'):
+            continue
+        numbers.add(number)
+    return numbers
+
+
+def _report(messages, verbose):
+    for level, message in messages:
+        if level != 'info' or verbose:
+            print(f"[{level}] {message}", file=sys.stderr)
+
+
+def load(np_files, bakuraku_files, unpaid_numbers, verbose=False, workers=None, profiler=None, chunksize=None, bank_files=None):
+    """CSV群を読み込み、結合済みの DataFrame (合計行なし) を返す。処理できなかった場合は None。
+
+    chunksize を指定すると、NP掛け払いCSVはその行数ずつ分割して読み込む。
+    bank_files (銀行の入金明細CSV) を指定すると、入金と照合して自動で消し込めなかった請求書も未入金とする。
+    """
+    profiler = profiler or profiling.DISABLED
+    np_result = ingest.load_source(ingest.NP, np_files, workers, profiler, chunksize)
+    _report(np_result.read_messages + np_result.messages, verbose)
+    bakuraku_result = ingest.load_source(ingest.BAKURAKU, bakuraku_files, workers, profiler)
+    _report(bakuraku_result.read_messages + bakuraku_result.messages, verbose)
+    if np_result.df is None or bakuraku_result.df is None:
+        return None
+
+    df_bakuraku = bakuraku_result.df
+    unpaid_rows = df_bakuraku['書類番号'].astype(str).isin(unpaid_numbers).to_numpy()
+    if bank_files:
+        bank_result = ingest.load_source(ingest.BANK, bank_files, workers, profiler)
+        _report(bank_result.read_messages + bank_result.messages, verbose)
+        if bank_result.df is None:
+            return None
+        with profiler.stage(f"{ingest.BANK}: 照合", rows_in=len(bank_result.df)) as stage:
+            reconcile_result = reconcile.reconcile(df_bakuraku, bank_result.df)
+            unpaid_rows = unpaid_rows | reconcile.unpaid_rows(reconcile_result)
+            stage.rows_out = len(reconcile_result.invoices)
+        _report(reconcile_result.messages, verbose)
+        review_numbers = reconcile_result.review['書類番号'].unique()
+        if len(review_numbers):
+            _report([('warning', f"入金との対応を確認できなかった請求書 {len(review_numbers):,} 件を未入金として出力します: {', '.join(map(str, review_numbers[:20]))}{' ...' if len(review_numbers) > 20 else ''}")], verbose)
+
+    with profiler.stage(f"{ingest.BAKURAKU}: 未入金の反映", rows_in=len(df_bakuraku)) as stage:
+        df_bakuraku_processed = normalize.apply_bakuraku_payment(df_bakuraku, unpaid_rows)
+        stage.rows_out = len(df_bakuraku_processed)
+
+    with profiler.stage("統合", rows_in=len(np_result.df) + len(df_bakuraku_processed)) as stage:
+        combined_df, messages = pipeline.combine(np_result.df, df_bakuraku_processed)
+        stage.rows_out = None if combined_df is None else len(combined_df)
+    _report(messages, verbose)
+    return combined_df
+
+
+def write_per_customer(combined_df, out_dir, split='files', profiler=None, workers=None):
+    """企業名ごとに合計行付きの一覧を書き出し、書き出したパスのリストを返す。
+
+    split='files' は企業ごとのExcelファイル、'sheets' は企業ごとのシートを持つ1つのExcelファイル、
+    'zip' は企業ごとのExcelファイルをまとめたZIPファイル、'pdf' は企業ごとのPDFをまとめたZIPファイル。
+    """
+    profiler = profiler or profiling.DISABLED
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    date_str = datetime.date.today().strftime('%Y%m%d')
+    with profiler.stage("企業ごとに分割", rows_in=len(combined_df)) as stage:
+        customers = pipeline.split_by_customer(combined_df)
+        stage.rows_out = len(customers)
+
+    with profiler.stage(f"出力: {split}", rows_in=len(combined_df)):
+        return _write_customers(customers, out_dir, date_str, split, workers)
+
+
+def _write_customers(customers, out_dir, date_str, split, workers=None):
+    if split == 'sheets':
+        path = out_dir / f"請求入金状況_{date_str}.xlsx"
+        export.write_workbook(customers, path)
+        return [path]
+
+    if split == 'pdf':
+        path = out_dir / f"請求入金状況_PDF_{date_str}.zip"
+        export.write_zip(statement.customer_statements(customers, date_str, workers=workers), path)
+        return [path]
+
+    if split == 'zip':
+        path = out_dir / f"請求入金状況_{date_str}.zip"
+        export.write_zip(export.customer_workbooks(customers, date_str), path)
+        return [path]
+
+    paths = []
+    for filename, (_, df) in zip(export.customer_filenames([name for name, _ in customers], date_str, 'xlsx'), customers):
+        path = out_dir / filename
+        export.write_workbook([(export.SHEET_NAME, df)], path)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m billing', description="請求・入金状況一覧を企業ごとのExcelファイルとして出力します。")
+    parser.add_argument('--np-dir', required=True, help="NP掛け払いCSVのディレクトリ")
+    parser.add_argument('--bakuraku-dir', required=True, help="バクラク請求書CSVのディレクトリ")
+    parser.add_argument('--unpaid', help="未入金のバクラク請求書の書類番号を1行に1つ書いたファイル")
+    parser.add_argument('--bank', help="銀行の入金明細CSVのディレクトリ (入金と照合して未入金を判定する)")
+    parser.add_argument('--out-dir', required=True, help="Excelファイルの出力先ディレクトリ")
+    parser.add_argument('--split', choices=['files', 'sheets', 'zip', 'pdf'], default='files', help="企業ごとの出力方法 (既定値: files)")
+    parser.add_argument('--workers', type=int, help="CSV読み込み・PDF作成の並列数 (1で逐次処理。既定値は環境変数 BILLING_JOB_WORKERS またはCPU数)")
+    parser.add_argument('--chunksize', type=int, nargs='?', const=ingest.NP_CHUNK_ROWS,
+                        help=f"NP掛け払いCSVを指定した行数ずつ、必要な列だけ読み込む (メモリ節約。行数省略時は{ingest.NP_CHUNK_ROWS:,}行)")
+    parser.add_argument('--sheet', help="統合結果を反映するGoogleスプレッドシートのURLまたはキー")
+    parser.add_argument('--sheet-name', default=export.SHEET_NAME, help=f"反映先のワークシート名 (既定値: {export.SHEET_NAME})")
+    parser.add_argument('--credentials', help="Googleのサービスアカウントの JSON ファイル")
+    parser.add_argument('-v', '--verbose', action='store_true', help="情報メッセージも表示する")
+    parser.add_argument('--profile', action='store_true', help="各段階の所要時間・行数・最大RSSを表示する")
+    parser.add_argument('--profile-log', help="各段階の記録を1行1件のJSONで追記するファイル")
+    args = parser.parse_args(argv)
+
+    np_files = read_csv_dir(args.np_dir, as_paths=bool(args.chunksize))
+    bakuraku_files = read_csv_dir(args.bakuraku_dir)
+    if not np_files or not bakuraku_files:
+        parser.error("NP掛け払いCSVとバクラク請求書CSVをそれぞれ1つ以上指定してください。")
+    unpaid_numbers = read_unpaid_numbers(args.unpaid) if args.unpaid else set()
+    bank_files = read_csv_dir(args.bank) if args.bank else None
+    if args.bank and not bank_files:
+        parser.error("--bank のディレクトリに入金明細CSVがありません。")
+    if args.split == 'pdf' and not statement.available():
+        parser.error("--split pdf には WeasyPrint (と cairo / pango) が必要です。")
+
+    if args.profile_log:
+        profiling.configure_json_log(args.profile_log)
+    profiler = profiling.Profiler() if args.profile or args.profile_log else None
+
+    combined_df = load(np_files, bakuraku_files, unpaid_numbers, args.verbose, args.workers, profiler, args.chunksize, bank_files)
+    if combined_df is None:
+        print("データの結合または処理に問題が発生したため、出力できませんでした。", file=sys.stderr)
+        return 1
+
+    for path in write_per_customer(combined_df, args.out_dir, args.split, profiler, args.workers):
+        print(path)
+    if args.sheet:
+        try:
+            with (profiler or profiling.DISABLED).stage("出力: スプレッドシート", rows_in=len(combined_df) + 1) as stage:
+                client = sheets.GspreadClient.open(args.sheet, args.sheet_name, args.credentials)
+                result = sheets.publish(pipeline.add_total_row(combined_df), client)
+                stage.rows_out = result.changed_rows
+        except Exception as e:
+            print(f"スプレッドシートに反映できませんでした: {e}", file=sys.stderr)
+            return 1
+        print(f"スプレッドシートの {result.changed_rows:,}行を更新しました (API呼び出し {result.api_calls}回)。", file=sys.stderr)
+    if args.profile:
+        print(profiler.report(), file=sys.stderr)
+    return 0
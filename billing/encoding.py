@@ -0,0 +1,86 @@
+"""CSVの文字コード判定。
+
+先頭の一定バイト数だけを見て BOM / UTF-8 / CP932 (Shift-JIS) を判定し、
+パースは判定した文字コードで1回だけ行えるようにする。
+"""
+import codecs
+
+import chardet
+
+SNIFF_BYTES = 64 * 1024 # 判定に使う先頭バイト数
+_VALIDATE_CHUNK = 1024 * 1024 # UTF-8 の全体検証で一度にデコードするバイト数
+
+# chardet の判定結果のうち、CP932 として読むもの (CP932 は Shift-JIS の上位互換)
+_SHIFT_JIS_FAMILY = {'shift_jis', 'cp932', 'windows-31j', 'ms932'}
+
+
+def _decodes(prefix, encoding):
+    """prefix が encoding として解釈できるか。末尾で切れた多バイト文字はエラーにしない。"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(prefix, final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _chunks_are_utf8(chunks):
+    """バイト列のチャンクを順に連結したものが UTF-8 として正しいか (チャンクの境界で切れた文字も扱える)。"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in chunks:
+            decoder.decode(chunk, final=False)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _is_utf8(data):
+    """data 全体が UTF-8 として正しいか。文字列全体は作らず、チャンクごとに検証する。"""
+    if data.isascii():
+        return True
+    view = memoryview(data)
+    return _chunks_are_utf8(view[offset:offset + _VALIDATE_CHUNK] for offset in range(0, len(view), _VALIDATE_CHUNK))
+
+
+def detect_encoding(data, sniff_bytes=SNIFF_BYTES):
+    """バイト列の文字コードを判定し、Pythonのコーデック名を返す。
+
+    先頭 sniff_bytes で UTF-8 と判定した場合は、それ以降も UTF-8 として正しいかを検証する
+    (後半にだけ Shift-JIS の文字がある場合に、パースの途中で失敗して読み直すことを防ぐ)。
+    """
+    return _detect(data[:sniff_bytes], lambda: _is_utf8(data))
+
+
+def detect_stream_encoding(f, sniff_bytes=SNIFF_BYTES):
+    """バイナリファイル f の文字コードを判定する (detect_encoding のファイル版)。
+
+    UTF-8 の検証はファイルを _VALIDATE_CHUNK ずつ読み進めて行うので、ファイル全体をメモリに載せない。
+    判定後は読み込み位置を元に戻す。
+    """
+    start = f.tell()
+    prefix = f.read(sniff_bytes)
+
+    def rest_is_utf8():
+        f.seek(start)
+        return _chunks_are_utf8(iter(lambda: f.read(_VALIDATE_CHUNK), b''))
+
+    try:
+        return _detect(prefix, rest_is_utf8)
+    finally:
+        f.seek(start)
+
+
+def _detect(prefix, is_utf8):
+    """先頭部分 prefix と、全体が UTF-8 として正しいかを返す関数 is_utf8 から文字コードを判定する。"""
+    if prefix.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if _decodes(prefix, 'utf-8') and is_utf8():
+        return 'utf-8'
+    if _decodes(prefix, 'cp932'):
+        return 'cp932'
+
+    guess = (chardet.detect(prefix).get('encoding') or '').lower()
+    if not guess or guess in _SHIFT_JIS_FAMILY:
+        return 'cp932'
+    return guess
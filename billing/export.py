@@ -0,0 +1,349 @@
+"""統合結果のファイル出力。
+
+Excelは openpyxl の書き込み専用モードで一定行数ずつ書き出し、DataFrame全体のコピーやセルのオブジェクトを保持しない。
+日付・金額は値のまま書き込み、表示形式をセルの書式として設定する。
+CSVは指定した文字コードで出力先に直接書き込む (文字列全体を作ってからエンコードし直すことはしない)。
+出力先は一定サイズまではメモリ上、超えると一時ファイルに退避する (SpooledTemporaryFile)。
+アプリでは出力ファイルを ExportCache の一時ディレクトリに直接書き出し、内容をメモリに保持しない。
+"""
+import codecs
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+
+from billing import pipeline, profiling, schema
+
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ZIP_MIME = "application/zip"
+CSV_MIME = "text/csv"
+SHEET_NAME = '請求入金状況'
+DATE_COLS = schema.DATE_COLS
+
+DATE_FORMAT = 'yyyy/mm/dd'
+AMOUNT_FORMAT = '#,##0'
+AMOUNT_COLS = schema.AMOUNT_COLS
+NUMBER_FORMATS = {col: DATE_FORMAT for col in DATE_COLS} | {col: AMOUNT_FORMAT for col in AMOUNT_COLS}
+CHUNK_ROWS = 10_000 # 1回に書き出す行数
+SPOOL_THRESHOLD = 32 * 1024 * 1024 # これを超えた出力は一時ファイルに退避する
+
+_SHEET_TITLE_MAX = 31 # Excelのシート名の最大文字数
+_INVALID_SHEET_CHARS = re.compile(r'[\[\]:*?/\\]')
+_UNSAFE_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|\r\n\t]')
+
+
+def sheet_titles(names):
+    """Excelで使えるシート名に変換する (使えない文字の置換、31文字への切り詰め、重複時の連番付与)。"""
+    titles = []
+    used = set()
+    for name in names:
+        base = _INVALID_SHEET_CHARS.sub('_', name).strip("'") or SHEET_NAME
+        title = base[:_SHEET_TITLE_MAX]
+        n = 2
+        while title.lower() in used:
+            suffix = f" ({n})"
+            title = base[:_SHEET_TITLE_MAX - len(suffix)] + suffix
+            n += 1
+        used.add(title.lower())
+        titles.append(title)
+    return titles
+
+
+def safe_filename(name):
+    """ファイル名に使えない文字を '_' に置き換える。"""
+    return _UNSAFE_FILENAME_CHARS.sub('_', name).strip() or SHEET_NAME
+
+
+def customer_filenames(names, suffix, extension):
+    """企業ごとのファイル名 (請求入金状況_企業名_suffix.extension) のリスト。
+
+    使えない文字は '_' に置き換え、置き換えた結果が重複する場合は sheet_titles と同じく連番を付ける
+    (大文字・小文字の違いだけのファイル名も重複とみなす)。
+    """
+    filenames = []
+    used = set()
+    for name in names:
+        base = safe_filename(name)
+        filename = f"請求入金状況_{base}_{suffix}.{extension}"
+        n = 2
+        while filename.lower() in used:
+            filename = f"請求入金状況_{base} ({n})_{suffix}.{extension}"
+            n += 1
+        used.add(filename.lower())
+        filenames.append(filename)
+    return filenames
+
+
+def _column_values(series):
+    """列の値を Python のオブジェクトのリストにする (欠損値は空のセルになるよう None)。"""
+    if isinstance(series.dtype, pd.PeriodDtype):
+        series = schema.month_labels(series).replace('', None)
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def _write_sheet(ws, df, number_formats):
+    ws.append(list(df.columns))
+    formats = [number_formats.get(col) for col in df.columns]
+    for start in range(0, len(df), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        columns = [_column_values(chunk[col]) for col in chunk.columns]
+        for values in zip(*columns):
+            row = []
+            for value, number_format in zip(values, formats):
+                if number_format is not None and value is not None:
+                    cell = WriteOnlyCell(ws, value)
+                    cell.number_format = number_format
+                    value = cell
+                row.append(value)
+            ws.append(row)
+
+
+def write_workbook(sheets, target, number_formats=NUMBER_FORMATS):
+    """[(シート名, DataFrame), ...] を1つのExcelファイルとして target (パスまたはバイナリファイル) に書き出す。
+
+    number_formats は {列名: Excelの表示形式} で、該当する列のセルに書式として設定する。
+    """
+    wb = Workbook(write_only=True)
+    for title, (_, df) in zip(sheet_titles([name for name, _ in sheets]), sheets):
+        _write_sheet(wb.create_sheet(title), df, number_formats)
+    wb.save(target)
+
+
+def workbook_file(sheets, number_formats=NUMBER_FORMATS, spool_threshold=SPOOL_THRESHOLD):
+    """Excelファイルを書き出したファイルオブジェクト (先頭にシーク済み) を返す。"""
+    output = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    write_workbook(sheets, output, number_formats)
+    output.seek(0)
+    return output
+
+
+def to_excel_bytes(df, sheet_name=SHEET_NAME):
+    """1シートのExcelファイル (xlsx) のバイト列を返す。"""
+    return to_workbook_bytes([(sheet_name, df)])
+
+
+def to_workbook_bytes(sheets):
+    """[(シート名, DataFrame), ...] を1つのExcelファイルにまとめ、バイト列を返す。"""
+    excel_buffer = io.BytesIO()
+    write_workbook(sheets, excel_buffer)
+    return excel_buffer.getvalue()
+
+
+def write_zip(files, target):
+    """[(ファイル名, バイト列), ...] をZIPにまとめて target (パスまたはバイナリファイル) に書き出す。"""
+    with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for filename, data in files:
+            zf.writestr(filename, data)
+
+
+def zip_file(files, spool_threshold=SPOOL_THRESHOLD):
+    """ZIPファイルを書き出したファイルオブジェクト (先頭にシーク済み) を返す。"""
+    output = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    write_zip(files, output)
+    output.seek(0)
+    return output
+
+
+class UnencodableError(ValueError):
+    """指定した文字コードで表せない文字があった (strict モードのCSV出力)。problems に該当箇所の一覧を持つ。"""
+
+    def __init__(self, encoding, problems):
+        self.encoding = encoding
+        self.problems = problems
+        super().__init__(f"{encoding} で表せない文字が {len(problems):,} 箇所あります。")
+
+
+def _encodable(value, encoding):
+    try:
+        value.encode(encoding)
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _column_encodable(series, encoding):
+    """列の値 (欠損値を除く) をまとめて1回でエンコードできるか。文字列以外の値がある場合も False。"""
+    try:
+        '\n'.join(series.to_numpy(dtype=object, na_value='')).encode(encoding)
+    except (TypeError, UnicodeEncodeError):
+        return False
+    return True
+
+
+def find_unencodable(df, encoding):
+    """encoding で表せない文字を含むセルを、列 '行' (データの何行目か、見出しは0)・'列'・'値' の DataFrame で返す。
+
+    UTF-8 はすべての文字を表せるので検査しない。文字列の列は列全体をまとめてエンコードしてみて、
+    失敗した列だけを値ごとに検査する (同じ値の検査は1回だけ)。
+    """
+    problems = []
+    if codecs.lookup(encoding).name not in ('utf-8', 'utf-8-sig'):
+        problems = [(0, col, col) for col in df.columns if not _encodable(str(col), encoding)]
+        for col in df.columns:
+            series = df[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                values = series.cat.categories
+            elif pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+                if _column_encodable(series, encoding):
+                    continue
+                values = series.dropna().unique()
+            else:
+                continue
+            bad = [value for value in values if isinstance(value, str) and not _encodable(value, encoding)]
+            if bad:
+                for row in np.flatnonzero(series.isin(bad).to_numpy()):
+                    problems.append((int(row) + 1, col, series.iat[row]))
+    return pd.DataFrame(problems, columns=['行', '列', '値']).sort_values('行', kind='stable', ignore_index=True)
+
+
+def write_csv(df, target, encoding='utf-8', errors='replace', date_format=None, chunk_rows=CHUNK_ROWS):
+    """df をCSVとして target (バイナリファイル) に encoding で書き出す。
+
+    chunk_rows 行ずつ文字列にして、そのまま encoding でエンコードしながら書き込む。
+    errors='replace' は表せない文字を '?' に置き換え、errors='strict' は書き込む前に検査して
+    表せない文字があれば UnencodableError を送出する (target には何も書き込まない)。
+    """
+    if errors == 'strict':
+        problems = find_unencodable(df, encoding)
+        if not problems.empty:
+            raise UnencodableError(encoding, problems)
+    text = io.TextIOWrapper(target, encoding=encoding, errors=errors, newline='')
+    try:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            df.iloc[start:start + chunk_rows].to_csv(text, index=False, header=start == 0, date_format=date_format)
+        text.flush()
+    finally:
+        text.detach() # target は閉じない
+
+
+def csv_file(df, encoding='utf-8', errors='replace', date_format=None, spool_threshold=SPOOL_THRESHOLD):
+    """CSVを書き出したファイルオブジェクト (先頭にシーク済み) を返す。"""
+    output = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    write_csv(df, output, encoding, errors, date_format)
+    output.seek(0)
+    return output
+
+
+def build(kind, df, path, suffix='', encoding='utf-8', profiler=None):
+    """統合結果 df から出力ファイルを作り、path に書き出す (プロセスプールで実行できるようにまとめた関数)。
+
+    kind は 'sheet' (1シート。df は合計行付き)、'sheets' (企業ごとのシート)、'zip' (企業ごとのExcelファイルのZIP)、
+    'pdf' (企業ごとのPDFのZIP)、'csv' (df は合計行付き。encoding で表せない文字は '?' にする)。
+    """
+    if kind not in ('sheet', 'sheets', 'zip', 'pdf', 'csv'):
+        raise ValueError(f"不明な出力の種類です: {kind}")
+    profiler = profiler or profiling.DISABLED
+    if kind in ('sheets', 'zip', 'pdf'):
+        with profiler.stage("企業ごとに分割", rows_in=len(df)) as stage:
+            customers = pipeline.split_by_customer(df)
+            stage.rows_out = len(customers)
+    with profiler.stage(f"出力: {kind}", rows_in=len(df)):
+        if kind == 'sheet':
+            write_workbook([(SHEET_NAME, df)], path)
+        elif kind == 'sheets':
+            write_workbook(customers, path)
+        elif kind == 'zip':
+            write_zip(customer_workbooks(customers, suffix), path)
+        elif kind == 'pdf':
+            from billing import statement # statement は export を使うので、使うときに読み込む
+            write_zip(statement.customer_statements(customers, suffix), path)
+        else:
+            with open(path, 'wb') as f:
+                write_csv(schema.with_month_labels(df), f, encoding, date_format='%Y/%m/%d')
+
+
+def customer_workbooks(customers, suffix):
+    """split_by_customer の結果を企業ごとのExcelファイル (ファイル名, バイト列) として1社ずつ返す。"""
+    filenames = customer_filenames([name for name, _ in customers], suffix, 'xlsx')
+    for filename, (_, df) in zip(filenames, customers):
+        yield filename, to_excel_bytes(df)
+
+
+def fingerprint(df):
+    """DataFrame の内容 (値・列名・型・インデックス) から求めたハッシュ値 (16進文字列)。"""
+    digest = hashlib.sha256()
+    digest.update(repr((list(df.columns), [str(dtype) for dtype in df.dtypes])).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class ExportCache:
+    """作成済みの出力ファイルをキーごとに一時ディレクトリに保持する。上限を超えると最も古く使われたものから削除する。
+
+    出力の内容はメモリに持たず、取り出すたびにファイルを開き直して渡す (同時にダウンロードされても読み込み位置を共有しない)。
+    ダウンロード時に別スレッドから呼ばれることがあるため、一覧の操作はロックで保護する。
+    作成中はロックを持たないので、別のキーの出力は同時に作成できる。
+    同じキーの出力を同時に要求された場合、作成は1回だけ行い、後から要求した側はその完了を待つ。
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._directory = tempfile.TemporaryDirectory(prefix='billing_export_') # プロセスの終了時に削除される
+        self._entries = OrderedDict() # キー -> ファイルのパス
+        self._building = {} # キー -> 作成中の出力の Future
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, write):
+        """key の出力ファイルを開いて (バイナリの読み込み用) 返す。まだなければ write(パス) で作成する。"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return open(self._entries[key], 'rb')
+            pending = self._building.get(key)
+            if pending is None:
+                pending = self._building[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return open(pending.result(), 'rb')
+
+        path = os.path.join(self._directory.name, uuid.uuid4().hex)
+        try:
+            write(path)
+        except BaseException as e:
+            with self._lock:
+                del self._building[key]
+            _remove(path)
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            del self._building[key]
+            self._entries[key] = path
+            output = open(path, 'rb')
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for evicted_path in evicted:
+            _remove(evicted_path) # 開いているファイルは (Windows 以外では) 閉じるまで読める
+        pending.set_result(path)
+        return output
+
+    def deferred(self, kind, df, write):
+        """ダウンロード時に呼ぶ関数 (出力ファイルを開いて返す) を返す。
+
+        種類 (kind) と df の内容のハッシュ値をキーにし、同じデータなら2回目以降は write を呼ばない。
+        ハッシュ値の計算も返した関数が呼ばれたときにだけ行う。
+        """
+        def produce():
+            return self.get_or_build((kind, fingerprint(df)), write)
+
+        return produce
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError: # 作成前に失敗した、または別のプロセスが開いている
+        pass
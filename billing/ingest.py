@@ -0,0 +1,238 @@
+"""CSVファイルの読み込みと列名の正規化。
+
+メッセージは (レベル, 本文) のタプルのリストで返し、表示は呼び出し側 (Streamlit等) に任せる。
+レベルは 'error' / 'warning' / 'info' のいずれか。
+"""
+import io
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple
+
+import pandas as pd
+
+from billing import jobs, normalize, profiling, reconcile, schema, selection
+from billing.encoding import detect_encoding, detect_stream_encoding
+
+NP = 'np'
+BAKURAKU = 'bakuraku'
+BANK = 'bank' # 銀行の入金明細 (バクラク請求書の消込用)
+
+# 分割読み込みでNP掛け払いCSVから読み込む列 (列名正規化後の名前)
+NP_COLUMNS = ['請求書発行日', '支払期限日', '請求番号', '企業名', '請求金額', '入金ステータス']
+NP_CHUNK_ROWS = 100_000 # 分割読み込みの1回あたりの行数
+
+
+class LoadResult(NamedTuple):
+    preview: pd.DataFrame | None  # 結合後 (列名正規化済み) の先頭5行
+    df: pd.DataFrame | None  # 処理済みデータ (処理できなかった場合はNone)
+    read_messages: list  # 読み込み時のメッセージ
+    messages: list  # 正規化・処理時のメッセージ
+    selection_index: selection.SelectionIndex | None = None  # バクラク請求書の未入金選択用インデックス
+    loaded_files: tuple = ()  # 読み込めたファイルの位置 (files の何番目か。読み込みに失敗したファイルは含まない)
+
+
+def read_csv_file(name, data):
+    """CSVのバイト列を読み込む。(DataFrame または None, メッセージ) を返す。
+
+    文字コードは先頭部分から一度だけ判定し、パースは1回で済ませる。
+    """
+    messages = []
+    encoding = detect_encoding(data)
+    messages.append(('info', f"ファイル '{name}' の文字コード: {encoding}"))
+    try:
+        return pd.read_csv(io.BytesIO(data), encoding=encoding), messages
+    except UnicodeDecodeError as e:
+        messages.append(('error', f"ファイル '{name}' の読み込み中にエラーが発生しました: {e}。エンコーディングを確認してください。"))
+    except Exception as e:
+        messages.append(('error', f"ファイル '{name}' の読み込み中にエラーが発生しました: {e}"))
+    return None, messages
+
+
+def normalize_column_name(col):
+    """列名の前後の空白を除去し、NFKCで全角・半角を統一する (英数字は半角、カタカナは全角)。"""
+    return unicodedata.normalize('NFKC', col.strip())
+
+
+def normalize_columns(df):
+    """すべての列名を normalize_column_name で正規化する。"""
+    df.columns = [normalize_column_name(col) for col in df.columns]
+    return df
+
+
+def _read_file(name, data):
+    """1ファイル分の読み込みと列名の正規化 (プロセスプールのワーカーからも呼ばれる)。"""
+    df, messages = read_csv_file(name, data)
+    if df is not None:
+        df = normalize_columns(df)
+    return df, messages
+
+
+def read_file(name, data, profiler=None):
+    """1ファイル分の読み込みと列名の正規化。(DataFrame または None, メッセージ) を返す。
+
+    アプリではファイルごとに1つのジョブとして実行し、結果を process_files に渡す。
+    """
+    profiler = profiler or profiling.DISABLED
+    with profiler.stage(f"CSV読み込み: {name}") as stage:
+        df, messages = _read_file(name, data)
+        stage.rows_out = None if df is None else len(df)
+    return df, messages
+
+
+def read_files(files, workers=None):
+    """(ファイル名, バイト列) のリストを読み込み、列名を正規化して結合する。
+
+    (結合後DataFrame または None, メッセージ, 読み込めたファイルの位置のタプル) を返す。
+
+    workers が2以上でファイルが複数ある場合はプロセスプールで並列に読み込む。
+    プールを起動できない環境では1ファイルずつ順に読み込む。メッセージはファイルの順番どおりに並ぶ。
+    """
+    if workers is None:
+        workers = jobs.default_workers()
+    workers = min(workers, len(files))
+
+    results = None
+    if workers > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=jobs.mp_context()) as executor:
+                results = list(executor.map(_read_file, *zip(*files)))
+        except (OSError, BrokenProcessPool):
+            results = None
+    if results is None:
+        results = [_read_file(name, data) for name, data in files]
+    return _combine(results)
+
+
+def _combine(results):
+    """ファイルごとの (DataFrame または None, メッセージ) を結合し、(DataFrame または None, メッセージ, 読み込めたファイルの位置) を返す。"""
+    frames = []
+    messages = []
+    loaded = []
+    for position, (df_temp, file_messages) in enumerate(results):
+        messages.extend(file_messages)
+        if df_temp is not None:
+            frames.append(df_temp)
+            loaded.append(position)
+    if not frames:
+        return None, messages, ()
+    return pd.concat(frames, ignore_index=True), messages, tuple(loaded)
+
+
+def _open_binary(data):
+    """バイト列はメモリ上のファイルとして、パスはファイルとして開く。"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return io.BytesIO(data)
+    return open(data, 'rb')
+
+
+def _extend_unique(messages, new_messages):
+    """チャンクごとに同じメッセージが出るので、初めてのものだけを追加する。"""
+    for message in new_messages:
+        if message not in messages:
+            messages.append(message)
+
+
+def load_np_chunked(files, chunksize=NP_CHUNK_ROWS, profiler=None):
+    """NP掛け払いCSVを chunksize 行ずつ読み込み、チャンクごとに整形してから結合する。
+
+    読み込むのは整形に使う列 (NP_COLUMNS) だけで、チャンクは整形後の型 (カテゴリ・整数) にしてから保持する。
+    そのため使用メモリはファイル全体ではなく、チャンクの大きさと整形後のデータの大きさで決まる。
+    files の各要素は (ファイル名, バイト列またはファイルのパス)。パスの場合はファイル全体を読み込まない。
+    """
+    profiler = profiler or profiling.DISABLED
+    read_messages = []
+    messages = []
+    frames = []
+    loaded = []
+    preview = None
+    with profiler.stage(f"{NP}: 分割読み込み・整形") as stage:
+        stage.rows_in = 0
+        for position, (name, data) in enumerate(files):
+            file_frames = []
+            with _open_binary(data) as f:
+                encoding = detect_stream_encoding(f)
+                read_messages.append(('info', f"ファイル '{name}' の文字コード: {encoding}"))
+                try:
+                    reader = pd.read_csv(
+                        f, encoding=encoding, chunksize=chunksize,
+                        usecols=lambda col: normalize_column_name(col) in NP_COLUMNS
+                    )
+                    for chunk in reader:
+                        chunk = normalize_columns(chunk)
+                        stage.rows_in += len(chunk)
+                        if preview is None:
+                            preview = chunk.head()
+                        df_chunk, chunk_messages = normalize.process_np(chunk)
+                        _extend_unique(messages, chunk_messages)
+                        if df_chunk is None:
+                            return LoadResult(preview, None, read_messages, messages)
+                        file_frames.append(df_chunk)
+                except UnicodeDecodeError as e:
+                    read_messages.append(('error', f"ファイル '{name}' の読み込み中にエラーが発生しました: {e}。エンコーディングを確認してください。"))
+                    continue
+                except Exception as e:
+                    read_messages.append(('error', f"ファイル '{name}' の読み込み中にエラーが発生しました: {e}"))
+                    continue
+            frames.extend(file_frames)
+            loaded.append(position)
+        if not frames:
+            return LoadResult(None, None, read_messages, [])
+        df = schema.concat(frames)
+        stage.rows_out = len(df)
+    return LoadResult(preview, df, read_messages, messages, loaded_files=tuple(loaded))
+
+
+def load_source(source, files, workers=None, profiler=None, chunksize=None):
+    """NP掛け払い (NP) またはバクラク請求書 (BAKURAKU) のCSV群を読み込み、支払状況以外の処理まで行う。
+
+    銀行の入金明細 (BANK) は入金の一覧 (reconcile.prepare_deposits の結果) にする。
+
+    profiler (profiling.Profiler) を指定すると、読み込み・整形の各段階の所要時間などを記録する。
+    chunksize を指定すると、NP掛け払いは load_np_chunked で分割して読み込む (バクラク請求書は常に一括)。
+    """
+    if source == NP and chunksize:
+        return load_np_chunked(files, chunksize, profiler)
+    profiler = profiler or profiling.DISABLED
+    with profiler.stage(f"{source}: CSV読み込み") as stage:
+        df, read_messages, loaded = read_files(files, workers)
+        stage.rows_out = None if df is None else len(df)
+    return _process(source, df, read_messages, loaded, profiler)
+
+
+def process_files(source, results, profiler=None):
+    """read_file の結果のリスト (files の順) を結合し、load_source と同じ処理を行う。"""
+    profiler = profiler or profiling.DISABLED
+    with profiler.stage(f"{source}: ファイルの結合") as stage:
+        df, read_messages, loaded = _combine(results)
+        stage.rows_out = None if df is None else len(df)
+    return _process(source, df, read_messages, loaded, profiler)
+
+
+def _process(source, df, read_messages, loaded, profiler):
+    """読み込んだ (列名正規化済みの) DataFrame をデータソースごとに整形して LoadResult にする。"""
+    if df is None:
+        return LoadResult(None, None, read_messages, [])
+
+    preview = df.head()
+    if source == NP:
+        with profiler.stage(f"{source}: 整形", rows_in=len(df)) as stage:
+            df, messages = normalize.process_np(df)
+            stage.rows_out = None if df is None else len(df)
+        return LoadResult(preview, df, read_messages, messages, loaded_files=loaded)
+    if source == BAKURAKU:
+        with profiler.stage(f"{source}: 整形", rows_in=len(df)) as stage:
+            df, messages = normalize.prepare_bakuraku(df)
+            stage.rows_out = None if df is None else len(df)
+        index = None
+        if df is not None:
+            with profiler.stage(f"{source}: 選択用インデックス", rows_in=len(df)) as stage:
+                index = selection.build_index(df)
+                stage.rows_out = len(index.table)
+        return LoadResult(preview, df, read_messages, messages, index, loaded)
+    if source == BANK:
+        with profiler.stage(f"{source}: 整形", rows_in=len(df)) as stage:
+            df, messages = reconcile.prepare_deposits(df)
+            stage.rows_out = None if df is None else len(df)
+        return LoadResult(preview, df, read_messages, messages, loaded_files=loaded)
+    raise ValueError(f"不明なデータソースです: {source}")
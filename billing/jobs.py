@@ -0,0 +1,288 @@
+"""重い処理 (CSVの読み込み・出力ファイルの作成) のバックグラウンド実行。
+
+JobExecutor は上限つきのプロセスプールで関数を実行する。呼び出し側 (Streamlitのスクリプト) は完了を待たずに
+進捗を確認でき、同じキー (データソースとファイルのハッシュ値など) のジョブは、別のセッションからのものも含めて
+1つの実行結果を共有する。完了したジョブは新しいものから max_finished 件まで結果を保持する。
+
+profile=True で投入した関数には JobProfiler が profiler 引数として渡され、処理段階の開始ごとに
+進捗 (何段階目か・段階名) をプロセス間で共有する辞書に書き込む。記録した段階は Job.records で受け取れる。
+キャンセルは、開始前のジョブは取り消し、実行中のジョブは次の段階の開始時に JobCancelled で中断する。
+複数のセッションが同じジョブを待っている場合、あるセッションでのキャンセル (Job.detach) はそのセッションが待つのを
+やめるだけで、待っているセッションがなくなったときにだけジョブをキャンセルする。待っているセッションは Job.touch で
+定期的に知らせ、waiter_timeout 秒以上知らせのないもの (閉じられたタブなど) は待つのをやめたものとして扱う。
+失敗したジョブも完了したジョブと同じく保持し、同じキーで投入し直しても実行しない (discard で除くと実行し直す)。
+"""
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from billing import profiling
+
+PENDING = '待機中'
+RUNNING = '実行中'
+DONE = '完了'
+FAILED = '失敗'
+CANCELLED = 'キャンセル'
+
+WAITER_TIMEOUT = 120 # この秒数 touch されなければ待つのをやめたとみなす (バックグラウンドのタブでは更新が間引かれるため長めにする)
+
+_shared = None # ワーカーの (進捗の辞書, キャンセルされたジョブの辞書)
+
+
+def default_workers():
+    """プロセスプール (ジョブの実行器・CSV読み込み・PDF作成) の大きさの既定値。
+
+    CPUのコア数で、環境変数 BILLING_JOB_WORKERS で変更できる。環境変数 BILLING_INGEST_WORKERS があればそれを上限にする
+    (ジョブのワーカーの中では1になり、さらにプロセスを起動しない)。
+    """
+    workers = int(os.environ.get('BILLING_JOB_WORKERS', os.cpu_count() or 1))
+    if os.environ.get('BILLING_INGEST_WORKERS'):
+        workers = min(workers, int(os.environ['BILLING_INGEST_WORKERS']))
+    return workers
+
+
+def mp_context():
+    """プロセスプールの起動方法。使える環境では fork にする (spawn では Streamlit のスクリプトが __main__ として
+    ワーカーで再実行されてしまうため)。"""
+    return multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+
+
+class JobCancelled(Exception):
+    """実行中のジョブがキャンセルされた。"""
+
+
+class JobProfiler(profiling.Profiler):
+    """ワーカーで使う Profiler。段階の開始ごとに進捗を書き込み、キャンセルされていれば JobCancelled を送出する。"""
+
+    def __init__(self, job_id, progress, cancelled):
+        super().__init__()
+        self.job_id = job_id
+        self._progress = progress
+        self._cancelled = cancelled
+        self._started = 0
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        if self._cancelled.get(self.job_id):
+            raise JobCancelled(name)
+        self._started += 1
+        self._progress[self.job_id] = (self._started, name)
+        with super().stage(name, rows_in) as stage:
+            yield stage
+
+
+def _init_worker(progress, cancelled):
+    global _shared
+    _shared = (progress, cancelled)
+    # ワーカーの中でさらにプロセスプールを起動しない (同時に動くプロセス数を max_workers までにする)
+    os.environ['BILLING_INGEST_WORKERS'] = '1'
+
+
+def _run(job_id, fn, args, kwargs, profile):
+    """ワーカーで fn を実行し、(結果, 記録した段階のリスト) を返す。"""
+    progress, cancelled = _shared
+    if cancelled.get(job_id):
+        raise JobCancelled()
+    progress[job_id] = (0, RUNNING)
+    if not profile:
+        return fn(*args, **kwargs), []
+    profiler = JobProfiler(job_id, progress, cancelled)
+    return fn(*args, profiler=profiler, **kwargs), profiler.records
+
+
+class Job:
+    """投入したジョブ。結果・状態・進捗は JobExecutor が管理する Future と共有の辞書から取り出す。"""
+
+    def __init__(self, job_id, key, label, stages, future, executor):
+        self.id = job_id
+        self.key = key
+        self.label = label
+        self.stages = stages # 段階数 (進捗の割合に使う。分からない場合は None)
+        self.future = future
+        self.submitted_at = time.monotonic()
+        self.cancel_requested = False
+        self._waiters = {} # このジョブの結果を待っているもの (セッションのIDなど) と最後に touch された時刻
+        self._executor = executor
+
+    def done(self):
+        return self.future.done()
+
+    @property
+    def state(self):
+        if self.future.cancelled():
+            return CANCELLED
+        if not self.future.done():
+            return RUNNING if self._executor._progress.get(self.id) is not None else PENDING
+        error = self.future.exception()
+        if error is None:
+            return DONE
+        return CANCELLED if isinstance(error, JobCancelled) else FAILED
+
+    @property
+    def error(self):
+        """失敗した場合の例外 (それ以外は None)。"""
+        if self.future.done() and not self.future.cancelled():
+            error = self.future.exception()
+            if not isinstance(error, JobCancelled):
+                return error
+        return None
+
+    @property
+    def elapsed(self):
+        """投入からの経過秒数。"""
+        return time.monotonic() - self.submitted_at
+
+    def progress(self):
+        """(割合 0〜1 または None, 現在の段階名) を返す。段階数が分からない場合の割合は None。"""
+        if self.future.done():
+            return 1.0, self.state
+        started, name = self._executor._progress.get(self.id) or (0, PENDING)
+        if not self.stages:
+            return None, name
+        return min(max(started - 1, 0) / self.stages, 1.0), name
+
+    def cancel(self):
+        """開始前なら取り消し、実行中なら次の段階の開始時に中断する (待っているものがあってもキャンセルする)。"""
+        self.cancel_requested = True
+        if not self.future.cancel():
+            self._executor._cancelled[self.id] = True
+
+    def touch(self, waiter):
+        """waiter がこのジョブをまだ待っていることを知らせる。"""
+        with self._executor._lock:
+            self._waiters[waiter] = time.monotonic()
+
+    def detach(self, waiter):
+        """waiter がこのジョブを待つのをやめる。ほかに待っているものがなくなった場合だけキャンセルする。"""
+        with self._executor._lock:
+            self._waiters.pop(waiter, None)
+            if not self._waiters and not self.done():
+                self.cancel()
+
+    def result(self, timeout=None):
+        """結果を返す (完了するまで待つ)。キャンセル・失敗した場合は例外を送出する。"""
+        return self.future.result(timeout)[0]
+
+    @property
+    def records(self):
+        """ワーカーで記録した段階 (Stage) のリスト。完了していない場合は空。"""
+        if self.state != DONE:
+            return []
+        return self.future.result()[1]
+
+
+class JobExecutor:
+    """セッションをまたいで共有するジョブの実行器。同時に実行するジョブは max_workers 個まで。
+
+    ワーカーは mp_context の方法 (使える環境では fork) で起動する。投入する関数は billing パッケージなどモジュールの最上位で定義したものに限る。
+    """
+
+    def __init__(self, max_workers=None, max_finished=16, waiter_timeout=WAITER_TIMEOUT):
+        self.max_workers = max_workers or default_workers()
+        self.max_finished = max_finished
+        self.waiter_timeout = waiter_timeout
+        self._context = mp_context()
+        self._manager = self._context.Manager()
+        self._progress = self._manager.dict()
+        self._cancelled = self._manager.dict()
+        self._pool = self._new_pool()
+        self._jobs = OrderedDict()
+        self._lock = threading.RLock() # キャンセル時の完了処理 (_finished) は同じスレッドで呼ばれる
+        # 知らせのなくなった待ち手を定期的に除く (すべてのセッションが閉じられても実行中のジョブを止めるため)
+        self._stopped = threading.Event()
+        threading.Thread(target=self._expire_waiters_periodically, daemon=True).start()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=self._context,
+            initializer=_init_worker, initargs=(self._progress, self._cancelled)
+        )
+
+    def submit(self, key, fn, *args, label='', stages=None, profile=False, waiter=None, **kwargs):
+        """fn(*args, **kwargs) をジョブとして投入し、Job を返す。
+
+        key が同じジョブが実行中・完了済み・失敗済みならそれを返す (キャンセルしたもの、キャンセル中のものは投入し直す)。
+        失敗したジョブを実行し直す場合は、先に discard で一覧から除く。
+        key が None の場合は常に新しいジョブにする。waiter を指定すると、そのジョブを待っているものとして登録する。
+        """
+        with self._lock:
+            job = self._jobs.get(key) if key is not None else None
+            # キャンセルを要求したが実行中のものは、この後で中断されるので使わない
+            if job is not None and job.state != CANCELLED and not (job.cancel_requested and not job.done()):
+                self._jobs.move_to_end(key)
+                if waiter is not None:
+                    job.touch(waiter)
+                return job
+
+            job_id = uuid.uuid4().hex
+            try:
+                future = self._pool.submit(_run, job_id, fn, args, kwargs, profile)
+            except BrokenProcessPool: # ワーカーが異常終了した (メモリ不足など) 場合はプールを作り直す
+                self._pool = self._new_pool()
+                future = self._pool.submit(_run, job_id, fn, args, kwargs, profile)
+            job = Job(job_id, job_id if key is None else key, label, stages, future, self)
+            if waiter is not None:
+                job.touch(waiter)
+            self._jobs[job.key] = job
+            self._jobs.move_to_end(job.key)
+            future.add_done_callback(lambda _: self._finished(job))
+            return job
+
+    def run(self, fn, *args, label='', stages=None, profile=False, **kwargs):
+        """ジョブとして実行して完了を待ち、(結果, 記録した段階のリスト) を返す。結果は保持しない。"""
+        job = self.submit(None, fn, *args, label=label, stages=stages, profile=profile, **kwargs)
+        try:
+            return job.result(), job.records
+        finally:
+            self.discard(job.key)
+
+    def _finished(self, job):
+        self._progress.pop(job.id, None)
+        self._cancelled.pop(job.id, None)
+        with self._lock:
+            finished = [key for key, other in self._jobs.items() if other.done()]
+            for key in finished[:max(len(finished) - self.max_finished, 0)]:
+                del self._jobs[key]
+
+    def discard(self, key, job=None):
+        """キーのジョブを一覧から除く (実行中のものはキャンセルする)。job を指定した場合は、キーのジョブがそれのときだけ除く。"""
+        with self._lock:
+            if job is not None and self._jobs.get(key) is not job:
+                return
+            job = self._jobs.pop(key, None)
+        if job is not None and not job.done():
+            job.cancel()
+
+    def expire_waiters(self, now=None):
+        """waiter_timeout 秒以上 touch されていない待ち手を除き、待っているものがいなくなったジョブをキャンセルする。
+
+        待ち手を登録せずに投入したジョブ (run など) は対象にしない。
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for job in list(self._jobs.values()):
+                if job.done():
+                    continue
+                for waiter, seen in list(job._waiters.items()):
+                    if now - seen > self.waiter_timeout:
+                        job.detach(waiter)
+
+    def _expire_waiters_periodically(self):
+        while not self._stopped.wait(self.waiter_timeout / 4):
+            self.expire_waiters()
+
+    def jobs(self):
+        """保持しているジョブ (古い順)。"""
+        with self._lock:
+            return list(self._jobs.values())
+
+    def shutdown(self):
+        self._stopped.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
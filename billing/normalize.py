@@ -0,0 +1,140 @@
+"""NP掛け払い・バクラク請求書データの整形。
+
+行ごとの apply は使わず、ブールマスクと列演算で処理する。
+"""
+import numpy as np
+import pandas as pd
+
+from billing import schema
+from billing.schema import PAYMENT_FLAGS
+
+# バクラク請求書の明細を請求書単位にまとめるキーと、そのうちカテゴリ型で持つ列
+BAKURAKU_INVOICE_KEYS = ['書類番号', '日付', '支払期日', '送付先名', 'ご請求方法']
+BAKURAKU_CATEGORY_COLS = ['書類番号', '送付先名', 'ご請求方法']
+
+
+def payment_flag(paid):
+    """入金済みかどうかのブールマスクから、カテゴリ型の '入金有無' 列 (あり/なし) を作る。"""
+    paid = np.asarray(paid, dtype=bool)
+    return pd.Categorical.from_codes(np.where(paid, 0, 1), categories=PAYMENT_FLAGS)
+
+
+def unpaid_amount(amount, paid):
+    """未入金の行は金額、入金済みの行は0とした列を返す (金額列の型はそのまま)。"""
+    return amount.where(~np.asarray(paid, dtype=bool), 0)
+
+
+def process_np(df_np):
+    """列名正規化済みのNP掛け払いデータから df_np_processed を作成する。(DataFrame または None, メッセージ) を返す。"""
+    messages = [('info', f"デバッグ: NPデータフレーム列名正規化後の列: {df_np.columns.tolist()}")]
+
+    # '企業名' 列の存在チェックと代替
+    if '企業名' not in df_np.columns:
+        messages.append(('warning', "NP掛け払いCSVに '企業名' 列が見つかりませんでした。空文字列として処理を続行します。"))
+        df_np['企業名'] = '' # 存在しない場合は空の列を追加
+
+    # '請求番号' 列の存在チェックと代替
+    # 正規化後も '請求番号' がなければ、強制的に追加
+    if '請求番号' not in df_np.columns:
+        messages.append(('warning', "NP掛け払いCSVに '請求番号' 列が見つかりませんでした。空文字列として列を追加します。"))
+        df_np['請求番号'] = '' # 存在しない場合は空の列を追加
+        messages.append(('info', f"デバッグ: '請求番号' 列追加後のNPデータフレームの列: {df_np.columns.tolist()}"))
+    else:
+        messages.append(('info', f"デバッグ: NPデータフレームに'請求番号'列は元から存在していました。現在の列: {df_np.columns.tolist()}"))
+
+    # 必須列の存在チェック (上で追加した'企業名', '請求番号'はここでチェックしない)
+    required_np_columns_for_processing = ['請求書発行日', '支払期限日', '請求金額', '入金ステータス']
+    missing_np_cols = [col for col in required_np_columns_for_processing if col not in df_np.columns]
+    if missing_np_cols:
+        messages.append(('error', f"NP掛け払いCSVに以下の必須列が見つかりません: {', '.join(missing_np_cols)}"))
+        return None, messages
+
+    df_np['請求書発行日'] = pd.to_datetime(df_np['請求書発行日'], errors='coerce')
+    df_np['支払期限日'] = pd.to_datetime(df_np['支払期限日'], errors='coerce')
+
+    if df_np['請求書発行日'].isnull().any() or df_np['支払期限日'].isnull().any():
+        messages.append(('warning', "NP掛け払いCSVの日付列に無効な値がありました。該当行はNaNとして処理されます。"))
+
+    paid = (df_np['入金ステータス'] == '入金済み').to_numpy()
+    df_np['入金有無'] = payment_flag(paid)
+    df_np['ご請求方法'] = 'NP掛け払い'
+    df_np['請求金額'] = schema.to_yen(df_np['請求金額'])
+    df_np['未入金金額合計 (税込)'] = unpaid_amount(df_np['請求金額'], paid)
+
+    cols_for_np_processed = ['請求書発行日', '支払期限日', '請求番号', '企業名', 'ご請求方法', '請求金額', '未入金金額合計 (税込)', '入金有無']
+
+    messages.append(('info', f"デバッグ: df_np_processed作成直前のdf_npの列: {df_np.columns.tolist()}"))
+    if not all(col in df_np.columns for col in cols_for_np_processed):
+        messages.append(('error', "NP掛け払い処理済みデータフレームの作成に必要な列が不足しています。予期せぬエラーが発生しました。不足している列は上記デバッグ情報をご確認ください。"))
+        return None, messages
+
+    df_np_processed = df_np[cols_for_np_processed].rename(columns={
+        '請求金額': 'ご請求金額合計 (税込)',
+        '支払期限日': 'お支払期日',
+        '請求番号': '請求書番号'
+    })
+    df_np_processed['ご利用年月'] = df_np_processed['請求書発行日'].dt.to_period('M')
+    return schema.conform(df_np_processed), messages
+
+
+def prepare_bakuraku(df_bakuraku):
+    """列名正規化済みのバクラク請求書データを、未入金選択の前段階まで整形する。(DataFrame または None, メッセージ) を返す。"""
+    messages = [('info', f"デバッグ: バクラクデータフレーム列名正規化後の列: {df_bakuraku.columns.tolist()}")]
+
+    # 必須列の存在チェック
+    required_bakuraku_columns = ['日付', '支払期日', '書類種別', '書類番号', '送付先名', '金額'] # '書類種別'も確認
+    missing_bakuraku_cols = [col for col in required_bakuraku_columns if col not in df_bakuraku.columns]
+    if missing_bakuraku_cols:
+        messages.append(('error', f"バクラク請求書CSVに以下の必須列が見つかりません: {', '.join(missing_bakuraku_cols)}"))
+        return None, messages
+
+    df_bakuraku['日付'] = pd.to_datetime(df_bakuraku['日付'], errors='coerce')
+    df_bakuraku['支払期日'] = pd.to_datetime(df_bakuraku['支払期日'], errors='coerce')
+
+    if df_bakuraku['日付'].isnull().any() or df_bakuraku['支払期日'].isnull().any():
+        messages.append(('warning', "バクラク請求書CSVの日付列に無効な値がありました。該当行はNaNとして処理されます。"))
+
+    # 'ご請求方法'を'書類種別'から取得する ('書類種別'がNaNの場合は'不明')
+    df_bakuraku['ご請求方法'] = df_bakuraku['書類種別'].fillna('不明')
+
+    df_bakuraku['金額'] = schema.to_yen(df_bakuraku['金額'])
+    df_bakuraku['ご請求金額合計 (税込)'] = df_bakuraku['金額']
+    # 集計キーの文字列列は読み込み時に一度だけカテゴリ型にしておく (未入金の選択を変えるたびの集計が速くなる)
+    df_bakuraku = df_bakuraku.astype({col: 'category' for col in BAKURAKU_CATEGORY_COLS})
+    return df_bakuraku, messages
+
+
+def apply_bakuraku_payment(df_bakuraku, unpaid_rows):
+    """未入金として選択された行 (行ごとのブールマスク) を反映し、請求書単位に集計した df_bakuraku_processed を返す。
+
+    集計は組み込みの sum / max だけで行う。入金有無は「未入金の明細が1つでもあれば なし」なので、
+    未入金フラグ (bool) の max で求める。キーの文字列列はカテゴリ型 (observed=True) で集計する。
+    """
+    unpaid = np.asarray(unpaid_rows, dtype=bool)
+    lines = df_bakuraku[BAKURAKU_INVOICE_KEYS].astype({col: 'category' for col in BAKURAKU_CATEGORY_COLS})
+    lines['金額合計'] = df_bakuraku['ご請求金額合計 (税込)'].to_numpy()
+    lines['未入金合計'] = unpaid_amount(df_bakuraku['金額'], ~unpaid).to_numpy()
+    lines['未入金'] = unpaid
+
+    # 最終的な処理済みデータフレームを作成する際に、同じ請求書をグループ化
+    # 'ご請求方法' もグループ化キーに含める
+    df_bakuraku_processed = lines.groupby(BAKURAKU_INVOICE_KEYS, observed=True).agg(
+        金額合計=('金額合計', 'sum'),
+        未入金合計=('未入金合計', 'sum'),
+        未入金=('未入金', 'max') # 一つでも未入金があれば「なし」
+    ).reset_index()
+    df_bakuraku_processed['入金有無'] = payment_flag(~df_bakuraku_processed['未入金'].to_numpy())
+    for col in ['送付先名', 'ご請求方法']:
+        # 集計で除かれた明細 (日付が空など) だけにあったカテゴリは残さない
+        df_bakuraku_processed[col] = df_bakuraku_processed[col].cat.remove_unused_categories()
+
+    df_bakuraku_processed = df_bakuraku_processed.rename(columns={
+        '日付': '請求書発行日',
+        '支払期日': 'お支払期日',
+        '書類番号': '請求書番号',
+        '送付先名': '企業名',
+        '金額合計': 'ご請求金額合計 (税込)',
+        '未入金合計': '未入金金額合計 (税込)'
+    })
+    df_bakuraku_processed['ご利用年月'] = df_bakuraku_processed['請求書発行日'].dt.to_period('M')
+    return schema.conform(df_bakuraku_processed)
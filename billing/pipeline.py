@@ -0,0 +1,97 @@
+"""NP掛け払い・バクラク請求書の処理結果の統合と合計行の作成。"""
+import numpy as np
+import pandas as pd
+
+from billing import schema
+from billing.schema import AMOUNT_COLS, INVOICE_COLS as COMMON_COLS
+
+DEFAULT_COMPANY_NAME = "取引先"
+
+
+def combine(df_np_processed, df_bakuraku_processed):
+    """2つの処理結果を共通の列で結合し、ご利用年月・請求書発行日順に並べる。(DataFrame または None, メッセージ) を返す。"""
+    messages = []
+
+    # 結合する前に、各DFが共通の列を持っているか最終確認
+    missing_cols_np = [col for col in COMMON_COLS if col not in df_np_processed.columns]
+    missing_cols_bakuraku = [col for col in COMMON_COLS if col not in df_bakuraku_processed.columns]
+    if missing_cols_np:
+        messages.append(('error', f"NP掛け払い処理結果データに結合に必要な列が不足しています: {', '.join(missing_cols_np)}"))
+        return None, messages
+    if missing_cols_bakuraku:
+        messages.append(('error', f"バクラク請求書処理結果データに結合に必要な列が不足しています: {', '.join(missing_cols_bakuraku)}"))
+        return None, messages
+
+    combined_df = schema.concat([
+        df_np_processed[COMMON_COLS],
+        df_bakuraku_processed[COMMON_COLS]
+    ])
+
+    # ご利用年月 (Period) と請求書発行日は処理結果の時点で型がそろっているので、そのまま並べ替える
+    combined_df = combined_df.sort_values(by=['ご利用年月', '請求書発行日'], na_position='last').reset_index(drop=True)
+    messages.append(('info', f"デバッグ: 統合データのメモリ使用量: {schema.memory_usage_mb(combined_df):,.1f} MB ({len(combined_df):,}行)"))
+    return combined_df, messages
+
+
+def add_total_row(combined_df):
+    """末尾に金額列の合計行 (ご請求方法='合計') を追加した DataFrame を返す。"""
+    return _append_total(combined_df, combined_df[AMOUNT_COLS].sum())
+
+
+def company_label(*frames):
+    """宛名に使う企業名。1社ならその名前、複数なら先頭2社 + " 他"、不明なら "取引先"。"""
+    all_unique_companies = []
+    for df in frames:
+        if df is not None and not df.empty and '企業名' in df.columns:
+            all_unique_companies.extend(df['企業名'].dropna().unique().tolist())
+
+    unique_companies_set = sorted(set(all_unique_companies))
+
+    company_name = DEFAULT_COMPANY_NAME
+    if len(unique_companies_set) == 1:
+        company_name = unique_companies_set[0]
+    elif len(unique_companies_set) > 1:
+        company_name = ", ".join(unique_companies_set[:2]) + " 他"
+
+    if not company_name or company_name.strip() == "":
+        company_name = DEFAULT_COMPANY_NAME
+    return company_name
+
+
+def split_by_customer(combined_df):
+    """企業名ごとに合計行付きの DataFrame に分割する。[(宛名, DataFrame), ...] を企業名順で返す。
+
+    企業名での安定ソート1回と groupby の集計1回で処理する。全企業の合計行を1つの DataFrame として作り、
+    各企業の行の直後に合計行が来るように1回だけ並べ替えて (カテゴリもここで1回だけそろえる)、連続した範囲を切り出す。
+    企業内の並び (ご利用年月・請求書発行日順) は combine の結果のまま保たれる。
+    """
+    sorted_df = combined_df.sort_values('企業名', kind='stable', na_position='last').reset_index(drop=True)
+    totals = sorted_df.groupby('企業名', sort=False, dropna=False, observed=True)[AMOUNT_COLS].sum()
+
+    # 企業名が切り替わる位置で区切る (NaN 同士は同じ企業として扱う)
+    companies = sorted_df['企業名']
+    changed = (companies != companies.shift()) & ~(companies.isna() & companies.shift().isna())
+    starts = np.flatnonzero(changed.to_numpy())
+    ends = np.append(starts[1:], len(sorted_df))
+
+    # 企業 i の合計行 (len(sorted_df) + i 行目) を、その企業の最後の行の直後に入れる
+    with_totals = schema.concat([sorted_df, schema.total_rows(sorted_df, totals)])
+    order = np.insert(np.arange(len(sorted_df)), ends, len(sorted_df) + np.arange(len(totals)))
+    with_totals = with_totals.take(order)
+
+    customers = []
+    for i, (company, start, end) in enumerate(zip(totals.index, starts, ends)):
+        df_company = with_totals.iloc[start + i:end + i + 1].reset_index(drop=True)
+        customers.append((_customer_label(company), df_company))
+    return customers
+
+
+def _customer_label(company):
+    """1社分の宛名 (company_label と同じく、企業名が空なら "取引先")。"""
+    if pd.isna(company) or not str(company).strip():
+        return DEFAULT_COMPANY_NAME
+    return company
+
+
+def _append_total(df, total):
+    return schema.concat([df, schema.total_row(df, total)])
@@ -0,0 +1,157 @@
+"""処理段階ごとの所要時間・行数・メモリ使用量の記録。
+
+    profiler = Profiler()
+    with profiler.stage('統合', rows_in=len(df)) as stage:
+        combined_df = ...
+        stage.rows_out = len(combined_df)
+
+記録は Profiler.records に残り、ロガー 'billing.profiling' に1段階1行のJSONとして出力される
+(出力先は configure_json_log で指定する)。
+メモリはプロセス全体の最大使用量 (最大RSS) で、段階の終了時点の値と段階中の増加分を記録する。
+resource モジュールがない環境 (Windows) では None になる。
+"""
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+logger = logging.getLogger('billing.profiling')
+
+
+def peak_rss_mb():
+    """このプロセスのこれまでの最大RSS (MB)。取得できない環境では None。"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB 単位、macOS はバイト単位
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+class Stage:
+    """1つの処理段階の記録。rows_out は with ブロックの中で設定する。"""
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = None
+        self.peak_rss_mb = None
+        self.rss_growth_mb = None
+        self.error = None
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'seconds': None if self.seconds is None else round(self.seconds, 4),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'peak_rss_mb': None if self.peak_rss_mb is None else round(self.peak_rss_mb, 1),
+            'rss_growth_mb': None if self.rss_growth_mb is None else round(self.rss_growth_mb, 1),
+            'error': self.error,
+        }
+
+
+class Profiler:
+    """処理段階の記録を新しいものから max_records 件まで保持する。
+
+    enabled=False の場合は何も記録・出力しない (stage はそのまま使える)。
+    """
+
+    def __init__(self, max_records=100, enabled=True):
+        self.enabled = enabled
+        self._records = collections.deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        stage = Stage(name, rows_in)
+        if not self.enabled:
+            yield stage
+            return
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield stage
+        except BaseException as e:
+            stage.error = type(e).__name__
+            raise
+        finally:
+            stage.seconds = time.perf_counter() - start
+            stage.peak_rss_mb = peak_rss_mb()
+            if rss_before is not None:
+                stage.rss_growth_mb = stage.peak_rss_mb - rss_before
+            with self._lock:
+                self._records.append(stage)
+            logger.info(json.dumps(stage.as_dict(), ensure_ascii=False))
+
+    @property
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def extend(self, stages):
+        """別のプロセスなどで記録した段階 (Stage) を追加する。"""
+        with self._lock:
+            self._records.extend(stages)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def report(self):
+        """記録を表形式の文字列にする (CLI用)。"""
+        return format_records([stage.as_dict() for stage in self.records])
+
+
+def format_records(records, ratios=None):
+    """as_dict() の結果のリストを表形式の文字列にする。ratios を渡すと '基準比' 列を追加する。"""
+    header = _pad('段階', 32) + _pad('秒', 10, True) + _pad('入力行数', 12, True) + _pad('出力行数', 12, True) + _pad('最大RSS(MB)', 14, True)
+    lines = [header + (_pad('基準比', 10, True) if ratios is not None else '')]
+    for i, row in enumerate(records):
+        line = (
+            _pad(row['stage'], 32) + _pad(f"{row['seconds']:.3f}", 10, True)
+            + _pad(_blank(row['rows_in']), 12, True) + _pad(_blank(row['rows_out']), 12, True)
+            + _pad(_blank(row['peak_rss_mb']), 14, True)
+        )
+        if ratios is not None:
+            line += _pad(ratios[i], 10, True)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _blank(value):
+    return '' if value is None else f"{value:,}"
+
+
+def _pad(text, width, right=False):
+    """全角文字を2桁として width 桁にそろえる。"""
+    used = sum(2 if unicodedata.east_asian_width(c) in 'FW' else 1 for c in text)
+    space = ' ' * max(width - used, 1)
+    return space + text if right else text + space
+
+
+# ライブラリ関数で profiler が指定されなかったときに使う (何も記録しない)
+DISABLED = Profiler(max_records=1, enabled=False)
+
+
+def configure_json_log(path):
+    """記録を1行1件のJSONとして path に追記する。同じパスに対して何度呼んでもハンドラは1つだけ追加する。"""
+    path = str(path)
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler) and handler.baseFilename == os.path.abspath(path):
+            return handler
+    handler = logging.FileHandler(path, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return handler
@@ -0,0 +1,203 @@
+"""銀行の入金明細CSVとバクラク請求書の照合 (消込)。
+
+バクラク請求書は (書類番号, 日付, 支払期日, 送付先名) ごとに明細の金額を合計して1件の請求書とする。
+入金と請求書は、金額と「支払期日を含む期間」の番号をキーにしたハッシュ結合 (pandas の merge) で候補を作り、
+入金日が支払期日の WINDOW_BEFORE_DAYS 日前から WINDOW_AFTER_DAYS 日後までにあるものだけを残す。
+振込依頼人名と送付先名は normalize_name で正規化し、一致する候補があればそれを優先する。
+入金と請求書が1対1に対応し、名前が一致する (または振込依頼人名がない) ものを自動で消し込む。
+複数の候補が残ったもの、1対1でも名前が一致しないものは要確認とする。
+"""
+import re
+import unicodedata
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+INVOICE_KEYS = ['書類番号', '日付', '支払期日', '送付先名']
+
+# 銀行の入金明細CSVの列名の候補 (列名正規化後の名前。先にあるものを使う)
+DATE_COLUMNS = ['入金日', '取引日', '勘定日', '日付', '年月日']
+AMOUNT_COLUMNS = ['入金金額', 'お預り金額', 'お預入金額', '預入金額', '入金額', '入金', '金額']
+PAYER_COLUMNS = ['振込依頼人名', '振込依頼人', '依頼人名', '摘要', '取引内容', '内容']
+
+WINDOW_BEFORE_DAYS = 60 # 支払期日の何日前からの入金を候補にするか
+WINDOW_AFTER_DAYS = 30 # 支払期日の何日後までの入金を候補にするか
+
+AUTO = '自動消込'
+REVIEW = '要確認'
+UNMATCHED = '未照合'
+
+# 振込依頼人名 (半角カナが多い) と送付先名 (漢字が多い) の法人格の表記
+_CORPORATE = re.compile(
+    r'株式会社|有限会社|合同会社|合資会社|合名会社|一般社団法人|一般財団法人'
+    r'|カブシキガイシヤ|カブシキカイシヤ|ユウゲンガイシヤ|ゴウドウガイシヤ'
+    r'|\((?:株|有|同|名|資|社|財|カ|ユ|ド)\)|^(?:カ|ユ|ド)\)|\((?:カ|ユ|ド)$'
+)
+_IGNORED = re.compile(r'[\s.,・\-‐−ー()「」]')
+_SMALL_KANA = str.maketrans('ァィゥェォッャュョヮヵヶ', 'アイウエオツヤユヨワカケ')
+
+
+class ReconcileResult(NamedTuple):
+    invoices: pd.DataFrame # 請求書ごとの照合結果 (i 行目が請求書 i)
+    invoice_ids: np.ndarray # バクラク請求書の明細ごとの請求書番号 (invoices の行位置)
+    review: pd.DataFrame # 要確認の候補 (請求書と入金の組み合わせ)
+    unmatched_deposits: pd.DataFrame # どの請求書の候補にもならなかった入金
+    messages: list
+
+
+def normalize_name(name):
+    """振込依頼人名・送付先名を比較用に正規化する。
+
+    NFKC で全角・半角を統一し、ひらがなと小書きのカナを大きいカタカナに、英字を大文字にそろえ、
+    法人格 (株式会社、㈱、カ) など) と空白・記号を除く。
+    """
+    key = unicodedata.normalize('NFKC', str(name)).upper()
+    key = ''.join(chr(ord(c) + 0x60) if 'ぁ' <= c <= 'ゖ' else c for c in key)
+    key = _CORPORATE.sub('', key.translate(_SMALL_KANA).strip())
+    return _IGNORED.sub('', key)
+
+
+def name_keys(series):
+    """Series の各値を normalize_name で正規化する。正規化は重複のない値ごとに1回だけ行う。欠損値は空文字列。"""
+    codes, uniques = pd.factorize(series)
+    keys = np.array([normalize_name(value) for value in uniques] + [''], dtype=object) # 欠損値 (-1) は末尾の ''
+    return keys[codes]
+
+
+def _find_column(df, candidates):
+    return next((col for col in candidates if col in df.columns), None)
+
+
+def _to_amount(series):
+    """'1,000' や '¥1,000' のような金額を数値にする。数値に変換できない値は NaN。"""
+    if not pd.api.types.is_numeric_dtype(series):
+        series = series.astype(str).str.replace(r'[,¥￥円\s]', '', regex=True)
+    return pd.to_numeric(series, errors='coerce')
+
+
+def prepare_deposits(df_bank):
+    """列名正規化済みの入金明細から入金の一覧 (入金日, 入金金額, 振込依頼人名) を作る。(DataFrame または None, メッセージ) を返す。
+
+    入金金額が正の行だけを入金とする (出金の行や入金金額が空の行は除く)。
+    """
+    messages = [('info', f"デバッグ: 入金明細データフレーム列名正規化後の列: {df_bank.columns.tolist()}")]
+    date_col = _find_column(df_bank, DATE_COLUMNS)
+    amount_col = _find_column(df_bank, AMOUNT_COLUMNS)
+    if date_col is None or amount_col is None:
+        messages.append(('error', f"入金明細CSVに日付 ({' / '.join(DATE_COLUMNS)}) と入金金額 ({' / '.join(AMOUNT_COLUMNS)}) の列が必要です。"))
+        return None, messages
+    payer_col = _find_column(df_bank, PAYER_COLUMNS)
+    if payer_col is None:
+        messages.append(('warning', "入金明細CSVに振込依頼人名の列が見つかりませんでした。金額と日付だけで照合します。"))
+
+    deposits = pd.DataFrame({
+        '入金日': pd.to_datetime(df_bank[date_col], errors='coerce'),
+        '入金金額': _to_amount(df_bank[amount_col]),
+        '振込依頼人名': df_bank[payer_col].fillna('').astype(str) if payer_col else '',
+    })
+    deposits = deposits[deposits['入金金額'] > 0]
+    invalid_dates = deposits['入金日'].isnull()
+    if invalid_dates.any():
+        messages.append(('warning', f"入金明細CSVの日付が無効な入金 {int(invalid_dates.sum()):,} 件は照合の対象外です。"))
+        deposits = deposits[~invalid_dates]
+    deposits = deposits.astype({'入金金額': 'int64'}).reset_index(drop=True)
+    return deposits, messages
+
+
+def invoice_table(df_bakuraku):
+    """明細を請求書ごとにまとめる。(明細ごとの請求書番号, 請求書ごとの一覧) を返す。"""
+    invoice_ids = df_bakuraku.groupby(INVOICE_KEYS, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+    _, first_positions = np.unique(invoice_ids, return_index=True)
+    invoices = df_bakuraku.iloc[first_positions][INVOICE_KEYS].reset_index(drop=True)
+    invoices = invoices.astype({col: object for col in ['書類番号', '送付先名']})
+    invoices['金額'] = np.bincount(invoice_ids, weights=df_bakuraku['金額'].to_numpy(), minlength=len(invoices)).astype('int64')
+    return invoice_ids, invoices
+
+
+def _days(series):
+    return series.to_numpy(dtype='datetime64[D]').astype('int64')
+
+
+def candidate_pairs(invoices, deposits, before=WINDOW_BEFORE_DAYS, after=WINDOW_AFTER_DAYS):
+    """金額が一致し、入金日が支払期日の before 日前から after 日後までにある (請求行, 入金行) の組み合わせ。
+
+    日付を (before + after + 1) 日ごとの期間に分け、請求書は候補期間がかかる期間 (1つか2つ) の番号、
+    入金は入金日の期間の番号を持たせて、(金額, 期間の番号) で結合する。
+    同じ金額の請求書・入金が多くても、期間が離れたものどうしは組み合わせを作らない。
+    """
+    width = before + after + 1
+    invoices = invoices[invoices['支払期日'].notnull()]
+    due = _days(invoices['支払期日'])
+    first = pd.DataFrame({'請求行': invoices.index, '金額': invoices['金額'].to_numpy(), '開始': due - before, '終了': due + after})
+    first['期間'] = first['開始'] // width
+    second = first[first['終了'] // width != first['期間']].assign(期間=lambda df: df['終了'] // width)
+    invoice_windows = pd.concat([first, second], ignore_index=True)
+
+    deposit_keys = pd.DataFrame({'入金行': deposits.index, '金額': deposits['入金金額'].to_numpy(), '入金日': _days(deposits['入金日'])})
+    deposit_keys['期間'] = deposit_keys['入金日'] // width
+
+    pairs = invoice_windows.merge(deposit_keys, on=['金額', '期間'])
+    in_window = (pairs['入金日'] >= pairs['開始']) & (pairs['入金日'] <= pairs['終了'])
+    return pairs.loc[in_window, ['請求行', '入金行']].reset_index(drop=True)
+
+
+def _prefer_name_matches(pairs):
+    """名前が一致する候補がある入金・請求書について、名前が一致しない候補を除く。"""
+    for key in ['入金行', '請求行']:
+        has_name_match = pairs.groupby(key)['名前一致'].transform('max')
+        pairs = pairs[pairs['名前一致'] | ~has_name_match]
+    return pairs
+
+
+def reconcile(df_bakuraku, deposits, before=WINDOW_BEFORE_DAYS, after=WINDOW_AFTER_DAYS):
+    """バクラク請求書の明細 (prepare_bakuraku の結果) と入金 (prepare_deposits の結果) を照合する。
+
+    入金と請求書が互いに1つの候補しか持たず、名前が一致する (または振込依頼人名がない) 場合は自動で消し込む。
+    候補が複数ある場合 (同じ金額の請求書・入金が期間内に複数あるなど) は、その組み合わせをすべて要確認とする。
+    1対1でも振込依頼人名と送付先名が一致しない場合は、別の取引先の入金かもしれないので要確認とする。
+    """
+    invoice_ids, invoices = invoice_table(df_bakuraku)
+    pairs = candidate_pairs(invoices, deposits, before, after)
+
+    invoice_names = name_keys(invoices['送付先名'])
+    payer_names = name_keys(deposits['振込依頼人名'])
+    pair_invoice_names = invoice_names[pairs['請求行'].to_numpy()]
+    pairs['名前一致'] = (pair_invoice_names == payer_names[pairs['入金行'].to_numpy()]) & (pair_invoice_names != '')
+    pairs = _prefer_name_matches(pairs)
+
+    deposit_candidates = pairs.groupby('入金行')['請求行'].transform('size')
+    invoice_candidates = pairs.groupby('請求行')['入金行'].transform('size')
+    unique = (deposit_candidates == 1) & (invoice_candidates == 1)
+    payer_unknown = payer_names[pairs['入金行'].to_numpy()] == ''
+    automatic = unique & (pairs['名前一致'] | payer_unknown)
+    matched = pairs[automatic]
+    ambiguous = pairs[~automatic]
+
+    status = np.full(len(invoices), UNMATCHED, dtype=object)
+    status[ambiguous['請求行'].to_numpy()] = REVIEW
+    status[matched['請求行'].to_numpy()] = AUTO
+    invoices['照合結果'] = status
+    matched_deposits = deposits.loc[matched['入金行'].to_numpy(), ['入金日', '振込依頼人名']].set_axis(matched['請求行'].to_numpy())
+    invoices = invoices.join(matched_deposits)
+
+    review = (
+        ambiguous
+        .join(invoices[INVOICE_KEYS + ['金額']], on='請求行')
+        .join(deposits, on='入金行')
+        .sort_values(['金額', '支払期日', '入金日'])
+        [INVOICE_KEYS + ['金額', '入金日', '入金金額', '振込依頼人名', '名前一致']]
+        .reset_index(drop=True)
+    )
+    unmatched_deposits = deposits[~deposits.index.isin(pairs['入金行'])].reset_index(drop=True)
+
+    messages = [('info', (
+        f"入金 {len(deposits):,} 件を請求書 {len(invoices):,} 件と照合し、{len(matched):,} 件を自動で消し込みました。"
+        f"要確認: 請求書 {ambiguous['請求行'].nunique():,} 件、どの請求書とも対応しない入金: {len(unmatched_deposits):,} 件。"
+    ))]
+    return ReconcileResult(invoices, invoice_ids, review, unmatched_deposits, messages)
+
+
+def unpaid_rows(result):
+    """照合結果から、明細ごとの未入金フラグ (自動で消し込めなかった請求書の明細が True) を作る。"""
+    return (result.invoices['照合結果'] != AUTO).to_numpy()[result.invoice_ids]
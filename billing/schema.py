@@ -0,0 +1,86 @@
+"""統合後の請求データ (1行 = 1請求書) の列と型。
+
+NP掛け払い・バクラク請求書のどちらの処理結果もこの形にそろえてから結合する。
+文字列の繰り返しが多い列はカテゴリ型、金額は円単位の int64、ご利用年月は月単位の Period で持つ。
+"""
+import numpy as np
+import pandas as pd
+
+PAYMENT_FLAGS = ['あり', 'なし'] # 入金有無 のカテゴリ
+TOTAL_LABEL = '合計' # 合計行の ご請求方法
+
+INVOICE_DTYPES = {
+    'ご利用年月': pd.PeriodDtype('M'),
+    'ご請求方法': 'category',
+    'ご請求金額合計 (税込)': 'int64',
+    '未入金金額合計 (税込)': 'int64',
+    '請求書番号': 'string',
+    '請求書発行日': 'datetime64[ns]',
+    'お支払期日': 'datetime64[ns]',
+    '入金有無': pd.CategoricalDtype(PAYMENT_FLAGS),
+    '企業名': 'category',
+}
+INVOICE_COLS = list(INVOICE_DTYPES)
+CATEGORY_COLS = [col for col, dtype in INVOICE_DTYPES.items() if dtype == 'category']
+AMOUNT_COLS = ['ご請求金額合計 (税込)', '未入金金額合計 (税込)']
+DATE_COLS = ['請求書発行日', 'お支払期日']
+
+
+def to_yen(series):
+    """数値に変換できない値を0とし、円単位の整数 (int64) にする。"""
+    return pd.to_numeric(series, errors='coerce').fillna(0).round().astype('int64')
+
+
+def conform(df):
+    """INVOICE_COLS の列を、その順番と型にそろえた DataFrame を返す。"""
+    return df[INVOICE_COLS].astype(INVOICE_DTYPES)
+
+
+def concat(frames):
+    """カテゴリ型の列のカテゴリをそろえてから結合する (そろえないと object 型になってしまうため)。"""
+    frames = [df for df in frames if df is not None]
+    for col in CATEGORY_COLS + ['入金有無']:
+        categories = pd.Index([])
+        for df in frames:
+            categories = categories.union(df[col].cat.categories)
+        frames = [df.assign(**{col: df[col].cat.set_categories(categories)}) for df in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def total_row(df, totals):
+    """合計行 (1行の DataFrame) を df と同じ型で作る。金額以外の列は空。"""
+    return total_rows(df, {col: [totals[col]] for col in AMOUNT_COLS})
+
+
+def total_rows(df, amounts):
+    """合計行 (amounts は金額列ごとの値の配列。その長さの行数の DataFrame) を df と同じ型で作る。金額以外の列は空。"""
+    size = len(amounts[AMOUNT_COLS[0]])
+    rows = pd.DataFrame({
+        col: np.asarray(amounts[col], dtype=df[col].dtype) if col in AMOUNT_COLS else pd.Series([None] * size, dtype=df[col].dtype)
+        for col in df.columns
+    })
+    methods = df['ご請求方法'].cat.categories
+    if TOTAL_LABEL not in methods:
+        methods = methods.append(pd.Index([TOTAL_LABEL]))
+    rows['ご請求方法'] = pd.Categorical([TOTAL_LABEL] * size, categories=methods)
+    return rows
+
+
+def month_labels(series):
+    """ご利用年月 (Period) を表示用の 'YYYY年MM月' にする。欠損値は空文字列。
+
+    文字列への変換は重複のない月ごとに1回だけ行い、各行には番号で割り当てる。
+    """
+    codes, months = pd.factorize(series)
+    labels = np.append(months.strftime('%Y年%m月').to_numpy(dtype=object), '') # 欠損値 (-1) は末尾の ''
+    return pd.Series(labels[codes], index=series.index, name=series.name)
+
+
+def with_month_labels(df):
+    """ご利用年月を表示用の文字列にした DataFrame を返す (画面表示・CSV出力用)。"""
+    return df.assign(**{'ご利用年月': month_labels(df['ご利用年月'])})
+
+
+def memory_usage_mb(df):
+    """DataFrame の使用メモリ (MB、文字列の中身を含む)。"""
+    return df.memory_usage(deep=True).sum() / 1024 / 1024
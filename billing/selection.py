@@ -0,0 +1,39 @@
+"""バクラク請求書の未入金選択。
+
+(書類番号, 日付, 金額) が同じ行を1つの選択単位 (グループ) とし、行ごとのグループ番号を事前に計算しておく。
+選択状態はグループ数の長さのブール配列で持ち、行への反映は配列の添字参照1回で行う。
+"""
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+GROUP_KEYS = ['書類番号', '日付', '金額']
+
+
+class SelectionIndex(NamedTuple):
+    group_ids: np.ndarray # 行ごとのグループ番号 (0 から始まる連番)
+    table: pd.DataFrame # グループごとの代表行 (i 行目がグループ i)
+
+
+def build_index(df_bakuraku):
+    """行ごとのグループ番号と、選択用の一覧表 (グループの出現順) を作る。"""
+    group_ids = df_bakuraku.groupby(GROUP_KEYS, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    # sort=False なのでグループ番号は出現順。各グループの先頭行の位置を取り出す
+    _, first_positions = np.unique(group_ids, return_index=True)
+    table = df_bakuraku.iloc[first_positions][GROUP_KEYS].reset_index(drop=True)
+    return SelectionIndex(group_ids, table)
+
+
+def rows_mask(index, selected_groups):
+    """グループ単位の選択 (長さ=グループ数のブール配列) を行単位のブールマスクに展開する。"""
+    selected_groups = np.asarray(selected_groups, dtype=bool)
+    if len(selected_groups) != len(index.table):
+        raise ValueError("選択状態の件数がグループ数と一致しません。")
+    return selected_groups[index.group_ids]
+
+
+def groups_from_rows(index, rows):
+    """行単位のブールマスクをグループ単位にまとめる (グループ内の行が1つでも True なら True)。"""
+    counts = np.bincount(index.group_ids, weights=np.asarray(rows, dtype=bool), minlength=len(index.table))
+    return counts > 0
@@ -0,0 +1,304 @@
+"""統合結果の Google スプレッドシートへの反映 (差分のみ)。
+
+シートの現在の内容 (前回反映した内容) を1回で読み込み、請求書番号をキーに行ごとの差分を求めて、
+変わった行の範囲だけを数回の一括更新 (batch_update) で書き込む。
+既存の請求書は前回と同じ行に置いたままにし、新しい請求書は削除された請求書の行、足りなければ末尾に置く。
+合計行は常に最終行に置く (前回の最終行が合計行でなければ、データ行として扱う)。列の構成が変わった場合はすべての行を書き直す。
+
+シートの操作は SheetClient (read / batch_update / resize を持つオブジェクト) を通して行う。
+GspreadClient は gspread のワークシート、MemorySheetClient はメモリ上の表 (動作確認用) を操作する。
+API の利用上限 (HTTP 429) に達した場合は、待ち時間を倍にしながら再試行する。
+"""
+import random
+import re
+import time
+from typing import NamedTuple
+
+import pandas as pd
+
+from billing import schema
+
+KEY_COL = '請求書番号'
+MAX_CELLS_PER_UPDATE = 100_000 # 1回の一括更新で書き込む最大セル数
+MAX_RETRIES = 5 # 利用上限に達したときの再試行回数
+RETRY_BASE_SECONDS = 1.0 # 最初の再試行までの待ち時間 (再試行のたびに倍にする)
+
+_A1_START = re.compile(r'([A-Z]+)(\d+)')
+
+
+class RateLimitedError(Exception):
+    """API の利用上限に達した。retry_after は待つべき秒数 (分からない場合は None)。"""
+
+    def __init__(self, retry_after=None):
+        self.retry_after = retry_after
+        super().__init__("API の利用上限に達しました。")
+
+
+class PublishResult(NamedTuple):
+    rows: int # 反映後のシートの行数 (見出しを含む)
+    changed_rows: int # 書き込んだ行数
+    ranges: list # 書き込んだ範囲 (A1形式)
+    api_calls: int # API の呼び出し回数 (再試行を含む)
+
+
+class GspreadClient:
+    """gspread のワークシートを操作する SheetClient。"""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    @classmethod
+    def open(cls, spreadsheet, worksheet_title, credentials=None):
+        """スプレッドシート (URLまたはキー) のワークシートを開く。ない場合は作成する。
+
+        credentials はサービスアカウントの情報 (dict) またはその JSON ファイルのパス。
+        省略時は gspread の既定の場所のファイルを使う。
+        """
+        import gspread
+
+        if isinstance(credentials, dict):
+            client = gspread.service_account_from_dict(credentials)
+        elif credentials:
+            client = gspread.service_account(filename=credentials)
+        else:
+            client = gspread.service_account()
+        book = client.open_by_url(spreadsheet) if spreadsheet.startswith('https://') else client.open_by_key(spreadsheet)
+        try:
+            worksheet = book.worksheet(worksheet_title)
+        except gspread.WorksheetNotFound:
+            worksheet = book.add_worksheet(worksheet_title, rows=1, cols=len(schema.INVOICE_COLS))
+        return cls(worksheet)
+
+    def _call(self, method, *args, **kwargs):
+        from gspread.exceptions import APIError
+
+        try:
+            return method(*args, **kwargs)
+        except APIError as e:
+            if e.code == 429:
+                retry_after = e.response.headers.get('Retry-After')
+                raise RateLimitedError(float(retry_after) if retry_after else None) from e
+            raise
+
+    def read(self):
+        from gspread.utils import ValueRenderOption
+
+        return self._call(self.worksheet.get_values, value_render_option=ValueRenderOption.unformatted)
+
+    def batch_update(self, updates):
+        self._call(self.worksheet.batch_update, [{'range': a1, 'values': values} for a1, values in updates], raw=True)
+
+    def resize(self, rows, cols):
+        self._call(self.worksheet.resize, rows=rows, cols=cols)
+
+
+class MemorySheetClient:
+    """メモリ上の表を操作する SheetClient (動作確認用)。
+
+    calls に呼び出した操作の名前を記録する。rate_limited_calls 回目までの呼び出しは RateLimitedError になる。
+    """
+
+    def __init__(self, values=None, rate_limited_calls=0):
+        self.values = [list(row) for row in values or []]
+        self.calls = []
+        self.rate_limited_calls = rate_limited_calls
+
+    def _record(self, name):
+        self.calls.append(name)
+        if len(self.calls) <= self.rate_limited_calls:
+            raise RateLimitedError(retry_after=0)
+
+    def read(self):
+        self._record('read')
+        return [list(row) for row in self.values]
+
+    def batch_update(self, updates):
+        self._record('batch_update')
+        for a1, values in updates:
+            first_col, first_row = _range_start(a1)
+            for i, row in enumerate(values):
+                target = self.values[first_row - 1 + i]
+                target.extend([''] * (first_col + len(row) - len(target)))
+                target[first_col:first_col + len(row)] = row
+
+    def resize(self, rows, cols):
+        self._record('resize')
+        self.values = [(row + [''] * cols)[:cols] for row in self.values[:rows]]
+        self.values.extend([[''] * cols for _ in range(rows - len(self.values))])
+
+
+def _column_letter(index):
+    """0始まりの列番号を A, B, ..., Z, AA, ... にする。"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def _range(first_row, last_row, cols):
+    """1始まりの行番号の範囲 (A列から cols 列) を A1形式にする。"""
+    return f"A{first_row}:{_column_letter(cols - 1)}{last_row}"
+
+
+def _range_start(a1):
+    """A1形式の範囲の開始位置 (0始まりの列番号, 1始まりの行番号)。"""
+    letters, row = _A1_START.match(a1).groups()
+    col = 0
+    for letter in letters:
+        col = col * 26 + ord(letter) - ord('A') + 1
+    return col - 1, int(row)
+
+
+def sheet_rows(df):
+    """統合結果 (合計行付き) をシートに書き込む値の行のリストにする。
+
+    金額は整数、それ以外は文字列 (日付は YYYY/MM/DD、ご利用年月は YYYY年MM月)、欠損値は空文字列。
+    """
+    columns = []
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.PeriodDtype):
+            values = schema.month_labels(series).tolist()
+        elif col in schema.DATE_COLS:
+            values = series.dt.strftime('%Y/%m/%d').fillna('').tolist()
+        elif col in schema.AMOUNT_COLS:
+            values = [int(value) for value in series]
+        else:
+            values = series.astype(object).where(series.notna(), '').astype(str).tolist()
+        columns.append(values)
+    return [list(row) for row in zip(*columns)]
+
+
+def _cell_text(value):
+    """比較用にセルの値を文字列にする (シートから読んだ 1000.0 と書き込む 1000 を同じとみなす)。"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _row_key(row, counts, key_index):
+    """請求書番号と、同じ請求書番号の何番目の行か (重複がある場合に区別するため)。"""
+    number = _cell_text(row[key_index])
+    occurrence = counts.get(number, 0)
+    counts[number] = occurrence + 1
+    return number, occurrence
+
+
+def plan(old_values, header, data_rows, total_row):
+    """前回の内容 old_values (見出し・データ行・末尾の合計行 (ない場合もある)) から新しい内容への書き込みを求める。
+
+    (新しい内容の行のリスト (見出しを含む), 書き込む行の位置 (0始まり) のリスト) を返す。
+    """
+    width = len(header)
+    old_header = [_cell_text(value) for value in old_values[0]] if old_values else None
+    if old_header is None or old_header[:width] != header or len(old_header) > width and any(old_header[width:]):
+        old_data = [] # 列の構成が変わった場合は前回の行を使わない
+    else:
+        old_data = old_values[1:]
+        if old_data and _is_total_row(old_data[-1], header):
+            old_data = old_data[:-1]
+
+    # 前回の行の位置を請求書番号で引けるようにする (ハッシュ表)
+    key_index = header.index(KEY_COL)
+    counts = {}
+    old_positions = {_row_key(row, counts, key_index): i for i, row in enumerate(old_data) if row and any(row)}
+    counts = {}
+    new_keys = [_row_key(row, counts, key_index) for row in data_rows]
+
+    # 既存の請求書は前回と同じ位置、新しい請求書は空いた位置 (前から順)、足りなければ末尾に置く
+    size = len(data_rows)
+    placed = [None] * size
+    unplaced = []
+    for row_index, key in enumerate(new_keys):
+        position = old_positions.get(key)
+        if position is not None and position < size:
+            placed[position] = row_index
+        else:
+            unplaced.append(row_index)
+    free = (position for position, row_index in enumerate(placed) if row_index is None)
+    for row_index, position in zip(unplaced, free):
+        placed[position] = row_index
+
+    # 書き込むのは、シートの同じ位置の行 (請求書に関係なく) と内容が違う行だけ
+    values = [header] + [data_rows[row_index] for row_index in placed] + [total_row]
+    changed = [
+        position for position, row in enumerate(values)
+        if position >= len(old_values) or [_cell_text(value) for value in row] != _padded(old_values[position], width)
+    ]
+    return values, changed
+
+
+def _is_total_row(row, header):
+    """シートの行が合計行 (ご請求方法が '合計' で、請求書番号が空) か。手で編集したシートでは末尾が合計行とは限らない。"""
+    cells = _padded(row, len(header))
+    method = cells[header.index('ご請求方法')] if 'ご請求方法' in header else None
+    return method == schema.TOTAL_LABEL and cells[header.index(KEY_COL)] == ''
+
+
+def _padded(row, width):
+    return ([_cell_text(value) for value in row] + [''] * width)[:width]
+
+
+def _runs(positions):
+    """昇順の位置のリストを連続する範囲 [(開始, 終了), ...] にまとめる。"""
+    runs = []
+    for position in positions:
+        if runs and runs[-1][1] == position - 1:
+            runs[-1][1] = position
+        else:
+            runs.append([position, position])
+    return runs
+
+
+def _batches(values, runs, width):
+    """連続する範囲を、1回あたり MAX_CELLS_PER_UPDATE セル以下の一括更新にまとめる。"""
+    max_rows = max(1, MAX_CELLS_PER_UPDATE // width)
+    batch = []
+    batch_rows = 0
+    for first, last in runs:
+        for start in range(first, last + 1, max_rows):
+            end = min(start + max_rows - 1, last)
+            if batch and batch_rows + end - start + 1 > max_rows:
+                yield batch
+                batch, batch_rows = [], 0
+            batch.append((_range(start + 1, end + 1, width), values[start:end + 1]))
+            batch_rows += end - start + 1
+    if batch:
+        yield batch
+
+
+def _with_retry(call, counter, sleep=time.sleep):
+    """call を実行する。利用上限に達した場合は待ち時間を倍にしながら MAX_RETRIES 回まで再試行する。"""
+    for attempt in range(MAX_RETRIES + 1):
+        counter[0] += 1
+        try:
+            return call()
+        except RateLimitedError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = e.retry_after if e.retry_after is not None else RETRY_BASE_SECONDS * 2 ** attempt
+            sleep(delay + random.uniform(0, delay / 10))
+
+
+def publish(df, client, sleep=time.sleep):
+    """統合結果 (合計行付き) を client のシートに反映し、PublishResult を返す。
+
+    API の呼び出しは、読み込み1回・行数が変わった場合のサイズ変更1回・変わった行の一括更新 (MAX_CELLS_PER_UPDATE セルごとに1回)。
+    """
+    counter = [0]
+    old_values = _with_retry(client.read, counter, sleep)
+    header = [str(col) for col in df.columns]
+    rows = sheet_rows(df)
+    values, changed = plan(old_values, header, rows[:-1], rows[-1])
+
+    old_width = max((len(row) for row in old_values), default=0)
+    if len(values) != len(old_values) or old_width > len(header):
+        _with_retry(lambda: client.resize(len(values), len(header)), counter, sleep)
+
+    ranges = []
+    for batch in _batches(values, _runs(changed), len(header)):
+        _with_retry(lambda: client.batch_update(batch), counter, sleep)
+        ranges.extend(a1 for a1, _ in batch)
+    return PublishResult(len(values), len(changed), ranges, counter[0])
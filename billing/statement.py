@@ -0,0 +1,187 @@
+"""企業ごとの請求・入金状況一覧 (PDF) の一括作成。
+
+レイアウト (HTMLの雛形とCSS) はモジュールの読み込み時に1回だけ用意する。
+PDFへの変換は WeasyPrint で行い、CSSの解析と日本語フォントの読み込みはプロセスごとに1回だけ行う。
+企業ごとの変換はプロセスプールで並列に行い、結果は順番どおりに1つのZIPへ書き込む。
+WeasyPrint (と cairo / pango) がない環境では available() が False になり、PDFは作成できない。
+"""
+import datetime
+import html
+import os
+import pathlib
+import string
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from billing import export, jobs, schema
+
+try:
+    import weasyprint
+    from weasyprint.text.fonts import FontConfiguration
+except (ImportError, OSError): # 未インストール、または cairo / pango が見つからない
+    weasyprint = None
+
+PDF_MIME = "application/pdf"
+STATEMENT_TITLE = "ご請求およびご入金状況一覧"
+STATEMENT_COLS = ['ご利用年月', 'ご請求方法', 'ご請求金額合計 (税込)', '未入金金額合計 (税込)', '請求書番号', '請求書発行日', 'お支払期日', '入金有無']
+PDF_CHUNKSIZE = 8 # プロセスプールに一度に渡す企業数
+
+# 日本語フォント。環境変数 BILLING_PDF_FONT にフォントファイルを指定した場合はそれを優先する
+FONT_FAMILIES = '"Noto Sans CJK JP", "IPAexGothic", "IPAGothic", "Hiragino Sans", "Yu Gothic", sans-serif'
+
+STATEMENT_CSS = string.Template("""
+$font_face
+@page { size: A4 landscape; margin: 15mm 12mm; @bottom-center { content: counter(page) " / " counter(pages); font-size: 8pt; } }
+body { font-family: $font_families; font-size: 9pt; }
+h1 { font-size: 14pt; margin: 0 0 4pt; }
+h2 { font-size: 12pt; margin: 0 0 4pt; }
+.created { text-align: right; margin: 0 0 8pt; }
+table { width: 100%; border-collapse: collapse; }
+thead { display: table-header-group; }
+th, td { border: 0.5pt solid #999; padding: 2pt 4pt; }
+th { background: #eee; font-weight: bold; }
+td.amount { text-align: right; }
+tr.total td { font-weight: bold; background: #f6f6f6; }
+.note { margin-top: 8pt; font-weight: bold; }
+""")
+
+STATEMENT_HTML = string.Template("""<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><title>$title</title></head>
+<body>
+<h1>$company さま</h1>
+<h2>$title</h2>
+<p class="created">作成日: $created</p>
+<table>
+<thead><tr>$header</tr></thead>
+<tbody>
+$rows
+</tbody>
+</table>
+<p class="note">※$month時点での未入金合計金額: $unpaid円</p>
+</body></html>
+""")
+
+_renderer = None # プロセスごとの (CSS, FontConfiguration)
+
+
+def available():
+    """PDFを作成できる環境か (WeasyPrint と cairo / pango が使えるか)。"""
+    return weasyprint is not None
+
+
+def _css_string(text):
+    """CSS の文字列 ("...") にする (\\ と " と改行をエスケープする)。"""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\a ') + '"'
+
+
+def _font_face():
+    """環境変数 BILLING_PDF_FONT のフォントファイルの @font-face。
+
+    CSS は文字列から読み込む (基準のURLがない) ので、パスは file: の絶対URLにして渡す。
+    """
+    path = os.environ.get('BILLING_PDF_FONT')
+    if not path:
+        return ''
+    return f'@font-face {{ font-family: "Statement"; src: url({_css_string(pathlib.Path(path).resolve().as_uri())}); }}'
+
+
+def _get_renderer():
+    """このプロセスの (CSS, FontConfiguration) を返す。初回だけCSSを解析し、フォントを読み込む。"""
+    global _renderer
+    if _renderer is None:
+        font_config = FontConfiguration()
+        font_face = _font_face()
+        font_families = f'"Statement", {FONT_FAMILIES}' if font_face else FONT_FAMILIES
+        css = weasyprint.CSS(
+            string=STATEMENT_CSS.substitute(font_face=font_face, font_families=font_families),
+            font_config=font_config
+        )
+        _renderer = (css, font_config)
+    return _renderer
+
+
+def _init_worker():
+    """ワーカーの起動時にフォントを読み込んでおく (企業ごとの変換では読み込まない)。"""
+    _get_renderer()
+
+
+def render_pdf(document):
+    """statement_html の結果を PDF のバイト列にする。"""
+    css, font_config = _get_renderer()
+    return weasyprint.HTML(string=document).write_pdf(stylesheets=[css], font_config=font_config)
+
+
+def _cell_texts(df):
+    """表示用の文字列の列 (列名 -> 文字列のリスト)。日付は YYYY/MM/DD、金額は3桁区切り、欠損値は空文字列。"""
+    texts = {}
+    for col in STATEMENT_COLS:
+        series = df[col]
+        if col == 'ご利用年月':
+            values = schema.month_labels(series)
+        elif col in schema.DATE_COLS:
+            values = series.dt.strftime('%Y/%m/%d')
+        elif col in schema.AMOUNT_COLS:
+            values = series.map('{:,}'.format)
+        else:
+            values = series.astype(object)
+        texts[col] = [html.escape(str(value)) for value in values.where(values.notna(), '')]
+    return texts
+
+
+def statement_html(company, df, created):
+    """1社分 (split_by_customer の1要素。末尾が合計行) の一覧をHTMLにする。"""
+    texts = _cell_texts(df)
+    amount_cols = [col in schema.AMOUNT_COLS for col in STATEMENT_COLS]
+    rows = []
+    for i, values in enumerate(zip(*(texts[col] for col in STATEMENT_COLS))):
+        cells = ''.join(
+            f'<td class="amount">{value}</td>' if is_amount else f'<td>{value}</td>'
+            for value, is_amount in zip(values, amount_cols)
+        )
+        rows.append(f'<tr class="total">{cells}</tr>' if i == len(df) - 1 else f'<tr>{cells}</tr>')
+    return STATEMENT_HTML.substitute(
+        title=STATEMENT_TITLE,
+        company=html.escape(company),
+        created=created.strftime('%Y/%m/%d'),
+        header=''.join(f'<th>{html.escape(col)}</th>' for col in STATEMENT_COLS),
+        rows='\n'.join(rows),
+        month=created.strftime('%Y年%m月'),
+        unpaid=f"{int(df['未入金金額合計 (税込)'].iloc[-1]):,}",
+    )
+
+
+def customer_statements(customers, suffix, created=None, workers=None):
+    """split_by_customer の結果を企業ごとのPDF (ファイル名, バイト列) として順に返す。
+
+    HTMLはこのプロセスで作り、PDFへの変換は workers 個のプロセスで並列に行う。
+    workers が1以下の場合やプロセスプールを起動できない環境では、このプロセスで1社ずつ変換する。
+    """
+    if not available():
+        raise RuntimeError("PDFの作成には WeasyPrint (と cairo / pango) が必要です。")
+    created = created or datetime.date.today()
+    if workers is None:
+        workers = jobs.default_workers()
+    names = export.customer_filenames([name for name, _ in customers], suffix, 'pdf')
+
+    done = 0
+    if workers > 1 and len(customers) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(customers)), mp_context=jobs.mp_context(), initializer=_init_worker) as executor:
+                documents = (statement_html(name, df, created) for name, df in customers)
+                for item in zip(names, executor.map(render_pdf, documents, chunksize=PDF_CHUNKSIZE)):
+                    yield item
+                    done += 1
+            return
+        except (OSError, BrokenProcessPool):
+            pass # 残りの企業はこのプロセスで変換する
+    for filename, (name, df) in zip(names[done:], customers[done:]):
+        yield filename, render_pdf(statement_html(name, df, created))
+
+
+def statements_zip_file(customers, suffix, created=None, workers=None, spool_threshold=export.SPOOL_THRESHOLD):
+    """企業ごとのPDFをまとめたZIPファイルを書き出したファイルオブジェクト (先頭にシーク済み) を返す。"""
+    output = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    export.write_zip(customer_statements(customers, suffix, created, workers), output)
+    output.seek(0)
+    return output
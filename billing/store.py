@@ -0,0 +1,194 @@
+"""取り込み済みの請求データをローカルの SQLite ファイルに保存する。
+
+一度取り込んだCSVファイルは内容のハッシュ値で記録し、次回以降は読み込まない。
+NP掛け払いは請求書番号、バクラク請求書は書類番号が同じものを新しい内容で置き換える (後から取り込んだ方が優先)。
+バクラク請求書の未入金選択 (書類番号, 日付, 金額) も保存し、次のセッションで復元する。
+"""
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from billing import ingest, schema, selection
+
+NP_COLUMNS = ['請求書番号', '請求書発行日', 'お支払期日', '企業名', 'ご請求方法', 'ご請求金額合計 (税込)', '未入金金額合計 (税込)', '入金有無']
+BAKURAKU_COLUMNS = ['書類番号', '日付', '支払期日', '送付先名', 'ご請求方法', '金額']
+_DATE_COLUMNS = {'請求書発行日', 'お支払期日', '日付', '支払期日'}
+_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+_TABLES = {ingest.NP: ('np_invoices', NP_COLUMNS, '請求書番号'), ingest.BAKURAKU: ('bakuraku_lines', BAKURAKU_COLUMNS, '書類番号')}
+
+_DDL = '''
+CREATE TABLE IF NOT EXISTS meta (revision INTEGER NOT NULL);
+INSERT INTO meta (revision) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM meta);
+CREATE TABLE IF NOT EXISTS ingested_files (
+    source TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ingested_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (source, digest)
+);
+CREATE TABLE IF NOT EXISTS np_invoices (
+    "請求書番号" TEXT,
+    "請求書発行日" TEXT,
+    "お支払期日" TEXT,
+    "企業名" TEXT,
+    "ご請求方法" TEXT,
+    "ご請求金額合計 (税込)" INTEGER NOT NULL,
+    "未入金金額合計 (税込)" INTEGER NOT NULL,
+    "入金有無" TEXT
+);
+CREATE INDEX IF NOT EXISTS np_invoices_number ON np_invoices ("請求書番号");
+CREATE TABLE IF NOT EXISTS bakuraku_lines (
+    "書類番号" TEXT,
+    "日付" TEXT,
+    "支払期日" TEXT,
+    "送付先名" TEXT,
+    "ご請求方法" TEXT,
+    "金額" INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bakuraku_lines_number ON bakuraku_lines ("書類番号");
+CREATE TABLE IF NOT EXISTS bakuraku_unpaid (
+    "書類番号" TEXT,
+    "日付" TEXT,
+    "金額" INTEGER,
+    UNIQUE ("書類番号", "日付", "金額")
+);
+'''
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _to_rows(df, columns):
+    """SQLite に渡せる値 (文字列・整数・None) の行のリストにする。"""
+    values = []
+    for col in columns:
+        series = df[col]
+        if col in _DATE_COLUMNS:
+            series = series.dt.strftime(_DATE_FORMAT)
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            values.append(series.astype('int64').tolist())
+            continue
+        else:
+            series = series.astype(object).where(series.notna(), None)
+            values.append([None if value is None else str(value) for value in series.tolist()])
+            continue
+        values.append(series.astype(object).where(series.notna(), None).tolist())
+    return list(zip(*values))
+
+
+class InvoiceStore:
+    """取り込み済みデータの保存先。Streamlit の複数スレッドから使えるよう、操作はロックで保護する。"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(_DDL)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def revision(self):
+        """データを追加・更新するたびに増える番号 (読み込み結果のキャッシュキーに使う)。"""
+        with self._lock:
+            return self._conn.execute('SELECT revision FROM meta').fetchone()[0]
+
+    def new_files(self, source, files):
+        """(ファイル名, バイト列, ハッシュ値) のうち、まだ取り込んでいないものを返す。"""
+        with self._lock:
+            known = {row[0] for row in self._conn.execute('SELECT digest FROM ingested_files WHERE source = ?', (source,))}
+        return [file for file in files if file[2] not in known]
+
+    def append(self, source, df, files):
+        """処理済みデータを追加し、取り込んだファイル [(ファイル名, ハッシュ値), ...] を記録する。
+
+        キー (NP: 請求書番号, バクラク: 書類番号) が既存のデータと重複する場合は既存のデータを削除してから追加する。
+        キーが空の行は重複判定の対象外。
+        """
+        table, columns, key = _TABLES[source]
+        if df is not None and not df.empty:
+            keys = df[key].astype('string')
+            has_key = keys.notna() & (keys != '')
+            if source == ingest.NP:
+                # 同じ取り込み内で重複する請求書番号は最後の行を残す
+                df = df[~(keys.duplicated(keep='last') & has_key)]
+                keys = keys[df.index]
+                has_key = has_key[df.index]
+            new_keys = [(k,) for k in keys[has_key].unique()]
+        else:
+            new_keys = []
+
+        with self._lock, self._conn:
+            if new_keys:
+                self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS new_keys (k TEXT PRIMARY KEY)')
+                self._conn.execute('DELETE FROM new_keys')
+                self._conn.executemany('INSERT OR IGNORE INTO new_keys (k) VALUES (?)', new_keys)
+                self._conn.execute(f'DELETE FROM {table} WHERE {_quote(key)} IN (SELECT k FROM new_keys)')
+            if df is not None and not df.empty:
+                placeholders = ', '.join('?' for _ in columns)
+                self._conn.executemany(
+                    f'INSERT INTO {table} ({", ".join(_quote(col) for col in columns)}) VALUES ({placeholders})',
+                    _to_rows(df, columns)
+                )
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO ingested_files (source, digest, name) VALUES (?, ?, ?)',
+                [(source, digest, name) for name, digest in files]
+            )
+            self._conn.execute('UPDATE meta SET revision = revision + 1')
+
+    def _read(self, source):
+        table, columns, _ = _TABLES[source]
+        with self._lock:
+            df = pd.read_sql_query(f'SELECT {", ".join(_quote(col) for col in columns)} FROM {table}', self._conn)
+        for col in columns:
+            if col in _DATE_COLUMNS:
+                df[col] = pd.to_datetime(df[col], format=_DATE_FORMAT, errors='coerce')
+        return df
+
+    def load_np(self):
+        """保存済みのNP掛け払いデータを df_np_processed と同じ形で返す。"""
+        df = self._read(ingest.NP)
+        df['ご利用年月'] = df['請求書発行日'].dt.to_period('M')
+        return schema.conform(df)
+
+    def load_bakuraku(self):
+        """保存済みのバクラク請求書データを、未入金選択の前段階 (prepare_bakuraku の結果) と同じ形で返す。"""
+        df = self._read(ingest.BAKURAKU)
+        df['金額'] = df['金額'].astype('int64')
+        df['ご請求金額合計 (税込)'] = df['金額']
+        return df
+
+    def unpaid_groups(self, index):
+        """保存済みの未入金選択を、選択用インデックスのグループ単位のブール配列にする。"""
+        with self._lock:
+            saved = pd.read_sql_query('SELECT "書類番号", "日付", "金額" FROM bakuraku_unpaid', self._conn)
+        if saved.empty or index.table.empty:
+            return np.zeros(len(index.table), dtype=bool)
+        keys = self._group_keys(index.table)
+        saved_keys = pd.MultiIndex.from_frame(saved.astype(object).where(saved.notna(), None))
+        return pd.MultiIndex.from_frame(keys).isin(saved_keys)
+
+    def save_unpaid(self, index, unpaid_groups):
+        """未入金選択を保存する。今回の一覧に含まれる請求書の選択状態だけを更新する。"""
+        keys = self._group_keys(index.table)
+        rows = list(keys.itertuples(index=False, name=None))
+        unpaid_groups = np.asarray(unpaid_groups, dtype=bool)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'DELETE FROM bakuraku_unpaid WHERE "書類番号" IS ? AND "日付" IS ? AND "金額" IS ?',
+                [row for row, unpaid in zip(rows, unpaid_groups) if not unpaid]
+            )
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO bakuraku_unpaid ("書類番号", "日付", "金額") VALUES (?, ?, ?)',
+                [row for row, unpaid in zip(rows, unpaid_groups) if unpaid]
+            )
+
+    @staticmethod
+    def _group_keys(table):
+        keys = pd.DataFrame(_to_rows(table, selection.GROUP_KEYS), columns=selection.GROUP_KEYS)
+        return keys.astype(object).where(keys.notna(), None)
@@ -0,0 +1,40 @@
+import codecs
+import io
+
+import pytest
+
+from billing import encoding
+
+TEXT = '請求番号,企業名,請求金額\nN1,株式会社エー,1000\n'
+
+
+@pytest.mark.parametrize('data, expected', [
+    (TEXT.encode('utf-8'), 'utf-8'),
+    (codecs.BOM_UTF8 + TEXT.encode('utf-8'), 'utf-8-sig'),
+    (TEXT.encode('cp932'), 'cp932'),
+    (b'a,b\n1,2\n', 'utf-8'),
+])
+def test_detect_encoding(data, expected):
+    assert encoding.detect_encoding(data) == expected
+    f = io.BytesIO(data)
+    assert encoding.detect_stream_encoding(f) == expected
+    assert f.tell() == 0
+
+
+def test_shift_jis_after_sniffed_prefix():
+    # 先頭は ASCII だけで、判定に使う範囲より後ろに Shift-JIS の文字がある
+    data = b'a,b\n' * 100 + TEXT.encode('cp932')
+    assert encoding.detect_encoding(data, sniff_bytes=64) == 'cp932'
+    assert encoding.detect_stream_encoding(io.BytesIO(data), sniff_bytes=64) == 'cp932'
+
+
+def test_utf8_character_split_at_prefix_boundary():
+    data = TEXT.encode('utf-8')
+    # 多バイト文字の途中で切れる長さ
+    assert encoding.detect_encoding(data, sniff_bytes=len('請求番号'.encode('utf-8')) + 1) == 'utf-8'
+
+
+def test_utf8_validation_across_chunks(monkeypatch):
+    monkeypatch.setattr(encoding, '_VALIDATE_CHUNK', 7)
+    data = (TEXT * 20).encode('utf-8')
+    assert encoding.detect_stream_encoding(io.BytesIO(data), sniff_bytes=16) == 'utf-8'
@@ -0,0 +1,141 @@
+import io
+import os
+import threading
+import zipfile
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from billing import export, pipeline
+
+from tests.test_pipeline import invoices
+
+
+def write_bytes(data, calls=None):
+    def write(path):
+        if calls is not None:
+            calls.append(path)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return write
+
+
+def test_export_cache_builds_each_key_once():
+    cache = export.ExportCache()
+    calls = []
+    with cache.get_or_build('a', write_bytes(b'abc', calls)) as f:
+        assert f.read() == b'abc'
+    with cache.get_or_build('a', write_bytes(b'xyz', calls)) as f:
+        assert f.read() == b'abc'
+    assert len(calls) == 1
+
+
+def test_export_cache_returns_independent_handles():
+    cache = export.ExportCache()
+    first = cache.get_or_build('a', write_bytes(b'abcdef'))
+    second = cache.get_or_build('a', write_bytes(b''))
+    assert first.read(3) == b'abc'
+    assert second.read() == b'abcdef'
+    assert first.read() == b'def'
+    first.close()
+    second.close()
+
+
+def test_export_cache_evicts_oldest_file():
+    cache = export.ExportCache(max_entries=2)
+    paths = []
+    for key in 'abc':
+        cache.get_or_build(key, write_bytes(key.encode(), paths)).close()
+    assert not os.path.exists(paths[0])
+    assert all(os.path.exists(path) for path in paths[1:])
+
+
+def test_export_cache_concurrent_requests_share_one_build():
+    cache = export.ExportCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_write(path):
+        calls.append(path)
+        started.set()
+        release.wait(5)
+        write_bytes(b'data')(path)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_build('a', slow_write).read())) for _ in range(3)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [b'data'] * 3
+    assert len(calls) == 1
+
+
+def test_export_cache_failed_build_is_retried():
+    cache = export.ExportCache()
+
+    def failing(path):
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_build('a', failing)
+    with cache.get_or_build('a', write_bytes(b'ok')) as f:
+        assert f.read() == b'ok'
+
+
+def test_build_writes_each_kind(tmp_path):
+    df = invoices(['A社', 'B社', 'A社'])
+    with_total = pipeline.add_total_row(df)
+
+    export.build('sheet', with_total, tmp_path / 'sheet.xlsx')
+    assert openpyxl.load_workbook(tmp_path / 'sheet.xlsx').sheetnames == [export.SHEET_NAME]
+
+    export.build('sheets', df, tmp_path / 'sheets.xlsx')
+    assert openpyxl.load_workbook(tmp_path / 'sheets.xlsx').sheetnames == ['A社', 'B社']
+
+    export.build('zip', df, tmp_path / 'out.zip', suffix='20240101')
+    with zipfile.ZipFile(tmp_path / 'out.zip') as zf:
+        assert zf.namelist() == ['請求入金状況_A社_20240101.xlsx', '請求入金状況_B社_20240101.xlsx']
+
+    export.build('csv', with_total, tmp_path / 'out.csv', encoding='cp932')
+    csv = pd.read_csv(io.BytesIO((tmp_path / 'out.csv').read_bytes()), encoding='cp932')
+    assert len(csv) == len(with_total)
+    assert csv['ご利用年月'].iloc[0] == '2024年01月'
+
+    with pytest.raises(ValueError):
+        export.build('nope', df, tmp_path / 'nope')
+
+
+def test_find_unencodable_reports_rows_and_columns():
+    df = pd.DataFrame({
+        '企業名': pd.Categorical(['髙橋商店', '𠮷野家', '𠮷野家']),
+        '請求書番号': pd.array(['N1', None, 'N3😀'], dtype='string'),
+        '備考': ['a', 1, '😀'],
+        '金額': [1, 2, 3],
+    })
+    problems = export.find_unencodable(df, 'cp932')
+    assert problems.to_dict('records') == [
+        {'行': 2, '列': '企業名', '値': '𠮷野家'},
+        {'行': 3, '列': '企業名', '値': '𠮷野家'},
+        {'行': 3, '列': '請求書番号', '値': 'N3😀'},
+        {'行': 3, '列': '備考', '値': '😀'},
+    ]
+
+
+def test_find_unencodable_skips_utf8():
+    df = pd.DataFrame({'企業名': ['😀']})
+    assert export.find_unencodable(df, 'utf-8').empty
+    assert list(export.find_unencodable(df, 'utf-8').columns) == ['行', '列', '値']
+
+
+def test_write_csv_strict_raises_before_writing():
+    df = pd.DataFrame({'企業名': ['𠮷野家']})
+    output = io.BytesIO()
+    with pytest.raises(export.UnencodableError):
+        export.write_csv(df, output, 'cp932', errors='strict')
+    assert output.getvalue() == b''
@@ -0,0 +1,55 @@
+import pandas as pd
+import pytest
+
+from bench import generate
+from billing import ingest, normalize
+
+BAD_FILE = ('bad.csv', b'\x00\xff\xfe"unterminated\n1,2,3\n"')
+
+
+def test_read_files_reports_loaded_files():
+    files = generate.np_files(20, files=2)
+    df, messages, loaded = ingest.read_files([files[0], BAD_FILE, files[1]], workers=1)
+    assert len(df) == 20
+    assert loaded == (0, 2)
+    assert any(level == 'error' and 'bad.csv' in text for level, text in messages)
+
+
+def test_read_files_nothing_loaded():
+    df, _, loaded = ingest.read_files([BAD_FILE], workers=1)
+    assert df is None
+    assert loaded == ()
+
+
+def test_load_source_reports_loaded_files():
+    files = generate.bakuraku_files(30)
+    result = ingest.load_source(ingest.BAKURAKU, [BAD_FILE] + files, workers=1)
+    assert result.df is not None
+    assert result.loaded_files == (1,)
+
+
+def test_load_np_chunked_reports_loaded_files():
+    files = generate.np_files(50, files=2)
+    result = ingest.load_source(ingest.NP, [files[0], BAD_FILE, files[1]], workers=1, chunksize=10)
+    assert len(result.df) == 50
+    assert result.loaded_files == (0, 2)
+
+
+def test_process_files_matches_load_source():
+    files = generate.bakuraku_files(40, files=2)
+    results = [ingest.read_file(name, data) for name, data in [files[0], BAD_FILE, files[1]]]
+    result = ingest.process_files(ingest.BAKURAKU, results)
+    expected = ingest.load_source(ingest.BAKURAKU, [files[0], BAD_FILE, files[1]], workers=1)
+    pd.testing.assert_frame_equal(result.df, expected.df)
+    pd.testing.assert_frame_equal(result.selection_index.table, expected.selection_index.table)
+    assert result.read_messages == expected.read_messages
+    assert result.loaded_files == expected.loaded_files == (0, 2)
+
+
+@pytest.mark.parametrize('chunksize', [7, 64])
+def test_load_np_chunked_matches_bulk_processing(chunksize):
+    name, data = generate.np_files(150)[0]
+    bulk, _ = ingest.read_csv_file(name, data)
+    expected, _ = normalize.process_np(ingest.normalize_columns(bulk))
+    result = ingest.load_np_chunked([(name, data)], chunksize=chunksize)
+    pd.testing.assert_frame_equal(result.df, expected)
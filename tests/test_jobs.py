@@ -0,0 +1,130 @@
+import os
+import time
+
+import pytest
+
+from billing import jobs
+
+
+def staged(count, seconds, profiler):
+    for i in range(count):
+        with profiler.stage(f"段階{i}"):
+            time.sleep(seconds)
+    return count
+
+
+def worker_defaults():
+    return os.environ.get('BILLING_INGEST_WORKERS'), jobs.default_workers()
+
+
+@pytest.fixture
+def executor():
+    executor = jobs.JobExecutor(max_workers=2)
+    yield executor
+    executor.shutdown()
+
+
+def wait_until_running(job):
+    deadline = time.monotonic() + 10
+    while job.state != jobs.RUNNING:
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def test_same_key_shares_one_job(executor):
+    first = executor.submit('k', staged, 2, 0.01, profile=True, stages=2, waiter='a')
+    second = executor.submit('k', staged, 2, 0.01, profile=True, stages=2, waiter='b')
+    assert first is second
+    assert first.result(10) == 2
+    assert [stage.name for stage in first.records] == ['段階0', '段階1']
+    assert first.progress() == (1.0, jobs.DONE)
+
+
+def test_detach_cancels_only_when_nobody_waits(executor):
+    job = executor.submit('k', staged, 200, 0.02, profile=True, stages=200, waiter='a')
+    executor.submit('k', staged, 200, 0.02, profile=True, stages=200, waiter='b')
+    wait_until_running(job)
+
+    job.detach('a')
+    time.sleep(0.1)
+    assert not job.cancel_requested
+    assert job.state == jobs.RUNNING
+
+    job.detach('b')
+    assert job.cancel_requested
+    with pytest.raises(jobs.JobCancelled):
+        job.result(10)
+    assert job.state == jobs.CANCELLED
+    assert job.error is None
+
+
+def test_job_being_cancelled_is_not_reused(executor):
+    job = executor.submit('k', staged, 200, 0.02, profile=True, waiter='a')
+    wait_until_running(job)
+    job.detach('a')
+    again = executor.submit('k', staged, 1, 0, profile=True, waiter='b')
+    assert again is not job
+    assert again.result(10) == 1
+
+
+def test_failed_job_is_kept_until_retried(executor):
+    job = executor.submit('k', int, 'x')
+    with pytest.raises(ValueError):
+        job.result(10)
+    assert job.state == jobs.FAILED
+    assert isinstance(job.error, ValueError)
+    assert executor.submit('k', int, '1') is job
+
+    executor.discard('k', job)
+    assert executor.submit('k', int, '1').result(10) == 1
+
+
+def test_discard_keeps_newer_job(executor):
+    job = executor.submit('k', int, 'x')
+    with pytest.raises(ValueError):
+        job.result(10)
+    executor.discard('k', job)
+    retried = executor.submit('k', int, '1')
+    executor.discard('k', job)
+    assert executor.submit('k', int, '2') is retried
+
+
+def test_expired_waiters_cancel_job(executor):
+    job = executor.submit('k', staged, 200, 0.02, profile=True, waiter='a')
+    executor.submit('k', staged, 200, 0.02, profile=True, waiter='b')
+    wait_until_running(job)
+
+    job._waiters['a'] -= executor.waiter_timeout + 1 # 'a' のタブが閉じられた
+    executor.expire_waiters()
+    assert 'a' not in job._waiters
+    assert not job.cancel_requested
+
+    executor.expire_waiters(time.monotonic() + executor.waiter_timeout + 1)
+    assert job.cancel_requested
+    with pytest.raises(jobs.JobCancelled):
+        job.result(10)
+
+
+def test_jobs_without_waiters_do_not_expire(executor):
+    job = executor.submit('k', staged, 2, 0.01, profile=True)
+    executor.expire_waiters(time.monotonic() + executor.waiter_timeout + 1)
+    assert job.result(10) == 2
+
+
+def test_workers_do_not_start_nested_pools(executor):
+    assert executor.submit(None, worker_defaults).result(10) == ('1', 1)
+
+
+def test_run_returns_result_and_forgets_job(executor):
+    result, records = executor.run(staged, 1, 0, profile=True)
+    assert result == 1
+    assert len(records) == 1
+    assert executor.jobs() == []
+
+
+def test_default_workers_is_capped_by_ingest_workers(monkeypatch):
+    monkeypatch.setenv('BILLING_JOB_WORKERS', '4')
+    monkeypatch.delenv('BILLING_INGEST_WORKERS', raising=False)
+    assert jobs.default_workers() == 4
+    monkeypatch.setenv('BILLING_INGEST_WORKERS', '1')
+    assert jobs.default_workers() == 1
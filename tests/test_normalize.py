@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bench import generate
+from billing import normalize, schema
+
+
+def row_wise_apply_bakuraku_payment(df_bakuraku, unpaid_rows):
+    """列演算にする前の apply_bakuraku_payment (行ごと・請求書ごとの Python 関数で求める)。"""
+    df_bakuraku = df_bakuraku.astype({col: object for col in normalize.BAKURAKU_CATEGORY_COLS})
+    unpaid = dict(zip(df_bakuraku.index, unpaid_rows))
+    df_bakuraku['入金有無'] = df_bakuraku.index.map(lambda idx: 'なし' if unpaid[idx] else 'あり')
+    df_bakuraku['未入金金額合計 (税込)'] = df_bakuraku.apply(lambda row: row['金額'] if row['入金有無'] == 'なし' else 0, axis=1)
+    df_processed = df_bakuraku.groupby(['書類番号', '日付', '支払期日', '送付先名', 'ご請求方法']).agg(
+        金額合計=('ご請求金額合計 (税込)', 'sum'),
+        未入金合計=('未入金金額合計 (税込)', 'sum'),
+        入金有無=('入金有無', lambda x: 'なし' if 'なし' in x.values else 'あり')
+    ).reset_index()
+    df_processed = df_processed.rename(columns={
+        '日付': '請求書発行日',
+        '支払期日': 'お支払期日',
+        '書類番号': '請求書番号',
+        '送付先名': '企業名',
+        '金額合計': 'ご請求金額合計 (税込)',
+        '未入金合計': '未入金金額合計 (税込)'
+    })
+    df_processed['ご利用年月'] = df_processed['請求書発行日'].dt.to_period('M')
+    return schema.conform(df_processed)
+
+
+def test_process_np_matches_row_wise_rules():
+    df_np = pd.DataFrame({
+        '請求書発行日': ['2024-01-05', '2024-01-10', 'x', '2024-02-01', '2024-02-03'],
+        '支払期限日': ['2024-02-05', '2024-02-10', '2024-02-20', '2024-03-01', None],
+        '請求番号': ['N1', 'N2', 'N3', 'N4', 'N5'],
+        '企業名': ['A社', 'B社', 'A社', None, 'C社'],
+        '請求金額': ['1000', 2500, 'abc', None, 700],
+        '入金ステータス': ['入金済み', '未入金', None, '入金済み', '一部入金'],
+    })
+    statuses = df_np['入金ステータス'].copy()
+    processed, _ = normalize.process_np(df_np)
+
+    expected_flags = statuses.apply(lambda x: 'あり' if x == '入金済み' else 'なし')
+    assert processed['入金有無'].astype(str).tolist() == expected_flags.tolist()
+    expected_unpaid = processed.apply(lambda row: row['ご請求金額合計 (税込)'] if row['入金有無'] == 'なし' else 0, axis=1)
+    assert processed['未入金金額合計 (税込)'].tolist() == expected_unpaid.tolist()
+    assert processed['ご請求金額合計 (税込)'].tolist() == [1000, 2500, 0, 0, 700]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_apply_bakuraku_payment_matches_row_wise_version(seed):
+    df_bakuraku, _ = normalize.prepare_bakuraku(generate.bakuraku_frame(300, seed=seed))
+    unpaid_rows = np.random.default_rng(seed).random(len(df_bakuraku)) < 0.3
+
+    result = normalize.apply_bakuraku_payment(df_bakuraku, unpaid_rows)
+    expected = row_wise_apply_bakuraku_payment(df_bakuraku, unpaid_rows)
+    pd.testing.assert_frame_equal(result, expected)
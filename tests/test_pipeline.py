@@ -0,0 +1,53 @@
+import pandas as pd
+
+from billing import export, pipeline, schema
+
+
+def invoices(companies, amounts=None):
+    """1社1行ずつ (companies の順) の統合結果。"""
+    n = len(companies)
+    amounts = amounts if amounts is not None else list(range(1, n + 1))
+    return schema.conform(pd.DataFrame({
+        'ご利用年月': pd.period_range('2024-01', periods=n, freq='M'),
+        'ご請求方法': ['NP掛け払い'] * n,
+        'ご請求金額合計 (税込)': amounts,
+        '未入金金額合計 (税込)': [a // 2 for a in amounts],
+        '請求書番号': [f"N{i}" for i in range(n)],
+        '請求書発行日': pd.date_range('2024-01-01', periods=n),
+        'お支払期日': pd.date_range('2024-02-01', periods=n),
+        '入金有無': ['あり'] * n,
+        '企業名': companies,
+    }))
+
+
+def test_split_by_customer_matches_per_customer_total_rows():
+    df = invoices(['B社', 'A社', None, 'B社', 'A社', 'C社'], [100, 200, 300, 400, 500, 600])
+    customers = pipeline.split_by_customer(df)
+
+    assert [name for name, _ in customers] == ['A社', 'B社', 'C社', pipeline.DEFAULT_COMPANY_NAME]
+    sorted_df = df.sort_values('企業名', kind='stable', na_position='last').reset_index(drop=True)
+    for (_, part), (_, expected_rows) in zip(customers, sorted_df.groupby('企業名', sort=False, dropna=False, observed=True)):
+        expected = pipeline.add_total_row(expected_rows)
+        pd.testing.assert_frame_equal(part, expected)
+        assert part['ご請求方法'].iloc[-1] == schema.TOTAL_LABEL
+
+
+def test_split_by_customer_empty():
+    assert pipeline.split_by_customer(invoices([])) == []
+
+
+def test_customer_filenames_are_unique():
+    filenames = export.customer_filenames(['A/B', 'A:B', 'a/b', 'C'], '20240101', 'xlsx')
+    assert filenames == [
+        '請求入金状況_A_B_20240101.xlsx',
+        '請求入金状況_A_B (2)_20240101.xlsx',
+        '請求入金状況_a_b (3)_20240101.xlsx',
+        '請求入金状況_C_20240101.xlsx',
+    ]
+
+
+def test_customer_workbooks_do_not_overwrite_each_other():
+    customers = pipeline.split_by_customer(invoices(['A/B', 'A:B']))
+    filenames = [filename for filename, _ in export.customer_workbooks(customers, '20240101')]
+    assert len(set(filenames)) == 2
+    assert all(name.endswith('.xlsx') for name in filenames)
@@ -0,0 +1,98 @@
+import pandas as pd
+
+from billing import reconcile
+
+
+def bakuraku(rows):
+    """(書類番号, 支払期日, 送付先名, 金額) の明細から prepare_bakuraku の結果と同じ列の DataFrame を作る。"""
+    df = pd.DataFrame(rows, columns=['書類番号', '支払期日', '送付先名', '金額'])
+    df['日付'] = pd.to_datetime(df['支払期日']) - pd.Timedelta(days=30)
+    df['支払期日'] = pd.to_datetime(df['支払期日'])
+    return df
+
+
+def deposits(rows):
+    """(入金日, 入金金額, 振込依頼人名) の一覧。"""
+    df = pd.DataFrame(rows, columns=['入金日', '入金金額', '振込依頼人名'])
+    df['入金日'] = pd.to_datetime(df['入金日'])
+    return df
+
+
+def statuses(result):
+    return dict(zip(result.invoices['書類番号'], result.invoices['照合結果']))
+
+
+def test_normalize_name():
+    assert reconcile.normalize_name('株式会社エー') == reconcile.normalize_name('ｶ)ｴｰ')
+    assert reconcile.normalize_name('（株）ビー ショウジ') == reconcile.normalize_name('ﾋﾞｰｼｮｳｼﾞ')
+    assert reconcile.normalize_name('株式会社エー') != reconcile.normalize_name('ｶ)ﾍﾞﾂｼﾔ')
+
+
+def test_matching_name_is_cleared_automatically():
+    result = reconcile.reconcile(
+        bakuraku([('B-1', '2024-03-31', '株式会社エー', 60_000), ('B-1', '2024-03-31', '株式会社エー', 40_000)]),
+        deposits([('2024-03-29', 100_000, 'ｶ)ｴｰ')]),
+    )
+    assert statuses(result) == {'B-1': reconcile.AUTO}
+    assert result.review.empty
+    assert result.invoices['振込依頼人名'].iloc[0] == 'ｶ)ｴｰ'
+
+
+def test_unique_pair_with_different_payer_goes_to_review():
+    result = reconcile.reconcile(
+        bakuraku([('B-1', '2024-03-31', '株式会社エー', 100_000)]),
+        deposits([('2024-03-29', 100_000, 'ｶ)ﾍﾞﾂｼﾔ')]),
+    )
+    assert statuses(result) == {'B-1': reconcile.REVIEW}
+    assert result.review[['書類番号', '振込依頼人名', '名前一致']].values.tolist() == [['B-1', 'ｶ)ﾍﾞﾂｼﾔ', False]]
+    assert reconcile.unpaid_rows(result).tolist() == [True]
+
+
+def test_unique_pair_without_payer_name_is_cleared():
+    result = reconcile.reconcile(
+        bakuraku([('B-1', '2024-03-31', '株式会社エー', 100_000)]),
+        deposits([('2024-03-29', 100_000, '')]),
+    )
+    assert statuses(result) == {'B-1': reconcile.AUTO}
+    assert reconcile.unpaid_rows(result).tolist() == [False]
+
+
+def test_same_amount_invoices_go_to_review():
+    result = reconcile.reconcile(
+        bakuraku([('B-1', '2024-03-31', '株式会社エー', 100_000), ('B-2', '2024-04-10', '株式会社エー', 100_000)]),
+        deposits([('2024-03-29', 100_000, 'ｶ)ｴｰ')]),
+    )
+    assert statuses(result) == {'B-1': reconcile.REVIEW, 'B-2': reconcile.REVIEW}
+    assert len(result.review) == 2
+
+
+def test_name_match_is_preferred_over_other_candidates():
+    result = reconcile.reconcile(
+        bakuraku([('B-1', '2024-03-31', '株式会社エー', 100_000), ('B-2', '2024-03-31', '株式会社ビー', 100_000)]),
+        deposits([('2024-03-29', 100_000, 'ｶ)ﾋﾞｰ')]),
+    )
+    assert statuses(result) == {'B-1': reconcile.UNMATCHED, 'B-2': reconcile.AUTO}
+
+
+def test_deposit_outside_window_is_unmatched():
+    before, after = reconcile.WINDOW_BEFORE_DAYS, reconcile.WINDOW_AFTER_DAYS
+    due = pd.Timestamp('2024-03-31')
+    result = reconcile.reconcile(
+        bakuraku([('B-1', due, 'エー', 100_000), ('B-2', due, 'ビー', 200_000)]),
+        deposits([(due - pd.Timedelta(days=before + 1), 100_000, 'ｴｰ'), (due + pd.Timedelta(days=after), 200_000, 'ﾋﾞｰ')]),
+    )
+    assert statuses(result) == {'B-1': reconcile.UNMATCHED, 'B-2': reconcile.AUTO}
+    assert result.unmatched_deposits['入金金額'].tolist() == [100_000]
+
+
+def test_prepare_deposits_keeps_positive_amounts():
+    df_bank = pd.DataFrame({
+        '取引日': ['2024/03/01', '2024/03/02', 'invalid', '2024/03/04'],
+        '摘要': ['ｶ)ｴｰ', '振替', 'ｶ)ﾋﾞｰ', 'ｶ)ｼｰ'],
+        'お支払金額': ['', '5,000', '', ''],
+        'お預り金額': ['1,000', '', '2,000', '¥3,000'],
+    })
+    df, messages = reconcile.prepare_deposits(df_bank)
+    assert df['入金金額'].tolist() == [1_000, 3_000]
+    assert df['振込依頼人名'].tolist() == ['ｶ)ｴｰ', 'ｶ)ｼｰ']
+    assert any(level == 'warning' for level, _ in messages)
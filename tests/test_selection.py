@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+
+from billing import selection
+
+
+def test_build_index_numbers_categorical_groups_in_order():
+    df = pd.DataFrame({
+        '書類番号': pd.Categorical(['B2', 'A1', 'B2', None], categories=['A1', 'B2', 'C3']),
+        '日付': pd.to_datetime(['2024-01-02', '2024-01-01', '2024-01-02', '2024-01-03']),
+        '金額': [200, 100, 200, 300],
+    })
+    index = selection.build_index(df)
+    np.testing.assert_array_equal(index.group_ids, [0, 1, 0, 2])
+    assert index.table['書類番号'].tolist()[:2] == ['B2', 'A1']
+    assert len(index.table) == 3
+    np.testing.assert_array_equal(selection.rows_mask(index, [True, False, False]), [True, False, True, False])
@@ -0,0 +1,130 @@
+import pandas as pd
+import pytest
+
+from billing import pipeline, sheets
+
+from tests.test_pipeline import invoices
+
+
+def publish(df, client, sleeps=None):
+    return sheets.publish(df, client, sleep=(sleeps.append if sleeps is not None else lambda seconds: None))
+
+
+def with_total(companies, amounts):
+    return pipeline.add_total_row(invoices(companies, amounts))
+
+
+def test_sheet_rows_formats_values():
+    rows = sheets.sheet_rows(with_total(['A社'], [1000]))
+    assert rows[0] == ['2024年01月', 'NP掛け払い', 1000, 500, 'N0', '2024/01/01', '2024/02/01', 'あり', 'A社']
+    assert rows[1] == ['', '合計', 1000, 500, '', '', '', '', '']
+
+
+def test_first_publish_writes_everything():
+    client = sheets.MemorySheetClient()
+    result = publish(with_total(['A社', 'B社'], [100, 200]), client)
+    assert result.rows == 4
+    assert result.changed_rows == 4
+    assert client.calls == ['read', 'resize', 'batch_update']
+    assert client.values[0][0] == 'ご利用年月'
+    assert client.values[-1][1] == '合計'
+
+
+def test_unchanged_republish_only_reads():
+    df = with_total(['A社', 'B社'], [100, 200])
+    client = sheets.MemorySheetClient()
+    publish(df, client)
+    client.calls.clear()
+    result = publish(df, client)
+    assert result.changed_rows == 0
+    assert result.api_calls == 1
+    assert client.calls == ['read']
+
+
+def test_changed_row_and_total_are_the_only_writes():
+    client = sheets.MemorySheetClient()
+    publish(with_total(['A社', 'B社', 'C社'], [100, 200, 300]), client)
+    client.calls.clear()
+    result = publish(with_total(['A社', 'B社', 'C社'], [100, 250, 300]), client)
+    assert result.changed_rows == 2 # B社の行と合計行
+    assert result.ranges == ['A3:I3', 'A5:I5']
+    assert client.calls == ['read', 'batch_update']
+    assert client.values[1:] == sheets.sheet_rows(with_total(['A社', 'B社', 'C社'], [100, 250, 300]))
+
+
+def test_existing_invoices_keep_their_rows():
+    client = sheets.MemorySheetClient()
+    old = with_total(['A社', 'B社', 'C社'], [100, 200, 300])
+    publish(old, client)
+    # B社 (N1) を削除し、先頭に新しい請求書を追加する
+    new = pd.concat([old.iloc[[2]].assign(請求書番号='N9'), old.iloc[[0, 2]]], ignore_index=True)
+    publish(pipeline.add_total_row(new), client)
+    assert [row[4] for row in client.values[1:-1]] == ['N0', 'N9', 'N2']
+    assert client.values[-1][1] == '合計'
+
+
+def test_column_change_rewrites_all_rows():
+    client = sheets.MemorySheetClient([['旧列'], ['x'], ['合計']])
+    result = publish(with_total(['A社'], [100]), client)
+    assert result.changed_rows == 3
+    assert [row[0] for row in client.values] == ['ご利用年月', '2024年01月', '']
+
+
+def test_sheet_without_total_row_keeps_last_data_row():
+    header = ['請求書番号', 'ご請求方法', '金額']
+    # 合計行を手で消したシート: 最終行の N1 もデータ行として扱う
+    old = [header, ['N0', 'x', 1], ['N1', 'x', 2]]
+    new_values, changed = sheets.plan(old, header, [['N1', 'x', 2], ['N2', 'x', 3]], ['', '合計', 5])
+    assert new_values == [header, ['N2', 'x', 3], ['N1', 'x', 2], ['', '合計', 5]]
+    assert changed == [1, 3]
+
+
+def test_plan_places_duplicate_invoice_numbers_by_occurrence():
+    header = ['請求書番号', 'ご請求方法', '金額']
+    old = [header, ['N1', 'x', 1], ['N1', 'x', 2], ['', '合計', 3]]
+    new_values, changed = sheets.plan(old, header, [['N1', 'x', 1], ['N1', 'x', 2]], ['', '合計', 3])
+    assert changed == []
+
+
+def test_rate_limited_calls_are_retried():
+    client = sheets.MemorySheetClient(rate_limited_calls=2)
+    sleeps = []
+    result = publish(with_total(['A社'], [100]), client, sleeps)
+    assert client.calls[:3] == ['read', 'read', 'read']
+    assert result.api_calls == len(client.calls)
+    assert len(sleeps) == 2
+    assert client.values[-1][1] == '合計'
+
+
+def test_retry_backs_off_exponentially(monkeypatch):
+    monkeypatch.setattr(sheets.random, 'uniform', lambda low, high: 0)
+    attempts = []
+
+    def call():
+        attempts.append(1)
+        if len(attempts) <= 3:
+            raise sheets.RateLimitedError()
+        return 'ok'
+
+    sleeps = []
+    counter = [0]
+    assert sheets._with_retry(call, counter, sleeps.append) == 'ok'
+    assert sleeps == [1.0, 2.0, 4.0]
+    assert counter == [4]
+
+
+def test_retry_gives_up_after_max_retries():
+    def call():
+        raise sheets.RateLimitedError(retry_after=0)
+
+    with pytest.raises(sheets.RateLimitedError):
+        sheets._with_retry(call, [0], lambda seconds: None)
+
+
+def test_large_updates_are_split_into_batches(monkeypatch):
+    monkeypatch.setattr(sheets, 'MAX_CELLS_PER_UPDATE', 9 * 3)
+    client = sheets.MemorySheetClient()
+    df = with_total([f"企業{i}" for i in range(7)], list(range(1, 8)))
+    publish(df, client)
+    assert client.calls == ['read', 'resize', 'batch_update', 'batch_update', 'batch_update']
+    assert client.values == [[str(col) for col in df.columns]] + sheets.sheet_rows(df)
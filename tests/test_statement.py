@@ -0,0 +1,33 @@
+import datetime
+
+import pytest
+
+from billing import pipeline, statement
+
+from tests.test_pipeline import invoices
+
+
+def test_font_face_uses_absolute_file_url(monkeypatch, tmp_path):
+    tinycss2 = pytest.importorskip('tinycss2')
+    font = tmp_path / 'my "fonts"' / 'フォント.otf'
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('BILLING_PDF_FONT', str(font.relative_to(tmp_path)))
+
+    rule = tinycss2.parse_stylesheet(statement._font_face(), skip_whitespace=True)[0]
+    declarations = tinycss2.parse_blocks_contents(rule.content, skip_whitespace=True)
+    src = next(d for d in declarations if d.type == 'declaration' and d.lower_name == 'src')
+    url = next(token for token in src.value if token.type == 'function' and token.lower_name == 'url')
+    assert url.arguments[0].value == font.as_uri()
+
+
+def test_font_face_empty_without_env(monkeypatch):
+    monkeypatch.delenv('BILLING_PDF_FONT', raising=False)
+    assert statement._font_face() == ''
+
+
+def test_statement_html_escapes_and_marks_total_row():
+    [(name, df)] = pipeline.split_by_customer(invoices(['<A&B>', '<A&B>']))
+    document = statement.statement_html(name, df, datetime.date(2024, 5, 1))
+    assert '&lt;A&amp;B&gt; さま' in document
+    assert document.count('<tr class="total">') == 1
+    assert '※2024年05月時点での未入金合計金額: 1円' in document
@@ -0,0 +1,57 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from bench import generate
+from billing import ingest, selection, store
+
+from tests.test_ingest import BAD_FILE
+
+
+def with_digests(files):
+    return [(name, data, hashlib.sha256(data).hexdigest()) for name, data in files]
+
+
+def test_np_round_trip(tmp_path):
+    invoice_store = store.InvoiceStore(tmp_path / 'store.sqlite3')
+    df = ingest.load_source(ingest.NP, generate.np_files(50), workers=1).df
+    invoice_store.append(ingest.NP, df, [('np.csv', 'digest')])
+
+    loaded = invoice_store.load_np()
+    pd.testing.assert_frame_equal(
+        loaded.sort_values('請求書番号', ignore_index=True),
+        df.sort_values('請求書番号', ignore_index=True),
+        check_categorical=False,
+    )
+
+
+def test_bakuraku_round_trip_and_unpaid_selection(tmp_path):
+    invoice_store = store.InvoiceStore(tmp_path / 'store.sqlite3')
+    df = ingest.load_source(ingest.BAKURAKU, generate.bakuraku_files(40), workers=1).df
+    invoice_store.append(ingest.BAKURAKU, df, [('bakuraku.csv', 'digest')])
+
+    loaded = invoice_store.load_bakuraku()
+    assert len(loaded) == len(df)
+    assert loaded['金額'].sum() == df['金額'].sum()
+
+    index = selection.build_index(loaded)
+    unpaid = np.zeros(len(index.table), dtype=bool)
+    unpaid[::3] = True
+    invoice_store.save_unpaid(index, unpaid)
+    reopened = store.InvoiceStore(tmp_path / 'store.sqlite3')
+    np.testing.assert_array_equal(reopened.unpaid_groups(selection.build_index(reopened.load_bakuraku())), unpaid)
+
+
+def test_new_files_skips_only_loaded_files(tmp_path):
+    invoice_store = store.InvoiceStore(tmp_path / 'store.sqlite3')
+    files = with_digests(generate.np_files(20) + [BAD_FILE])
+    assert invoice_store.new_files(ingest.NP, files) == files
+
+    result = ingest.load_source(ingest.NP, [(name, data) for name, data, _ in files], workers=1)
+    file_keys = [(name, digest) for name, _, digest in files]
+    invoice_store.append(ingest.NP, result.df, [file_keys[i] for i in result.loaded_files])
+
+    # 読み込めなかったファイルは取り込み済みにならない
+    assert [name for name, _, _ in invoice_store.new_files(ingest.NP, files)] == ['bad.csv']
+    assert invoice_store.revision() == 1